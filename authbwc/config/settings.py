@@ -23,6 +23,7 @@ class Settings(ComponentSettings):
         self.add_route('/groups/<action>/<int:objid>', endpoint='auth:GroupCrud')
         self.add_route('/permissions/<action>', endpoint='auth:PermissionCrud')
         self.add_route('/permissions/<action>/<int:objid>', endpoint='auth:PermissionCrud')
+        self.add_route('/permissions/holders/<int:objid>', 'auth:PermissionHolders')
         self.add_route('/users/profile', 'auth:UserProfile')
 
         self.for_me.cp_nav.enabled = base_bwa
@@ -74,3 +75,114 @@ class Settings(ComponentSettings):
         #
         # If left as None, it will not be used
         self.for_me.password_salt = None
+
+        # how should passwords be hashed?  `name` can be:
+        #
+        #   'pbkdf2': PBKDF2-HMAC-SHA256 with `iterations` rounds
+        #   'scrypt': hashlib.scrypt (Python 3.6+) with cost `n`, block size `r`
+        #       and parallelization `p`
+        #   'sha512': a single round of sha512, the only option before 0.3.3.
+        #       Only use it if the hashes must stay readable by older versions.
+        #   a callable: given these settings, returns a lib.hashers.PasswordHasher
+        #
+        # Hashes made by another hasher or with other work factors are still
+        # verified and get replaced the next time the user logs in.  The
+        # calibrate-password-hasher task times hashing on the host and suggests
+        # work factors for a hash to take about `target_ms`.
+        self.for_me.password_hasher.name = 'pbkdf2'
+        self.for_me.password_hasher.iterations = 100000
+        self.for_me.password_hasher.n = 2 ** 14
+        self.for_me.password_hasher.r = 8
+        self.for_me.password_hasher.p = 1
+        self.for_me.password_hasher.target_ms = 250
+
+        # verify passwords at login in a pool of `workers` threads rather than
+        # in the request thread (None).  When `max_pending` logins are already
+        # waiting for the pool, the login is turned away with a message to try
+        # again.  Needs concurrent.futures (the "futures" package on Python 2).
+        self.for_me.password_verify.workers = None
+        self.for_me.password_verify.max_pending = 20
+
+        # turn away logins for a login id that failed `per_login` times, or from
+        # a remote address that failed `per_ip` times, in the last `window`
+        # seconds (None for no limit).  Turned away logins are not counted and
+        # don't look up the user or hash the password.  `backend` can be:
+        #
+        #   None: no throttling
+        #   'memory': counts in each process, for at most `max_keys` login ids
+        #       and addresses
+        #   'dbm': dbm file at `dbm_path` (defaults to the app's data dir)
+        #       shared by the processes on a host
+        #   a callable: given these settings, returns a store like
+        #       lib.throttle.MemoryWindowStore
+        #
+        # Throttling by address is off by default: behind a proxy every login
+        # can come from the proxy's address.  Set `per_ip` (e.g. to 50) only
+        # where remote_addr is the client's.
+        self.for_me.login_throttle.backend = 'memory'
+        self.for_me.login_throttle.window = 300
+        self.for_me.login_throttle.per_login = 10
+        self.for_me.login_throttle.per_ip = None
+        self.for_me.login_throttle.max_keys = 10000
+        self.for_me.login_throttle.dbm_path = None
+
+        # how should effective permissions be resolved?
+        #
+        #   'sql': run the permission map query for each lookup
+        #   'memory': load the assignment and group membership tables into an
+        #       in-process index and resolve permissions in Python.  The index
+        #       is dropped when the auth epoch changes (see `check_auth_epoch`)
+        #       and reloaded after `permission_engine_ttl` seconds (None to
+        #       disable) to pick up changes made elsewhere.
+        #   'table': read approvals from auth_effective_permissions, which the
+        #       model keeps up to date as assignments and memberships change.
+        #       Populate it with the rebuild-effective-permissions task when
+        #       switching to this engine.
+        self.for_me.permission_engine = 'sql'
+        self.for_me.permission_engine_ttl = 60
+
+        # check the auth epoch (see model/epoch.py) at the start of every
+        # request and drop cached permission data in this process if it changed.
+        # Turn on when caching permissions across multiple processes.
+        self.for_me.check_auth_epoch = False
+
+        # cache for User.cm_permission_dict(), keyed by user id and
+        # su_override.  `backend` can be:
+        #
+        #   None: no caching
+        #   'memory': LRU cache in each process, holding at most `max_size`
+        #       entries
+        #   'dbm': dbm file at `dbm_path` (defaults to the app's data dir)
+        #       shared by the processes on a host
+        #   a callable: given these settings, returns a lib.cache.CacheBackend
+        #
+        # Entries expire after `ttl` seconds and the cache is cleared whenever
+        # the auth epoch changes.
+        self.for_me.permission_cache.backend = None
+        self.for_me.permission_cache.max_size = 10000
+        self.for_me.permission_cache.ttl = 300
+        self.for_me.permission_cache.dbm_path = None
+
+        # how should the session user's approved permissions be stored?
+        #
+        #   'names': the name of every approved permission
+        #   'mask': a single int with a bit set for each approved permission,
+        #       the names are looked up on the first check in each request
+        self.for_me.session_permissions = 'names'
+
+        # compare the session user's permission_version to the database at the
+        # start of every request.  When it changed, the session user is rebuilt
+        # (or logged out if the user was deleted or made inactive).  Versions
+        # are cached in each process for `session_version_ttl` seconds.
+        self.for_me.check_session_version = False
+        self.for_me.session_version_ttl = 5
+
+        # can groups be nested in other groups (Group.update(assigned_groups=...))?
+        # When on, a group's members get the permissions of every group it is
+        # nested in, at any depth.  Run the rebuild-group-closure task after
+        # upgrading an existing database, before turning this on.
+        self.for_me.nested_groups = False
+
+        # select from the auth_user_permissions view (installed by init-db, see
+        # model/sqlview.py) rather than sending the full permission query
+        self.for_me.permission_view = False
@@ -1,7 +1,11 @@
 from blazeweb.events import signal
-from blazeweb.globals import user
+from blazeweb.globals import settings, user
 from blazeweb.views import forward
 
+from compstack.auth.helpers.session import refresh_session_user
+from compstack.auth.lib.cache import clear_request_memo
+from compstack.auth.model.epoch import check_auth_epoch
+
 
 def check_reset_required(sender, endpoint, urlargs):
     skip_endpoints = ['auth:ChangePassword', 'auth:Logout']
@@ -9,4 +13,21 @@ def check_reset_required(sender, endpoint, urlargs):
         forward('auth:ChangePassword')
 
 
+def check_permission_epoch(sender, endpoint, urlargs):
+    if settings.components.auth.check_auth_epoch:
+        check_auth_epoch()
+
+
+def check_session_version(sender, endpoint, urlargs):
+    if settings.components.auth.check_session_version and user.is_authenticated:
+        refresh_session_user()
+
+
+def clear_permission_memo(sender, response):
+    clear_request_memo()
+
+
+signal('blazeweb.response_cycle.started').connect(check_permission_epoch)
+signal('blazeweb.response_cycle.started').connect(check_session_version)
 signal('blazeweb.response_cycle.started').connect(check_reset_required)
+signal('blazeweb.response_cycle.ended').connect(clear_permission_memo)
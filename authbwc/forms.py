@@ -6,6 +6,7 @@ import sqlalchemy as sa
 import six
 
 from compstack.auth.helpers import validate_password_complexity, note_password_complexity
+from compstack.auth.lib.hashers import PasswordVerifyBusy
 from compstack.auth.model.orm import User as orm_User, Group as orm_Group, \
     Permission as orm_Permission
 from compstack.common.lib.forms import Form
@@ -268,7 +269,11 @@ class ChangePasswordForm(UserFormBase):
 
     def validate_password(self, value):
         dbobj = orm_User.get(user.id)
-        if not dbobj.validate_password(value):
+        try:
+            valid = dbobj.validate_password(value)
+        except PasswordVerifyBusy:
+            raise ValueInvalid('the server is busy, please try again')
+        if not valid:
             raise ValueInvalid('incorrect password')
 
         return value
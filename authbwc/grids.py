@@ -84,6 +84,17 @@ class PermissionMapColumn(LinkColumnBase):
         )
 
 
+class PermissionHoldersColumn(LinkColumnBase):
+    def extract_data(self, rec):
+        return 'view holders'
+
+    def create_url(self, record):
+        return url_for(
+            'auth:PermissionHolders',
+            objid=record.id,
+        )
+
+
 class YesNoFilter(FilterBase):
     operators = (
         Operator('a', 'all', None),
@@ -148,6 +159,7 @@ class PermissionGrid(Grid):
     PermissionActionColumn('', Permission.id, can_sort=False, render_in='html')
     Column('Permission', Permission.name, TextFilter)
     Column('Description', Permission.description, TextFilter)
+    PermissionHoldersColumn('Holders', None, can_sort=False)
 
     def query_prep(self, query, has_sort, has_filters):
         # default sort
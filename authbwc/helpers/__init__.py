@@ -2,6 +2,7 @@
 
 from compstack.auth.helpers.email import send_new_user_email, send_change_password_email, \
     send_reset_password_email
-from compstack.auth.helpers.functions import add_administrative_user, add_user
+from compstack.auth.helpers.functions import add_administrative_user, add_user, chunked
 from compstack.auth.helpers.password import note_password_complexity, validate_password_complexity
-from compstack.auth.helpers.session import after_login_url, load_session_user
+from compstack.auth.helpers.session import after_login_url, load_session_user, \
+    refresh_session_user
@@ -1,3 +1,5 @@
+from itertools import islice
+
 from blazeutils.strings import randchars
 from blazeweb.globals import settings
 import six
@@ -53,3 +55,16 @@ def add_user(login_id, email, password=None, super_user=False, send_email=True):
     else:
         email_sent = False
     return u, email_sent
+
+
+def chunked(items, size):
+    """
+        Yields lists of at most `size` items from `items`, which can be any
+        iterable and is only consumed as the chunks are needed
+    """
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
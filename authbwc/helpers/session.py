@@ -1,6 +1,16 @@
+import time
+
 from blazeweb.globals import settings, user
 from blazeweb.routing import prefix_relative_url
 
+from compstack.auth.lib.cache import LRUCache
+from compstack.auth.model.engine import permission_registry
+from compstack.auth.model.epoch import on_epoch_change
+
+# user id -> (permission_version, time it was read)
+_permission_versions = LRUCache(ttl=None)
+on_epoch_change(_permission_versions.clear)
+
 
 def after_login_url():
     if settings.components.auth.after_login_url:
@@ -21,9 +31,106 @@ def load_session_user(user_obj):
     user.display_name = user_obj.name_or_login
     user.is_super_user = bool(user_obj.super_user)
     user.reset_required = user_obj.reset_required
+    user.permission_version = user_obj.permission_version
     user.is_authenticated = True
 
     # now permissions
-    for row in user_obj.permission_map:
-        if row['resulting_approval'] or user_obj.super_user:
-            user.add_perm(row['permission_name'])
+    if settings.components.auth.session_permissions == 'mask':
+        user.perms = SessionPermissions(user_obj.id)
+        return
+    for permission_name, approved in user_obj.permission_dict().items():
+        if approved:
+            user.add_perm(permission_name)
+
+
+def current_permission_version(uid):
+    """
+        returns the user's permission_version, read from the database at most
+        once every `session_version_ttl` seconds
+    """
+    from compstack.auth.model.orm import User
+    ttl = settings.components.auth.session_version_ttl
+    entry = _permission_versions.get(uid)
+    if entry is not None and ttl and time.time() - entry[1] < ttl:
+        return entry[0]
+    version = User.cm_permission_version(uid)
+    _permission_versions.set(uid, (version, time.time()))
+    return version
+
+
+def refresh_session_user():
+    """
+        Rebuilds the session user if their permission_version changed since
+        the session was loaded.  Users that were deleted or made inactive are
+        logged out.  Returns True when the session user was stale.
+    """
+    from compstack.auth.model.orm import User
+    version = current_permission_version(user.id)
+    if version is not None and version == user.get('permission_version'):
+        return False
+    user_obj = User.get(user.id) if version is not None else None
+    if user_obj is None or user_obj.inactive:
+        user.clear()
+    else:
+        load_session_user(user_obj)
+    return True
+
+
+class SessionPermissions(object):
+    """
+        Stands in for the session user's set of permission names.  Only the
+        mask of approved permissions (see model.engine.PermissionLayout) and
+        the key of the layout it was built with are stored in the session, the
+        names are resolved the first time they are needed in a request.  The
+        mask is rebuilt when permissions were added or deleted since.
+    """
+    def __init__(self, uid):
+        self.uid = uid
+        self.extra = set()
+        self.load_mask()
+
+    def load_mask(self):
+        from compstack.auth.model.orm import User
+        # read the key first: if the layout changes while the mask is built,
+        # the mask is rebuilt on its next use
+        self.layout_key = permission_registry.layout().key
+        self.mask = User.cm_permission_mask(self.uid)
+        self._names = None
+
+    @property
+    def names(self):
+        if self._names is None:
+            if self.layout_key != permission_registry.layout().key:
+                self.load_mask()
+            self._names = set(permission_registry.names_for_mask(self.mask)) | self.extra
+        return self._names
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def intersection(self, other):
+        return self.names.intersection(other)
+
+    def __ior__(self, other):
+        # used by SessionUser.add_perm()
+        self.extra |= set(other)
+        if self._names is not None:
+            self._names |= self.extra
+        return self
+
+    def __getstate__(self):
+        return {'uid': self.uid, 'mask': self.mask, 'layout_key': self.layout_key,
+                'extra': self.extra}
+
+    def __setstate__(self, state):
+        self.uid = state['uid']
+        self.mask = state['mask']
+        self.layout_key = state['layout_key']
+        self.extra = state['extra']
+        self._names = None
@@ -0,0 +1,268 @@
+"""
+    Cache backends for permission data (see UserMixin.cm_permission_dict()).
+
+    A backend stores values by key, returns None on a miss and keeps hit,
+    miss and eviction counters.  Backends are cleared whenever the auth epoch
+    changes, so cached values never outlive a change made through the model.
+"""
+from collections import OrderedDict
+import os
+import pickle
+import threading
+import time
+
+from blazeweb.globals import rg, settings
+from blazeweb.utils import registry_has_object
+import six
+
+from compstack.auth.model.epoch import on_epoch_change
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if six.PY2:
+    import anydbm as dbm  # noqa
+else:
+    import dbm
+
+
+def run_locked(lock, path, func):
+    """
+        Runs `func` holding the thread lock `lock` and, where fcntl is
+        available, an exclusive lock on the file `path` + ".lock" so other
+        processes using the same dbm file wait for it.
+    """
+    with lock:
+        if fcntl is None:
+            return func()
+        with open(path + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                return func()
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class CacheBackend(object):
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def expires_at(self):
+        if self.ttl is None:
+            return None
+        return time.time() + self.ttl
+
+    def is_expired(self, expires_at):
+        return expires_at is not None and expires_at < time.time()
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class LRUCache(CacheBackend):
+    """
+        In-process cache that evicts the least recently used entry once it
+        holds `max_size` entries and drops entries older than `ttl` seconds.
+    """
+    def __init__(self, max_size=10000, ttl=300):
+        CacheBackend.__init__(self, ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.is_expired(entry[0]):
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # move to the end, i.e. most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.expires_at(), value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DbmCache(CacheBackend):
+    """
+        Cache stored in a dbm file so worker processes on the same host can
+        share it.  Access is serialized with a lock file where fcntl is
+        available.  Entries are only dropped when they expire.
+    """
+    def __init__(self, path, ttl=300):
+        CacheBackend.__init__(self, ttl)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _open(self, flag):
+        return dbm.open(self.path, flag)
+
+    def _locked(self, func):
+        return run_locked(self._lock, self.path, func)
+
+    def _key(self, key):
+        return repr(key).encode('utf-8')
+
+    def get(self, key):
+        def get():
+            db = self._open('c')
+            try:
+                dbkey = self._key(key)
+                if dbkey not in db:
+                    return None
+                expires_at, value = pickle.loads(db[dbkey])
+                if self.is_expired(expires_at):
+                    del db[dbkey]
+                    self.evictions += 1
+                    return None
+                return value
+            finally:
+                db.close()
+        value = self._locked(get)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        def set():
+            db = self._open('c')
+            try:
+                db[self._key(key)] = pickle.dumps((self.expires_at(), value))
+            finally:
+                db.close()
+        self._locked(set)
+
+    def delete(self, key):
+        def delete():
+            db = self._open('c')
+            try:
+                dbkey = self._key(key)
+                if dbkey in db:
+                    del db[dbkey]
+            finally:
+                db.close()
+        self._locked(delete)
+
+    def clear(self):
+        self._locked(lambda: self._open('n').close())
+
+
+def create_backend(config):
+    """
+        Creates the backend described by the `permission_cache` settings.
+        `backend` can be 'memory', 'dbm', None (no caching) or a callable that
+        is given the settings and returns a CacheBackend.
+    """
+    if config.backend is None:
+        return None
+    if callable(config.backend):
+        return config.backend(config)
+    if config.backend == 'memory':
+        return LRUCache(max_size=config.max_size, ttl=config.ttl)
+    if config.backend == 'dbm':
+        path = config.dbm_path or os.path.join(settings.dirs.data, 'auth_permission_cache')
+        return DbmCache(path, ttl=config.ttl)
+    raise ValueError('unknown permission cache backend: %r' % (config.backend,))
+
+
+class _CacheHolder(object):
+    def __init__(self):
+        self.backend = None
+        self.created = False
+        self.lock = threading.Lock()
+
+
+_holder = _CacheHolder()
+
+
+def permission_cache():
+    """
+        The configured cache backend for permission dicts or None when caching
+        is turned off.
+    """
+    if not _holder.created:
+        with _holder.lock:
+            if not _holder.created:
+                _holder.backend = create_backend(settings.components.auth.permission_cache)
+                _holder.created = True
+    return _holder.backend
+
+
+def reset_permission_cache():
+    """
+        Forget the current backend so the next permission_cache() call creates
+        a new one from the settings.
+    """
+    _holder.backend = None
+    _holder.created = False
+
+
+@on_epoch_change
+def clear_permission_cache():
+    if _holder.backend is not None:
+        _holder.backend.clear()
+
+
+def request_memo():
+    """
+        A dict for memoizing permission data during the current request, None
+        when there is no request.
+    """
+    if not registry_has_object(rg):
+        return None
+    try:
+        return rg.auth_memo
+    except AttributeError:
+        rg.auth_memo = {}
+        return rg.auth_memo
+
+
+@on_epoch_change
+def clear_request_memo():
+    # writes committed during the request must be visible to the rest of it
+    memo = request_memo()
+    if memo:
+        memo.clear()
@@ -0,0 +1,250 @@
+"""
+    Password hashers (see the `password_hasher` settings).
+
+    A hasher turns a password and salt into an encoded string that starts
+    with its algorithm and work factors, e.g. "pbkdf2_sha256$100000$<hex>", so
+    hashes made with older settings (or by another hasher) can still be
+    verified and are recognized as needing an update.  Hashes without a
+    prefix are the single round of sha512 used before 0.3.3.
+
+    Verification can run in a bounded thread pool (the `password_verify`
+    settings), so that a burst of logins waits for a few hashing threads
+    rather than tying up every request thread.
+"""
+import binascii
+import hashlib
+import hmac
+import threading
+import time
+
+from blazeweb.globals import settings
+import six
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+class PasswordVerifyBusy(Exception):
+    """
+        Raised when the verification pool has `max_pending` passwords waiting
+    """
+
+
+def _to_bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+class PasswordHasher(object):
+    algorithm = None
+
+    def params(self):
+        """
+            the work factors, as they are encoded in the hash
+        """
+        return ()
+
+    def digest(self, password, salt):
+        raise NotImplementedError
+
+    def encode(self, password, salt):
+        digest = self.digest(_to_bytes(password), _to_bytes(salt))
+        return '$'.join([self.algorithm] + [str(p) for p in self.params()] + [digest])
+
+    def verify(self, password, salt, encoded):
+        return hmac.compare_digest(self.encode(password, salt), str(encoded))
+
+    def needs_update(self, encoded):
+        """
+            True when `encoded` wasn't made by this hasher with its current
+            work factors
+        """
+        return not str(encoded).startswith(
+            '$'.join([self.algorithm] + [str(p) for p in self.params()]) + '$'
+        )
+
+
+class SHA512Hasher(PasswordHasher):
+    """
+        The single round of sha512 that was the only option before 0.3.3.
+        Kept to verify existing hashes, too fast to be used for new ones.
+    """
+    algorithm = 'sha512'
+
+    def digest(self, password, salt):
+        return hashlib.sha512(password + salt).hexdigest()
+
+    def encode(self, password, salt):
+        # stored without a prefix
+        return self.digest(_to_bytes(password), _to_bytes(salt))
+
+    def needs_update(self, encoded):
+        return '$' in str(encoded)
+
+
+class PBKDF2Hasher(PasswordHasher):
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=100000):
+        self.iterations = int(iterations)
+
+    def params(self):
+        return (self.iterations,)
+
+    def digest(self, password, salt):
+        return binascii.hexlify(
+            hashlib.pbkdf2_hmac('sha256', password, salt, self.iterations)
+        ).decode('ascii')
+
+
+class ScryptHasher(PasswordHasher):
+    """
+        hashlib.scrypt, available on Python 3.6+ built with OpenSSL 1.1+
+    """
+    algorithm = 'scrypt'
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        if not hasattr(hashlib, 'scrypt'):
+            raise ValueError('hashlib.scrypt is not available on this Python')
+        self.n = int(n)
+        self.r = int(r)
+        self.p = int(p)
+
+    def params(self):
+        return (self.n, self.r, self.p)
+
+    def digest(self, password, salt):
+        # scrypt needs 128 * n * r bytes, leave room above the default limit
+        maxmem = 128 * self.n * self.r * (self.p + 1) + 2 ** 20
+        return binascii.hexlify(
+            hashlib.scrypt(password, salt=salt, n=self.n, r=self.r, p=self.p, maxmem=maxmem,
+                           dklen=32)
+        ).decode('ascii')
+
+
+def create_hasher(config):
+    """
+        Creates the hasher described by the `password_hasher` settings.
+        `name` can be 'pbkdf2', 'scrypt', 'sha512' or a callable that is given
+        the settings and returns a PasswordHasher.
+    """
+    if callable(config.name):
+        return config.name(config)
+    if config.name == 'pbkdf2':
+        return PBKDF2Hasher(config.iterations)
+    if config.name == 'scrypt':
+        return ScryptHasher(config.n, config.r, config.p)
+    if config.name == 'sha512':
+        return SHA512Hasher()
+    raise ValueError('unknown password hasher: %r' % (config.name,))
+
+
+def password_hasher():
+    """
+        The hasher for new password hashes.  Created from the settings on each
+        call, which is cheap next to hashing.
+    """
+    return create_hasher(settings.components.auth.password_hasher)
+
+
+def identify_hasher(encoded):
+    """
+        A hasher that can verify `encoded`, with the work factors it was made
+        with
+    """
+    parts = str(encoded).split('$')
+    if len(parts) == 1:
+        return SHA512Hasher()
+    if parts[0] == PBKDF2Hasher.algorithm and len(parts) == 3:
+        return PBKDF2Hasher(parts[1])
+    if parts[0] == ScryptHasher.algorithm and len(parts) == 5:
+        return ScryptHasher(*parts[1:4])
+    configured = password_hasher()
+    if parts[0] == configured.algorithm:
+        return configured
+    raise ValueError('unknown password hash algorithm: %s' % parts[0])
+
+
+class _VerifyPool(object):
+    def __init__(self):
+        self.executor = None
+        self.workers = None
+        self.slots = None
+        self.lock = threading.Lock()
+
+    def get(self, workers, max_pending):
+        if self.workers != workers:
+            with self.lock:
+                if self.workers != workers:
+                    if ThreadPoolExecutor is None:
+                        raise ValueError('password_verify.workers needs concurrent.futures')
+                    if self.executor is not None:
+                        self.executor.shutdown(wait=False)
+                    self.executor = ThreadPoolExecutor(max_workers=workers)
+                    self.slots = threading.BoundedSemaphore(workers + max_pending)
+                    self.workers = workers
+        return self.executor, self.slots
+
+
+_pool = _VerifyPool()
+
+
+def verify_password(password, salt, encoded):
+    """
+        Checks `password` against `encoded` with the hasher that made it.  Runs
+        in the verification pool when `password_verify.workers` is set and
+        raises PasswordVerifyBusy when the pool is full.
+    """
+    hasher = identify_hasher(encoded)
+    config = settings.components.auth.password_verify
+    if not config.workers:
+        return hasher.verify(password, salt, encoded)
+    executor, slots = _pool.get(config.workers, config.max_pending)
+    if not slots.acquire(False):
+        raise PasswordVerifyBusy()
+    try:
+        return executor.submit(hasher.verify, password, salt, encoded).result()
+    finally:
+        slots.release()
+
+
+def calibrate(hasher_factory, target_seconds, start, grow, limit=None):
+    """
+        Increases the work factor from `start` with `grow` until hashing with
+        `hasher_factory(factor)` takes at least `target_seconds` on one core.
+        Returns (factor, seconds).
+    """
+    factor = start
+    while True:
+        hasher = hasher_factory(factor)
+        started = time.time()
+        hasher.encode('calibration password', 'calibration salt')
+        seconds = time.time() - started
+        next_factor = grow(factor, seconds, target_seconds)
+        if seconds >= target_seconds or next_factor <= factor or \
+                (limit is not None and next_factor > limit):
+            return factor, seconds
+        factor = next_factor
+
+
+def calibrate_hasher(name, target_seconds):
+    """
+        A hasher of the given kind ('pbkdf2' or 'scrypt') whose work factor
+        makes one hash take about `target_seconds` on one core of this host,
+        and the seconds a hash took.
+    """
+    if name == 'pbkdf2':
+        factor, seconds = calibrate(
+            PBKDF2Hasher, target_seconds, 10000,
+            lambda f, s, t: max(f + 1000, int(f * t * 1.05 / max(s, 0.0001)))
+        )
+        return PBKDF2Hasher(factor), seconds
+    if name == 'scrypt':
+        factor, seconds = calibrate(
+            ScryptHasher, target_seconds, 2 ** 12, lambda f, s, t: f * 2, limit=2 ** 22
+        )
+        return ScryptHasher(factor), seconds
+    raise ValueError('can only calibrate pbkdf2 and scrypt, not %r' % (name,))
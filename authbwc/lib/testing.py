@@ -1,5 +1,5 @@
 import paste.fixture
-from blazeutils import tolist, randchars
+from blazeutils import randchars
 from blazeweb.testing import Client
 from werkzeug.test import Client as WerkzeugClient
 from werkzeug.wrappers import BaseRequest
@@ -65,21 +65,11 @@ def login_client_as_user(client, username, password, validate_login_response=Tru
 
 
 def create_user_with_permissions(approved_perms=None, denied_perms=None, super_user=False):
-    from compstack.auth.model.orm import User, Permission
-
-    appr_perm_ids = []
-    denied_perm_ids = []
-    # create the permissions
-    for perm in tolist(approved_perms):
-        p = Permission.get_by(name=perm)
-        if p is None:
-            raise ValueError('permission %s does not exist' % perm)
-        appr_perm_ids.append(p.id)
-    for perm in tolist(denied_perms):
-        p = Permission.get_by(name=perm)
-        if p is None:
-            raise ValueError('permission %s does not exist' % perm)
-        denied_perm_ids.append(p.id)
+    from compstack.auth.model.engine import permission_registry
+    from compstack.auth.model.orm import User
+
+    appr_perm_ids = permission_registry.ids_for_names(approved_perms)
+    denied_perm_ids = permission_registry.ids_for_names(denied_perms)
 
     # create the user
     username = u'user_for_testing_%s' % randchars(15)
@@ -0,0 +1,180 @@
+"""
+    Login throttling (see the `login_throttle` settings).
+
+    Failed logins are counted per login id and per remote IP address over a
+    sliding window.  Once either count reaches its limit, further attempts
+    for that login id or from that address are turned away before the user
+    is looked up or a password is hashed, until old failures leave the window.
+
+    A store keeps the failure times by key.  MemoryWindowStore is per process
+    and holds at most `max_keys` keys, each with at most `limit` times.
+    DbmWindowStore keeps them in a dbm file shared by the processes on a host.
+"""
+from collections import deque, OrderedDict
+import os
+import pickle
+import threading
+import time
+
+from blazeweb.globals import settings
+
+from compstack.auth.lib.cache import dbm, run_locked
+
+
+class MemoryWindowStore(object):
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _prune(self, times, now, window):
+        while times and times[0] <= now - window:
+            times.popleft()
+
+    def count(self, key, window, now):
+        with self._lock:
+            times = self._entries.get(key)
+            if times is None:
+                return 0
+            self._prune(times, now, window)
+            if not times:
+                del self._entries[key]
+            return len(times)
+
+    def add(self, key, window, limit, now):
+        with self._lock:
+            times = self._entries.pop(key, None)
+            if times is None:
+                # only the last `limit` failures can matter
+                times = deque(maxlen=limit)
+            self._prune(times, now, window)
+            times.append(now)
+            # most recently used last
+            self._entries[key] = times
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def clear(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DbmWindowStore(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _update(self, key, func):
+        def update():
+            db = dbm.open(self.path, 'c')
+            try:
+                dbkey = repr(key).encode('utf-8')
+                times = pickle.loads(db[dbkey]) if dbkey in db else []
+                times, retval = func(times)
+                if times:
+                    db[dbkey] = pickle.dumps(times)
+                elif dbkey in db:
+                    del db[dbkey]
+                return retval
+            finally:
+                db.close()
+        return run_locked(self._lock, self.path, update)
+
+    def count(self, key, window, now):
+        def count(times):
+            times = [t for t in times if t > now - window]
+            return times, len(times)
+        return self._update(key, count)
+
+    def add(self, key, window, limit, now):
+        def add(times):
+            times = [t for t in times if t > now - window] + [now]
+            return times[-limit:], None
+        self._update(key, add)
+
+    def clear(self, key):
+        self._update(key, lambda times: ([], None))
+
+
+class LoginThrottle(object):
+    def __init__(self, store, window=300, per_login=10, per_ip=None):
+        self.store = store
+        self.window = window
+        self.per_login = per_login
+        self.per_ip = per_ip
+
+    def _limits(self, login_id, remote_ip):
+        limits = []
+        if self.per_login and login_id:
+            limits.append((('login', login_id.lower()), self.per_login))
+        if self.per_ip and remote_ip:
+            limits.append((('ip', remote_ip), self.per_ip))
+        return limits
+
+    def is_throttled(self, login_id, remote_ip):
+        now = time.time()
+        return any(
+            self.store.count(key, self.window, now) >= limit
+            for key, limit in self._limits(login_id, remote_ip)
+        )
+
+    def record_failure(self, login_id, remote_ip):
+        now = time.time()
+        for key, limit in self._limits(login_id, remote_ip):
+            self.store.add(key, self.window, limit, now)
+
+    def record_success(self, login_id):
+        if login_id:
+            self.store.clear(('login', login_id.lower()))
+
+
+def create_throttle(config):
+    """
+        Creates the throttle described by the `login_throttle` settings.
+        `backend` can be 'memory', 'dbm', None (no throttling) or a callable
+        that is given the settings and returns a store.
+    """
+    if config.backend is None:
+        return None
+    if callable(config.backend):
+        store = config.backend(config)
+    elif config.backend == 'memory':
+        store = MemoryWindowStore(config.max_keys)
+    elif config.backend == 'dbm':
+        store = DbmWindowStore(
+            config.dbm_path or os.path.join(settings.dirs.data, 'auth_login_throttle')
+        )
+    else:
+        raise ValueError('unknown login throttle backend: %r' % (config.backend,))
+    return LoginThrottle(store, config.window, config.per_login, config.per_ip)
+
+
+class _ThrottleHolder(object):
+    def __init__(self):
+        self.throttle = None
+        self.created = False
+        self.lock = threading.Lock()
+
+
+_holder = _ThrottleHolder()
+
+
+def login_throttle():
+    """
+        The configured LoginThrottle or None when throttling is turned off
+    """
+    if not _holder.created:
+        with _holder.lock:
+            if not _holder.created:
+                _holder.throttle = create_throttle(settings.components.auth.login_throttle)
+                _holder.created = True
+    return _holder.throttle
+
+
+def reset_login_throttle():
+    """
+        Forget the current throttle so the next login_throttle() call creates
+        a new one from the settings.
+    """
+    _holder.throttle = None
+    _holder.created = False
@@ -1,5 +1,5 @@
+from collections import namedtuple
 from datetime import datetime
-from hashlib import sha512
 
 from blazeutils.helpers import tolist
 from blazeutils.strings import randchars
@@ -11,12 +11,118 @@ from sqlalchemy.ext.hybrid import hybrid_property
 import sqlalchemy.orm as saorm
 import sqlalchemy.sql as sasql
 
+from compstack.auth.lib.cache import permission_cache, request_memo
+from compstack.auth.lib.hashers import password_hasher, verify_password
+from compstack.auth.model.engine import engine_enabled, mask_for_ids, permission_index, \
+    permission_registry, refresh_effective_permissions, table_enabled
+from compstack.auth.model.epoch import bump_auth_epoch
+from compstack.auth.model.nesting import nested_groups_enabled, remove_group_nesting, \
+    set_group_parents
+from compstack.auth.model.signals import record_permission_change
 from compstack.sqlalchemy import db
 from compstack.sqlalchemy.lib.columns import SmallIntBool
 from compstack.sqlalchemy.lib.declarative import DefaultMixin
 from compstack.sqlalchemy.lib.decorators import transaction, transaction_ncm
 
 
+class PermissionChanges(namedtuple('PermissionChanges', 'inserted updated deleted')):
+    """
+        The permission ids whose assignment rows were inserted, had their
+        approved flag flipped, or were deleted by an assignment write
+    """
+    @property
+    def permission_ids(self):
+        return set(self.inserted) | set(self.updated) | set(self.deleted)
+
+    def merge(self, other):
+        return PermissionChanges(
+            self.inserted + other.inserted,
+            self.updated + other.updated,
+            self.deleted + other.deleted,
+        )
+
+
+def _current_assignments(table, owner_column, owner_id):
+    return dict(db.sess.execute(sasql.select(
+        [table.c.permission_id, table.c.approved], table.c[owner_column] == owner_id
+    )).fetchall())
+
+
+def _write_assignments(table, owner_column, owner_id, current, target):
+    """
+        Makes the assignment rows in `table` for `owner_id` match `target`, a
+        dict of permission id -> approved (1 or -1), with the fewest deletes,
+        updates and inserts.  `current` is the same kind of dict for the rows
+        as they are.
+    """
+    owner_clause = table.c[owner_column] == owner_id
+    inserted = sorted(pid for pid in target if pid not in current)
+    updated = sorted(pid for pid in target if pid in current and current[pid] != target[pid])
+    deleted = sorted(pid for pid in current if pid not in target)
+
+    if deleted:
+        db.sess.execute(table.delete(
+            sasql.and_(owner_clause, table.c.permission_id.in_(deleted))
+        ))
+    for approved in (1, -1):
+        flipped = [pid for pid in updated if target[pid] == approved]
+        if flipped:
+            db.sess.execute(table.update(
+                sasql.and_(owner_clause, table.c.permission_id.in_(flipped))
+            ).values(approved=approved))
+    if inserted:
+        db.sess.execute(table.insert(), [
+            {owner_column: owner_id, 'permission_id': pid, 'approved': target[pid]}
+            for pid in inserted
+        ])
+    return PermissionChanges(inserted, updated, deleted)
+
+
+def _bulk_write_assignments(table, owner_column, owner_cls, owner_ids, perm_ids, approved):
+    """
+        Sets the assignment of each permission in `perm_ids` for each owner in
+        `owner_ids` to `approved` (1 or -1), or deletes it when `approved` is
+        None.  Uses at most one UPDATE and one INSERT ... SELECT.  Returns the
+        number of rows written.
+    """
+    from compstack.auth.model.orm import Permission
+    owner_clause = table.c[owner_column].in_(owner_ids)
+    perm_clause = table.c.permission_id.in_(perm_ids)
+    if approved is None:
+        return db.sess.execute(table.delete(sasql.and_(owner_clause, perm_clause))).rowcount
+
+    written = db.sess.execute(
+        table.update(sasql.and_(owner_clause, perm_clause, table.c.approved != approved))
+        .values(approved=approved)
+    ).rowcount
+    assigned = sasql.exists().where(sasql.and_(
+        table.c[owner_column] == owner_cls.id,
+        table.c.permission_id == Permission.id
+    ))
+    missing = sasql.select([owner_cls.id, Permission.id, sasql.literal(approved)]).where(
+        sasql.and_(owner_cls.id.in_(owner_ids), Permission.id.in_(perm_ids), ~assigned)
+    )
+    written += db.sess.execute(
+        table.insert().from_select([owner_column, 'permission_id', 'approved'], missing)
+    ).rowcount
+    return written
+
+
+def resulting_approval(user_approved, group_approved, group_denied):
+    """
+        Whether a permission is approved given the user's assignment and the
+        sums of the group approvals and denials (0 when there are none): a user
+        level assignment wins, then a group denial, then a group approval.
+    """
+    if user_approved == -1:
+        return False
+    if user_approved == 1:
+        return True
+    if group_denied <= -1:
+        return False
+    return group_approved >= 1
+
+
 class AuthRelationsMixin(object):
     """
         This mixin provides methods and properties for a user-like entity
@@ -27,26 +133,31 @@ class AuthRelationsMixin(object):
         return saorm.relationship('Group', secondary='auth_user_group_map')
 
     def set_permissions(self, perm_ids, approved=True):
+        """
+            Makes `perm_ids` the permissions approved (or denied) for this
+            user.  Only the rows that differ are written.  Returns a
+            PermissionChanges.
+        """
         from compstack.auth.model.metadata import user_permission_assignments as tbl_upa
         approved = 1 if approved else -1
 
-        perm_ids = perm_ids or []
-        condition = tbl_upa.c.approved == approved
-        if perm_ids:
-            condition = sasql.or_(
-                condition,
-                tbl_upa.c.permission_id.in_(perm_ids)
-            )
+        current = _current_assignments(tbl_upa, 'user_id', self.id)
+        # assignments of the other kind are kept unless given in perm_ids
+        target = dict((pid, value) for pid, value in current.items() if value != approved)
+        # ids posted from forms can be strings
+        target.update((int(pid), approved) for pid in perm_ids or [])
 
-        # delete existing permission assignments for this user (i.e. we start over)
-        db.sess.execute(tbl_upa.delete(sasql.and_(tbl_upa.c.user_id == self.id, condition)))
-        insval = [{'user_id': self.id, 'permission_id': p, 'approved': approved} for p in perm_ids]
-        if insval:
-            db.sess.execute(tbl_upa.insert(), insval)
+        changes = _write_assignments(tbl_upa, 'user_id', self.id, current, target)
+        if changes.permission_ids:
+            refresh_effective_permissions([self.id], changes.permission_ids)
+            self.__class__.cm_bump_permission_version([self.id])
+            record_permission_change(user_ids=[self.id], permission_ids=changes.permission_ids)
+            bump_auth_epoch()
+        return changes
 
     def assign_permissions(self, approved_perm_ids, denied_perm_ids):
-        self.set_permissions(approved_perm_ids, True)
-        self.set_permissions(denied_perm_ids, False)
+        changes = self.set_permissions(approved_perm_ids, True)
+        return changes.merge(self.set_permissions(denied_perm_ids, False))
 
     @property
     def group_ids(self):
@@ -70,46 +181,116 @@ class AuthRelationsMixin(object):
         return approved, denied
 
     @classmethod
-    def get_by_permissions(cls, permissions):
-        from compstack.auth.model.queries import query_users_permissions
-        vuserperms = query_users_permissions().alias()
-        return db.sess.query(cls).select_from(
-            saorm.join(cls, vuserperms, cls.id == vuserperms.c.user_id)
-        ).filter(
-            sasql.or_(
-                vuserperms.c.user_approved == 1,
-                sasql.and_(
-                    vuserperms.c.user_approved.is_(None),
-                    sasql.or_(
-                        vuserperms.c.group_denied.is_(None),
-                        vuserperms.c.group_denied >= 0,
-                    ),
-                    vuserperms.c.group_approved >= 1
-                )
-            )
-        ).filter(
-            vuserperms.c.permission_name.in_(tolist(permissions))
-        ).all()
+    def get_by_permissions(cls, permissions, match='any', ids_only=False, stream=False,
+                           chunk_size=1000):
+        """
+            Returns the users approved for the given permission names, ordered
+            by id.  Super user status is not taken into account.
+
+            kwargs:
+                match: 'any' for users approved for at least one of the
+                    permissions, 'all' for users approved for every one of them;
+                    default: 'any'
+                ids_only: return user ids instead of instances; default: False
+                stream: return an iterator that fetches `chunk_size` rows at a
+                    time instead of a list; default: False
+        """
+        if match not in ('any', 'all'):
+            raise ValueError('match must be "any" or "all", not %r' % match)
+        if engine_enabled():
+            user_ids = permission_index.user_ids_with_permissions(permissions, match=match)
+            if ids_only:
+                result = iter(user_ids)
+            else:
+                result = cls._iter_by_ids(user_ids, chunk_size)
+        elif ids_only:
+            result = (row[0] for row in
+                      cls._query_ids_by_permissions(permissions, match, stream=stream))
+        else:
+            # one query, the users are loaded as the rows are read
+            query = db.sess.query(cls).filter(
+                cls.permissions_clause(permissions, match)
+            ).order_by(cls.id)
+            if stream:
+                query = query.yield_per(chunk_size)
+            result = iter(query)
+        return result if stream else list(result)
+
+    @classmethod
+    def _query_ids_by_permissions(cls, permissions, match, stream=False):
+        from compstack.auth.model.queries import cached_statement, execute_cached
+        perm_ids = cls._permission_ids_for(permissions, match)
+        if not perm_ids:
+            return []
+        if match == 'all':
+            binds = [sasql.bindparam('pid_%d' % i) for i in range(len(perm_ids))]
+            params = dict(('pid_%d' % i, pid) for i, pid in enumerate(perm_ids))
+        else:
+            binds = sasql.bindparam('permission_ids', expanding=True)
+            params = {'permission_ids': perm_ids}
+
+        def build():
+            return sasql.select([cls.id]).where(
+                cls._approved_clause(binds, match)
+            ).order_by(cls.id)
+        key = ('users_by_permissions', cls, match, len(perm_ids) if match == 'all' else None,
+               table_enabled())
+        return execute_cached(cached_statement(key, build), params, stream=stream)
+
+    @classmethod
+    def _iter_by_ids(cls, user_ids, chunk_size):
+        from compstack.auth.helpers import chunked
+        for chunk in chunked(user_ids, chunk_size):
+            for u in db.sess.query(cls).filter(cls.id.in_(chunk)).order_by(cls.id):
+                yield u
+
+    @classmethod
+    def permissions_clause(cls, permissions, match='any'):
+        """
+            Filter for a query over this class that keeps the users approved for
+            any (or all) of the given permission names, built from semi-joins
+            against the assignment tables (or auth_effective_permissions).
+        """
+        perm_ids = cls._permission_ids_for(permissions, match)
+        if not perm_ids:
+            return sasql.false()
+        return cls._approved_clause(perm_ids, match)
+
+    @classmethod
+    def _permission_ids_for(cls, permissions, match):
+        """
+            the ids of the given permission names, empty when no user can match
+        """
+        from compstack.auth.model.orm import Permission
+        names = set(tolist(permissions))
+        perm_ids = [r[0] for r in db.sess.query(Permission.id).filter(Permission.name.in_(names))]
+        if match == 'all' and len(perm_ids) != len(names):
+            return []
+        return perm_ids
+
+    @classmethod
+    def _approved_clause(cls, perm_ids, match):
+        from compstack.auth.model.metadata import effective_permissions as tbl_ep
+        from compstack.auth.model.queries import users_approved_clause
+        if not table_enabled():
+            return users_approved_clause(cls.id, perm_ids, match)
+        if match == 'all':
+            return sasql.and_(*[
+                sasql.exists().where(sasql.and_(
+                    tbl_ep.c.user_id == cls.id,
+                    tbl_ep.c.permission_id == pid
+                ))
+                for pid in perm_ids
+            ])
+        return sasql.exists().where(sasql.and_(
+            tbl_ep.c.user_id == cls.id,
+            tbl_ep.c.permission_id.in_(perm_ids)
+        ))
 
     @classmethod
     def cm_permission_map(cls, uid):
-        from compstack.auth.model.queries import query_users_permissions
-        user_perm = query_users_permissions().alias()
-        s = sasql.select(
-            [
-                user_perm.c.user_id.label('user_id'),
-                user_perm.c.permission_id.label('permission_id'),
-                user_perm.c.permission_name.label('permission_name'),
-                user_perm.c.login_id.label('login_id'),
-                user_perm.c.user_approved.label('user_approved'),
-                user_perm.c.group_approved.label('group_approved'),
-                user_perm.c.group_denied.label('group_denied'),
-            ],
-            from_obj=user_perm
-        ).where(
-            user_perm.c.user_id == uid
-        )
-        results = db.sess.execute(s)
+        from compstack.auth.model.queries import execute_cached, permission_map_statement
+        results = execute_cached(permission_map_statement(), {'uid': uid})
         retval = []
         for row in results:
             nrow = {}
@@ -119,18 +300,9 @@ class AuthRelationsMixin(object):
                 else:
                     nrow[key] = value
 
-            if nrow['user_approved'] == -1:
-                approved = False
-            elif nrow['user_approved'] == 1:
-                approved = True
-            elif nrow['group_denied'] <= -1:
-                approved = False
-            elif nrow['group_approved'] >= 1:
-                approved = True
-            else:
-                approved = False
-
-            nrow[u'resulting_approval'] = approved
+            nrow[u'resulting_approval'] = resulting_approval(
+                nrow['user_approved'], nrow['group_approved'], nrow['group_denied']
+            )
             retval.append(nrow)
         return retval
 
@@ -138,20 +310,69 @@ class AuthRelationsMixin(object):
     def permission_map(self):
         return self.__class__.cm_permission_map(self.id)
 
+    @classmethod
+    def cm_permission_explanation(cls, uid):
+        """
+            Like cm_permission_map(), but each row also lists the groups behind
+            the group approvals and denials (as dicts with id and name) in
+            `approved_groups` and `denied_groups`.  Takes a single query.
+        """
+        from compstack.auth.model.queries import execute_cached, \
+            permission_explanation_statement
+        results = execute_cached(permission_explanation_statement(), {'uid': uid})
+        retval = []
+        for row in results:
+            if not retval or retval[-1]['permission_id'] != row['permission_id']:
+                retval.append({
+                    u'user_id': uid,
+                    u'permission_id': row['permission_id'],
+                    u'permission_name': row['permission_name'],
+                    u'user_approved': row['user_approved'] or 0,
+                    u'group_approved': 0,
+                    u'group_denied': 0,
+                    u'approved_groups': [],
+                    u'denied_groups': [],
+                })
+            nrow = retval[-1]
+            if row['group_id'] is None:
+                continue
+            group = {'id': row['group_id'], 'name': row['group_name']}
+            if row['group_approved'] <= -1:
+                nrow['group_denied'] += row['group_approved']
+                nrow['denied_groups'].append(group)
+            elif row['group_approved'] >= 1:
+                nrow['group_approved'] += row['group_approved']
+                nrow['approved_groups'].append(group)
+        for nrow in retval:
+            nrow[u'resulting_approval'] = resulting_approval(
+                nrow['user_approved'], nrow['group_approved'], nrow['group_denied']
+            )
+        return retval
+
+    @property
+    def permission_explanation(self):
+        return self.__class__.cm_permission_explanation(self.id)
+
+    @classmethod
+    def cm_permission_holders(cls, permission_id, after_id=0, limit=50):
+        """
+            One page of the users approved for a permission, as dicts with
+            user_id, login_id and source ('direct' or 'group'), ordered by user
+            id.  Pass the last user_id of a page as `after_id` to get the next
+            one.
+        """
+        from compstack.auth.model.queries import execute_cached, permission_holders_statement
+        results = execute_cached(
+            permission_holders_statement(),
+            {'permission_id': permission_id, 'after_id': after_id, 'limit': limit}
+        )
+        return [dict(row.items()) for row in results]
+
     @property
     def permission_map_groups(self):
-        from compstack.auth.model.queries import query_user_group_permissions
-        user_group_perm = query_user_group_permissions().alias()
-        s = sasql.select(
-            [
-                user_group_perm.c.permission_id,
-                user_group_perm.c.group_name,
-                user_group_perm.c.group_id,
-                user_group_perm.c.group_approved
-            ],
-            from_obj=user_group_perm
-        ).where(user_group_perm.c.user_id == self.id)
-        results = db.sess.execute(s)
+        from compstack.auth.model.queries import execute_cached, \
+            user_group_permissions_statement
+        results = execute_cached(user_group_permissions_statement(), {'uid': self.id})
         retval = {}
         for row in results:
             if not row['permission_id'] in retval:
@@ -183,6 +404,9 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
     inactive_date = sa.Column(sa.DateTime)
     pass_reset_ts = sa.Column(sa.DateTime)
     pass_reset_key = sa.Column(sa.String(12))
+    # bumped whenever something stored in the session user changes, see
+    # helpers.session.refresh_session_user()
+    permission_version = sa.Column(sa.Integer, nullable=False, server_default=sasql.text('0'))
 
     def __repr__(self):
         return '<User "%s" : %s>' % (self.login_id, self.email_address)
@@ -262,9 +486,7 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
     @classmethod
     def calc_pass_hash(cls, password, record_salt=None):
         full_salt, record_salt = cls.calc_salt(record_salt)
-        if isinstance(password, six.text_type):
-            password = password.encode()
-        return sha512(password + full_salt).hexdigest()
+        return password_hasher().encode(password, full_salt)
 
     @classmethod
     def validate(cls, login_id, password):
@@ -275,10 +497,25 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
         if not u:
             return
         if u.validate_password(password):
+            if password_hasher().needs_update(u.pass_hash):
+                u.upgrade_pass_hash(password)
             return u
 
     def validate_password(self, password):
-        return self.pass_hash == self.calc_pass_hash(password, self.pass_salt)
+        """
+            Checks the password with the hasher that made pass_hash.  Can raise
+            lib.hashers.PasswordVerifyBusy, see the password_verify settings.
+        """
+        full_salt, _ = self.calc_salt(self.pass_salt)
+        return verify_password(password, full_salt, self.pass_hash)
+
+    @transaction_ncm
+    def upgrade_pass_hash(self, password):
+        """
+            rehashes a verified password with the configured hasher, keeping
+            the salt
+        """
+        self.pass_hash = self.calc_pass_hash(password, self.pass_salt)
 
     @transaction
     def add(cls, **kwargs):
@@ -320,15 +557,91 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
             except AttributeError:
                 pass
 
+        changed_group_ids = set()
         if 'assigned_groups' in kwargs:
+            # groups the user leaves change as well as the ones they join
+            changed_group_ids.update(g.id for g in u.groups)
             u.groups = [Group.get(gid) for gid in tolist(kwargs['assigned_groups'])]
+            changed_group_ids.update(g.id for g in u.groups)
         db.sess.flush()
+        if 'assigned_groups' in kwargs:
+            refresh_effective_permissions([u.id])
         if 'approved_permissions' in kwargs:
             u.set_permissions(kwargs['approved_permissions'], True)
         if 'denied_permissions' in kwargs:
             u.set_permissions(kwargs['denied_permissions'], False)
+        if oid is not None:
+            cls.cm_bump_permission_version([u.id])
+        record_permission_change(user_ids=[u.id], group_ids=changed_group_ids)
+        bump_auth_epoch()
         return u
 
+    @transaction
+    def bulk_grant(cls, user_ids, perm_ids, chunk_size=500):
+        """
+            Approves the permissions in `perm_ids` for every user in
+            `user_ids`, leaving their other assignments alone.  Returns the
+            number of assignment rows written.
+        """
+        return cls.cm_bulk_write_permissions(user_ids, perm_ids, 1, chunk_size)
+
+    @transaction
+    def bulk_deny(cls, user_ids, perm_ids, chunk_size=500):
+        """
+            like bulk_grant() but denies the permissions
+        """
+        return cls.cm_bulk_write_permissions(user_ids, perm_ids, -1, chunk_size)
+
+    @transaction
+    def bulk_revoke(cls, user_ids, perm_ids, chunk_size=500):
+        """
+            like bulk_grant() but removes the users' assignments for the
+            permissions
+        """
+        return cls.cm_bulk_write_permissions(user_ids, perm_ids, None, chunk_size)
+
+    @classmethod
+    def cm_bulk_write_permissions(cls, user_ids, perm_ids, approved, chunk_size=500):
+        from compstack.auth.helpers import chunked
+        from compstack.auth.model.metadata import user_permission_assignments as tbl_upa
+        perm_ids = [int(pid) for pid in tolist(perm_ids)]
+        if not perm_ids:
+            return 0
+        written = 0
+        for chunk in chunked(user_ids, chunk_size):
+            chunk_written = _bulk_write_assignments(
+                tbl_upa, 'user_id', cls, chunk, perm_ids, approved
+            )
+            if chunk_written:
+                refresh_effective_permissions(chunk, perm_ids)
+                cls.cm_bump_permission_version(chunk, chunk_size)
+                record_permission_change(user_ids=chunk, permission_ids=perm_ids)
+                written += chunk_written
+        if written:
+            bump_auth_epoch()
+        return written
+
+    @classmethod
+    def cm_bump_permission_version(cls, user_ids, chunk_size=500):
+        """
+            increments permission_version for the given users so that
+            sessions built before a change can be detected
+        """
+        from compstack.auth.helpers import chunked
+        for chunk in chunked(user_ids, chunk_size):
+            db.sess.query(cls).filter(cls.id.in_(chunk)).update(
+                {cls.permission_version: cls.permission_version + 1},
+                synchronize_session='fetch'
+            )
+
+    @classmethod
+    def cm_permission_version(cls, uid):
+        """
+            returns the permission_version of the user with the given user_id
+            `uid` or None if there is no such user
+        """
+        return db.sess.query(cls.permission_version).filter_by(id=uid).scalar()
+
     @transaction_ncm
     def update_password(self, password):
         self.password = password
@@ -369,16 +682,108 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
             kwargs:
                 `su_override`: if user is a super user, show all perms as approved;
                     default: True
+
+            Results are memoized for the current request and cached when the
+            `permission_cache` setting has a backend.
         """
-        retval = {}
-        user_is_super = False
+        # a copy, so callers can't change what is cached
+        return dict(cls._shared_permission_dict(uid, su_override))
+
+    @classmethod
+    def _shared_permission_dict(cls, uid, su_override=True):
+        """
+            cm_permission_dict() without the copy, for callers that only read it
+        """
+        memo = request_memo()
+        memo_key = ('permission_dict', uid, bool(su_override))
+        if memo is not None and memo_key in memo:
+            return memo[memo_key]
+
+        cache = permission_cache()
+        if cache is None:
+            retval = cls.cm_resolve_permission_dict(uid, su_override=su_override)
+        else:
+            key = (uid, bool(su_override))
+            retval = cache.get(key)
+            if retval is None:
+                retval = cls.cm_resolve_permission_dict(uid, su_override=su_override)
+                cache.set(key, retval)
+
+        if memo is not None:
+            memo[memo_key] = retval
+        return retval
+
+    @classmethod
+    def cm_is_super_user(cls, uid):
+        """
+            True if the user with the given user_id `uid` is a super user,
+            memoized for the current request
+        """
+        memo = request_memo()
+        memo_key = ('super_user', uid)
+        if memo is not None and memo_key in memo:
+            return memo[memo_key]
+        retval = bool(db.sess.query(cls.super_user).filter_by(id=uid).scalar())
+        if memo is not None:
+            memo[memo_key] = retval
+        return retval
+
+    @classmethod
+    def cm_resolve_permission_dict(cls, uid, su_override=True):
+        """
+            same as cm_permission_dict() without the cache
+        """
+        if engine_enabled():
+            return permission_index.permission_dict(uid, su_override=su_override)
         if su_override:
-            user_is_super = bool(db.sess.query(cls.super_user).filter_by(id=uid).scalar())
+            retval = cls.cm_super_user_permission_dict(uid)
+            if retval is not None:
+                return retval
+        if table_enabled():
+            return cls.cm_effective_permission_dict(uid, su_override=su_override)
+        retval = {}
         for pmap in cls.cm_permission_map(uid):
-            retval[pmap['permission_name']] = user_is_super or pmap['resulting_approval']
+            retval[pmap['permission_name']] = pmap['resulting_approval']
         return retval
-        u = cls.get(uid)
-        return u.permission_dict()
+
+    @classmethod
+    def cm_super_user_permission_dict(cls, uid):
+        """
+            returns a dict approving every permission if the user with the
+            given user_id `uid` is a super user, None otherwise.  The
+            super_user flag and the permission names come from one query, so
+            the permission map is never built for super users.
+        """
+        from compstack.auth.model.orm import Permission
+        memo = request_memo()
+        if memo is not None and memo.get(('super_user', uid)) is False:
+            return None
+        rows = db.sess.query(cls.super_user, Permission.name).select_from(cls).outerjoin(
+            Permission, cls.super_user == sa.true()
+        ).filter(cls.id == uid).all()
+        user_is_super = bool(rows and rows[0][0])
+        if memo is not None:
+            memo[('super_user', uid)] = user_is_super
+        if not user_is_super:
+            return None
+        return dict((name, True) for _, name in rows if name is not None)
+
+    @classmethod
+    def cm_effective_permission_dict(cls, uid, su_override=True):
+        """
+            same as cm_permission_dict() but read from auth_effective_permissions
+        """
+        from compstack.auth.model.metadata import effective_permissions as tbl_ep
+        from compstack.auth.model.orm import Permission
+        super_user = db.sess.query(cls.super_user).filter_by(id=uid).first()
+        if super_user is None:
+            return {}
+        user_is_super = su_override and bool(super_user[0])
+        rows = db.sess.query(Permission.name, tbl_ep.c.user_id).outerjoin(
+            tbl_ep,
+            sasql.and_(tbl_ep.c.permission_id == Permission.id, tbl_ep.c.user_id == uid)
+        )
+        return dict((name, user_is_super or euid is not None) for name, euid in rows)
 
     def permission_dict(self, su_override=True):
         """
@@ -386,6 +791,33 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
         """
         return self.__class__.cm_permission_dict(self.id, su_override=su_override)
 
+    @classmethod
+    def cm_permission_mask(cls, uid, su_override=True):
+        """
+            returns the approved permissions for the user with the given
+            user_id `uid` as an int with the bit for each permission set (see
+            engine.PermissionLayout)
+
+            kwargs:
+                `su_override`: if user is a super user, show all perms as approved;
+                    default: True
+        """
+        if engine_enabled():
+            return permission_index.permission_mask(uid, su_override=su_override)
+        if su_override and cls.cm_is_super_user(uid):
+            # every permission, without computing the permission map
+            return permission_registry.layout().full_mask
+        return mask_for_ids(
+            pmap['permission_id'] for pmap in cls.cm_permission_map(uid)
+            if pmap['resulting_approval']
+        )
+
+    def permission_mask(self, su_override=True):
+        """
+            same as cm_permission_mask() for the current instance
+        """
+        return self.__class__.cm_permission_mask(self.id, su_override=su_override)
+
     @classmethod
     def cm_has_permission(cls, uid, *perms, **kwargs):
         """
@@ -396,9 +828,18 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
                     default: True
         """
         su_override = kwargs.pop('su_override', True)
-        pdict = cls.cm_permission_dict(uid, su_override=su_override)
+        if engine_enabled():
+            return permission_index.has_permission(uid, perms, su_override=su_override)
+        pdict = cls._shared_permission_dict(uid, su_override=su_override)
         if not pdict:
             return False
+        memo = request_memo()
+        if memo is not None:
+            # the checks of a request share one mask, so each is a single AND
+            layout, mask = cls._memo_permission_mask(uid, su_override, pdict, memo)
+            required = layout.mask_for_names(perms)
+            # names the layout doesn't know aren't in pdict either
+            return required is not None and mask & required == required
         for pname in perms:
             if pname not in pdict:
                 return False
@@ -410,29 +851,91 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
         return self.__class__.cm_has_permission(self.id, *perms, **kwargs)
 
     @classmethod
-    def testing_create(cls, loginid=None, approved_perms=[], denied_perms=[],
-                       reset_required=False, groups=[]):
-        # use the hierarchy to find the Permission in case the app has changed
-        # it
+    def _memo_permission_mask(cls, uid, su_override, pdict, memo):
+        """
+            the (layout, mask) of the approved names in `pdict`, memoized for
+            the request.  The layout is kept with the mask so that a reload
+            of the registry during the request can't mix up the bits.
+        """
+        memo_key = ('permission_mask', uid, bool(su_override))
+        if memo_key not in memo:
+            layout = permission_registry.layout()
+            if any(name not in layout.ids for name in pdict):
+                layout = permission_registry.load()
+            mask = layout.mask_for_ids(
+                layout.ids[name] for name, approved in pdict.items()
+                if approved and name in layout.ids
+            )
+            memo[memo_key] = (layout, mask)
+        return memo[memo_key]
+
+    @classmethod
+    def cm_has_permission_many(cls, uids, *perms, **kwargs):
+        """
+            Like cm_has_permission() for many users at once.  Returns a
+            dictionary with each of the given user ids as the key and True if
+            that user has all permission names given as the value.
+
+            The users are resolved with one query per `chunk_size` user ids.
+
+            kwargs:
+                su_override: if user is a super user, show all perms as approved;
+                    default: True
+                chunk_size: how many user ids to resolve per query; default: 500
+        """
+        from compstack.auth.helpers import chunked
+        from compstack.auth.model.metadata import effective_permissions as tbl_ep
         from compstack.auth.model.orm import Permission
+        from compstack.auth.model.queries import query_approved_permission_counts
+        su_override = kwargs.pop('su_override', True)
+        chunk_size = kwargs.pop('chunk_size', 500)
+        if not perms:
+            raise ValueError('at least one permission name must be given')
+
+        uids = list(uids)
+        retval = dict((uid, False) for uid in uids)
+        if engine_enabled():
+            for uid in uids:
+                retval[uid] = permission_index.has_permission(uid, perms, su_override=su_override)
+            return retval
+
+        perm_ids = [
+            r[0] for r in db.sess.query(Permission.id).filter(Permission.name.in_(set(perms)))
+        ]
+        if len(perm_ids) != len(set(perms)):
+            # a permission that doesn't exist is never approved
+            return retval
+
+        for chunk in chunked(uids, chunk_size):
+            if table_enabled():
+                counts = sasql.select(
+                    [tbl_ep.c.user_id, sasql.func.count(tbl_ep.c.permission_id)],
+                    sasql.and_(
+                        tbl_ep.c.user_id.in_(chunk),
+                        tbl_ep.c.permission_id.in_(perm_ids)
+                    )
+                ).group_by(tbl_ep.c.user_id)
+            else:
+                counts = query_approved_permission_counts(chunk, perm_ids)
+            for uid, approved_count in db.sess.execute(counts):
+                retval[uid] = approved_count == len(perm_ids)
+            if su_override:
+                for (uid,) in db.sess.query(cls.id).filter(
+                    cls.id.in_(chunk),
+                    cls.super_user == sa.true()
+                ):
+                    retval[uid] = True
+        return retval
 
+    @classmethod
+    def testing_create(cls, loginid=None, approved_perms=[], denied_perms=[],
+                       reset_required=False, groups=[]):
         login_id = loginid or randchars()
         email_address = '%s@example.com' % login_id
         password = randchars(15)
 
-        appr_perm_ids = []
-        denied_perm_ids = []
-        # create the permissions
-        for perm in tolist(approved_perms):
-            p = Permission.get_by(name=perm)
-            if p is None:
-                raise ValueError('permission %s does not exist' % perm)
-            appr_perm_ids.append(p.id)
-        for perm in tolist(denied_perms):
-            p = Permission.get_by(name=perm)
-            if p is None:
-                raise ValueError('permission %s does not exist' % perm)
-            denied_perm_ids.append(p.id)
+        appr_perm_ids = permission_registry.ids_for_names(approved_perms)
+        denied_perm_ids = permission_registry.ids_for_names(denied_perms)
 
         u = cls.add(
             login_id=login_id,
@@ -450,6 +953,10 @@ class UserMixin(DefaultMixin, AuthRelationsMixin):
             super_user=False,
         )
         u.groups.extend(tolist(groups))
+        db.sess.flush()
+        refresh_effective_permissions([u.id])
+        record_permission_change([u.id], [g.id for g in u.groups])
+        bump_auth_epoch()
         db.sess.commit()
         u.text_password = password
         return u
@@ -465,6 +972,101 @@ class GroupMixin(DefaultMixin):
     def __repr__(self):
         return '<Group "%s">' % (self.name)
 
+    @classmethod
+    def cm_user_ids(cls, oid):
+        """
+            ids of the group's members, including the members of nested
+            groups when nested_groups is on
+        """
+        from compstack.auth.model.queries import query_group_user_ids
+        return [r[0] for r in db.sess.execute(query_group_user_ids([oid]))]
+
+    @classmethod
+    def cm_direct_user_ids(cls, group_ids):
+        """
+            ids of the users directly in any of the given groups
+        """
+        from compstack.auth.model.metadata import user_groups as tbl_ugm
+        group_ids = list(group_ids)
+        if not group_ids:
+            return []
+        return list(set(r[0] for r in db.sess.execute(sasql.select(
+            [tbl_ugm.c.auth_user_id], tbl_ugm.c.auth_group_id.in_(group_ids)
+        ))))
+
+    @property
+    def parent_group_ids(self):
+        from compstack.auth.model.metadata import group_groups as tbl_gg
+        return [r[0] for r in db.sess.execute(sasql.select(
+            [tbl_gg.c.parent_group_id], tbl_gg.c.child_group_id == self.id
+        ))]
+
+    @transaction
+    def bulk_grant(cls, group_ids, perm_ids, chunk_size=500):
+        """
+            Approves the permissions in `perm_ids` for every group in
+            `group_ids`, leaving their other assignments alone.  Returns the
+            number of assignment rows written.
+        """
+        return cls.cm_bulk_write_permissions(group_ids, perm_ids, 1, chunk_size)
+
+    @transaction
+    def bulk_deny(cls, group_ids, perm_ids, chunk_size=500):
+        """
+            like bulk_grant() but denies the permissions
+        """
+        return cls.cm_bulk_write_permissions(group_ids, perm_ids, -1, chunk_size)
+
+    @transaction
+    def bulk_revoke(cls, group_ids, perm_ids, chunk_size=500):
+        """
+            like bulk_grant() but removes the groups' assignments for the
+            permissions
+        """
+        return cls.cm_bulk_write_permissions(group_ids, perm_ids, None, chunk_size)
+
+    @classmethod
+    def cm_bulk_write_permissions(cls, group_ids, perm_ids, approved, chunk_size=500):
+        from compstack.auth.helpers import chunked
+        from compstack.auth.model.metadata import group_permission_assignments as tbl_gpa
+        from compstack.auth.model.orm import User
+        from compstack.auth.model.queries import query_group_user_ids
+        perm_ids = [int(pid) for pid in tolist(perm_ids)]
+        if not perm_ids:
+            return 0
+        written = 0
+        for chunk in chunked(group_ids, chunk_size):
+            chunk_written = _bulk_write_assignments(
+                tbl_gpa, 'group_id', cls, chunk, perm_ids, approved
+            )
+            if not chunk_written:
+                continue
+            written += chunk_written
+            user_ids = [r[0] for r in db.sess.execute(query_group_user_ids(chunk))]
+            for user_chunk in chunked(user_ids, chunk_size):
+                refresh_effective_permissions(user_chunk, perm_ids)
+            User.cm_bump_permission_version(user_ids, chunk_size)
+            record_permission_change(user_ids, chunk, perm_ids)
+        if written:
+            bump_auth_epoch()
+        return written
+
+    @transaction
+    def delete(cls, oid):
+        g = cls.get(oid)
+        if g is None:
+            return False
+        from compstack.auth.model.orm import User
+        user_ids = cls.cm_user_ids(oid)
+        remove_group_nesting(oid)
+        db.sess.delete(g)
+        db.sess.flush()
+        refresh_effective_permissions(user_ids)
+        User.cm_bump_permission_version(user_ids)
+        record_permission_change(user_ids, [oid])
+        bump_auth_epoch()
+        return True
+
     @transaction
     def add(cls, **kwargs):
         return cls.update(**kwargs)
@@ -478,16 +1080,19 @@ class GroupMixin(DefaultMixin):
     @classmethod
     def update(cls, oid=None, **kwargs):
         from compstack.auth.model.orm import User
+        old_user_ids = set()
         if oid is None:
             g = cls()
             db.sess.add(g)
         else:
             g = cls.get(oid)
+            old_user_ids = set(cls.cm_user_ids(oid))
 
         for k, v in six.iteritems(kwargs):
             try:
                 # some values can not be set directly
-                if k in ('assigned_users', 'approved_permissions', 'denied_permissions'):
+                if k in ('assigned_users', 'assigned_groups', 'approved_permissions',
+                         'denied_permissions'):
                     pass
                 else:
                     setattr(g, k, v)
@@ -496,51 +1101,61 @@ class GroupMixin(DefaultMixin):
 
         g.users = [User.get(uid) for uid in tolist(kwargs.get('assigned_users', []))]
         db.sess.flush()
+        if 'assigned_groups' in kwargs:
+            # the groups this group is nested in
+            nested_ids = set_group_parents(g.id, tolist(kwargs['assigned_groups']))
+            if nested_groups_enabled():
+                nested_user_ids = cls.cm_direct_user_ids(nested_ids)
+                refresh_effective_permissions(nested_user_ids)
+                User.cm_bump_permission_version(nested_user_ids)
+                record_permission_change(nested_user_ids, nested_ids)
         g.assign_permissions(
             kwargs.get('approved_permissions', []),
             kwargs.get('denied_permissions', [])
         )
+        # assign_permissions() took care of current members, users whose
+        # membership changed need all their permissions recomputed
+        changed_user_ids = old_user_ids ^ set(cls.cm_user_ids(g.id))
+        refresh_effective_permissions(changed_user_ids)
+        User.cm_bump_permission_version(changed_user_ids)
+        record_permission_change(changed_user_ids, [g.id])
+        bump_auth_epoch()
         return g
 
     def assign_permissions(self, approved_perm_ids, denied_perm_ids):
+        """
+            Makes the group's assignments match the given approved and denied
+            permission ids.  Only the rows that differ are written.  Returns a
+            PermissionChanges.
+        """
         from compstack.auth.model.metadata import group_permission_assignments as tbl_gpa
-        insval = []
-
-        # delete existing permission assignments for this group (i.e. we start over)
-        db.sess.execute(tbl_gpa.delete(tbl_gpa.c.group_id == self.id))
-
-        # insert "approved" records
-        if approved_perm_ids is not None and len(approved_perm_ids) != 0:
-            insval.extend([
-                {'group_id': self.id, 'permission_id': pid, 'approved': 1}
-                for pid in approved_perm_ids
-            ])
-
-        # insert "denied" records
-        if denied_perm_ids is not None and len(denied_perm_ids) != 0:
-            insval.extend([
-                {'group_id': self.id, 'permission_id': pid, 'approved': -1}
-                for pid in denied_perm_ids
-            ])
+        from compstack.auth.model.orm import User
 
-        # do inserts
-        if insval:
-            db.sess.execute(tbl_gpa.insert(), insval)
+        # ids posted from forms can be strings
+        target = dict((int(pid), 1) for pid in approved_perm_ids or [])
+        target.update((int(pid), -1) for pid in denied_perm_ids or [])
 
-        return
+        current = _current_assignments(tbl_gpa, 'group_id', self.id)
+        changes = _write_assignments(tbl_gpa, 'group_id', self.id, current, target)
+        if changes.permission_ids:
+            user_ids = self.__class__.cm_user_ids(self.id)
+            refresh_effective_permissions(user_ids, changes.permission_ids)
+            User.cm_bump_permission_version(user_ids)
+            record_permission_change(user_ids, [self.id], changes.permission_ids)
+            bump_auth_epoch()
+        return changes
 
     @transaction
     def assign_permissions_by_name(cls, group_name, approved_perm_list=[], denied_perm_list=[]):
         # Note: this function is a wrapper for assign_permissions and will commit db trans
-        from compstack.auth.model.orm import Permission
         group = cls.get_by(name=six.text_type(group_name))
-        approved_perm_ids = [item.id for item in [
-            Permission.get_by(name=six.text_type(perm)) for perm in tolist(approved_perm_list)
-        ]]
-        denied_perm_ids = [item.id for item in [
-            Permission.get_by(name=six.text_type(perm)) for perm in tolist(denied_perm_list)
-        ]]
-        group.assign_permissions(approved_perm_ids, denied_perm_ids)
+        approved_perm_ids = permission_registry.ids_for_names(
+            [six.text_type(perm) for perm in tolist(approved_perm_list)]
+        )
+        denied_perm_ids = permission_registry.ids_for_names(
+            [six.text_type(perm) for perm in tolist(denied_perm_list)]
+        )
+        return group.assign_permissions(approved_perm_ids, denied_perm_ids)
 
     @property
     def user_ids(self):
@@ -574,7 +1189,7 @@ class GroupMixin(DefaultMixin):
             if permid not in cdenied:
                 cdenied.append(permid)
 
-        g.assign_permissions(capproved, cdenied)
+        return g.assign_permissions(capproved, cdenied)
 
     @classmethod
     def testing_create(cls):
@@ -0,0 +1,578 @@
+from collections import defaultdict
+import threading
+import time
+import zlib
+
+from blazeutils.helpers import tolist
+from blazeweb.globals import settings
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+import sqlalchemy.sql as sasql
+
+from compstack.auth.model.epoch import on_epoch_change
+from compstack.sqlalchemy import db
+
+
+def engine_enabled():
+    return settings.components.auth.permission_engine == 'memory'
+
+
+def table_enabled():
+    return settings.components.auth.permission_engine == 'table'
+
+
+def rebuild_effective_permissions(user_ids=None, permission_ids=None):
+    """
+        Recomputes the rows of auth_effective_permissions for the given users
+        and permissions.  None means "all", so calling this without arguments
+        rebuilds the whole table.
+    """
+    from compstack.auth.model.metadata import effective_permissions as tbl_ep
+    from compstack.auth.model.queries import query_effective_permissions
+
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    if permission_ids is not None:
+        permission_ids = list(permission_ids)
+    if user_ids == [] or permission_ids == []:
+        return
+
+    condition = sasql.true()
+    if user_ids is not None:
+        condition = sasql.and_(condition, tbl_ep.c.user_id.in_(user_ids))
+    if permission_ids is not None:
+        condition = sasql.and_(condition, tbl_ep.c.permission_id.in_(permission_ids))
+    db.sess.execute(tbl_ep.delete(condition))
+    db.sess.execute(tbl_ep.insert().from_select(
+        ['user_id', 'permission_id'],
+        query_effective_permissions(user_ids, permission_ids)
+    ))
+
+
+def refresh_effective_permissions(user_ids=None, permission_ids=None):
+    """
+        Like rebuild_effective_permissions(), but only does something when the
+        permission engine is 'table'.  Called by the model's write paths.
+    """
+    if table_enabled():
+        if permission_ids is not None:
+            # approving a wildcard approves what it covers
+            permission_ids = permission_registry.layout().covered_ids(permission_ids)
+        rebuild_effective_permissions(user_ids, permission_ids)
+
+
+def permission_bit(permission_id):
+    """
+        A permission's bit in a permission mask (see PermissionLayout)
+    """
+    return permission_registry.bit(permission_id)
+
+
+def mask_for_ids(permission_ids):
+    return permission_registry.mask_for_ids(permission_ids)
+
+
+class PermissionLayout(object):
+    """
+        One load of auth_permissions: the name <-> id mapping and the bit of
+        each permission in a permission mask.  Bits are numbered densely in id
+        order, so a mask needs no more bits than there are permissions and
+        every process that loads the same permissions uses the same bits.
+        `key` identifies the numbering so that masks kept outside the process
+        (e.g. in sessions) can tell when permissions were added or deleted.
+    """
+    def __init__(self, rows=()):
+        self.names = dict(rows)
+        self.ids = dict((name, pid) for pid, name in self.names.items())
+        ordered = sorted(self.names)
+        self.positions = dict((pid, position) for position, pid in enumerate(ordered))
+        self.key = zlib.crc32(','.join(str(pid) for pid in ordered).encode('ascii')) \
+            & 0xffffffff
+        self.full_mask = (1 << len(ordered)) - 1
+        self._ordered_names = [self.names[pid] for pid in ordered]
+        self._name_masks = {}
+        # wildcard permission id -> (length of its name, ids of the
+        # permissions it covers)
+        self.wildcards = find_wildcards(self.names)
+
+    def covered_ids(self, permission_ids):
+        """
+            `permission_ids` and the ids of the permissions covered by the
+            wildcards among them
+        """
+        ids = set(permission_ids)
+        for pid in list(ids):
+            if pid in self.wildcards:
+                ids.update(self.wildcards[pid][1])
+        return ids
+
+    def bit(self, permission_id):
+        return 1 << self.positions[permission_id]
+
+    def mask_for_ids(self, permission_ids):
+        mask = 0
+        for pid in permission_ids:
+            mask |= 1 << self.positions[pid]
+        return mask
+
+    def mask_for_names(self, names):
+        """
+            returns the mask for the given permission names or None if any of
+            the names is not in this layout
+        """
+        key = tuple(tolist(names))
+        if key not in self._name_masks:
+            if any(name not in self.ids for name in key):
+                self._name_masks[key] = None
+            else:
+                self._name_masks[key] = self.mask_for_ids(self.ids[name] for name in key)
+        return self._name_masks[key]
+
+    def names_for_mask(self, mask):
+        names = []
+        position = 0
+        while mask:
+            if mask & 1:
+                names.append(self._ordered_names[position])
+            mask >>= 1
+            position += 1
+        return names
+
+
+class PermissionRegistry(object):
+    """
+        Caches the PermissionLayout of auth_permissions for the process.
+        Looking up a name or id that isn't known reloads the whole (small)
+        table with one query.  It is also cleared when the auth epoch changes.
+    """
+    def __init__(self):
+        self._layout = None
+
+    def clear(self):
+        self._layout = None
+
+    def load(self):
+        from compstack.auth.model.orm import Permission
+        rows = db.sess.query(Permission.id, Permission.name).all()
+        # swapped in with one assignment for other threads
+        layout = self._layout = PermissionLayout(rows)
+        return layout
+
+    def layout(self):
+        """
+            the current PermissionLayout, loaded if needed
+        """
+        layout = self._layout
+        if layout is None:
+            layout = self.load()
+        return layout
+
+    def _layout_with_ids(self, ids):
+        layout = self.layout()
+        if any(pid not in layout.positions for pid in ids):
+            layout = self.load()
+        return layout
+
+    def bit(self, permission_id):
+        return self._layout_with_ids((permission_id,)).bit(permission_id)
+
+    def mask_for_ids(self, permission_ids):
+        permission_ids = list(permission_ids)
+        return self._layout_with_ids(permission_ids).mask_for_ids(permission_ids)
+
+    def ids_for_names(self, names):
+        """
+            returns the ids of the given permission names, in the same order.
+            Raises ValueError if any of the names is not a permission.
+        """
+        names = tolist(names)
+        layout = self.layout()
+        if any(name not in layout.ids for name in names):
+            layout = self.load()
+        ids = layout.ids
+        missing = [name for name in names if name not in ids]
+        if missing:
+            raise ValueError('permission %s does not exist' % ', '.join(missing))
+        return [ids[name] for name in names]
+
+    def names_for_mask(self, mask):
+        """
+            returns the names of the permissions whose bits are set in `mask`
+        """
+        layout = self.layout()
+        if mask & ~layout.full_mask:
+            # a permission added since the layout was loaded
+            layout = self.load()
+        return layout.names_for_mask(mask & layout.full_mask)
+
+
+permission_registry = PermissionRegistry()
+on_epoch_change(permission_registry.clear)
+
+
+@sa.event.listens_for(saorm.Session, 'after_flush')
+def _permissions_written_after_flush(session, flush_context):
+    from compstack.auth.model.orm import Permission
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Permission):
+            permission_registry.clear()
+            sync_permission_wildcards(session)
+            return
+
+
+@sa.event.listens_for(saorm.Session, 'after_bulk_update')
+@sa.event.listens_for(saorm.Session, 'after_bulk_delete')
+def _permissions_written_after_bulk(context):
+    from compstack.auth.model.orm import Permission
+    if context.primary_table is Permission.__table__:
+        permission_registry.clear()
+        sync_permission_wildcards(context.session)
+
+
+WILDCARD = '*'
+
+
+def is_wildcard(name):
+    return name.endswith(WILDCARD)
+
+
+def find_wildcards(names):
+    """
+        returns a dict of wildcard permission id -> (length of its name, ids
+        of the permissions it covers) for a dict of permission id -> name.  A
+        wildcard like "reports-sales-*" covers the permissions whose names
+        start with "reports-sales-", other wildcards excepted.
+    """
+    trie = PrefixTrie()
+    wildcards = {}
+    for pid, name in names.items():
+        if is_wildcard(name):
+            trie.add(name[:-len(WILDCARD)], pid)
+            wildcards[pid] = (len(name), set())
+    if not wildcards:
+        return wildcards
+    for pid, name in names.items():
+        if is_wildcard(name):
+            continue
+        for wildcard_id in trie.matching(name):
+            wildcards[wildcard_id][1].add(pid)
+    return dict((pid, (length, frozenset(covered)))
+                for pid, (length, covered) in wildcards.items())
+
+
+def wildcards_in_use():
+    """
+        True when there are wildcard permissions, i.e. when the queries need to
+        resolve wildcard assignments
+    """
+    return bool(permission_registry.layout().wildcards)
+
+
+def sync_permission_wildcards(session=None):
+    """
+        Makes auth_permission_wildcards match the current permission names.
+        Called whenever permissions are written through the session.  When
+        the permission engine is 'table', the effective permissions of the
+        permissions whose coverage changed are recomputed.
+    """
+    from compstack.auth.model.metadata import permission_wildcards as tbl_pw
+    from compstack.auth.model.orm import Permission
+    session = session or db.sess
+    wildcards = find_wildcards(dict(
+        session.execute(sasql.select([Permission.id, Permission.name])).fetchall()
+    ))
+    rows = set(
+        (wildcard_id, pid, length)
+        for wildcard_id, (length, covered) in wildcards.items()
+        for pid in covered
+    )
+    current = set(tuple(row) for row in session.execute(sasql.select(
+        [tbl_pw.c.wildcard_id, tbl_pw.c.permission_id, tbl_pw.c.name_length]
+    )))
+    if rows == current:
+        return
+    session.execute(tbl_pw.delete())
+    if rows:
+        session.execute(tbl_pw.insert(), [
+            {'wildcard_id': wildcard_id, 'permission_id': pid, 'name_length': length}
+            for wildcard_id, pid, length in rows
+        ])
+    if table_enabled():
+        rebuild_effective_permissions(permission_ids=set(row[1] for row in rows ^ current))
+
+
+class PrefixTrie(object):
+    """
+        Maps prefixes to values.  matching() finds the values of every prefix
+        of a name in O(length of the name).
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # None can't be a character, so it holds the values that end here
+        node.setdefault(None, []).append(value)
+
+    def matching(self, name):
+        node = self.root
+        found = list(node.get(None, ()))
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                break
+            found.extend(node.get(None, ()))
+        return found
+
+
+class _IndexData(object):
+    """
+        Holds one snapshot of the indexes so that a reload can be swapped in
+        with a single attribute assignment.
+    """
+    def __init__(self, layout):
+        # the PermissionLayout the masks are built with, and its permission
+        # id -> name and name -> id mappings
+        self.layout = layout
+        self.perm_names = layout.names
+        self.perm_ids = layout.ids
+        # user id -> super_user flag
+        self.users = {}
+        # user id -> set of group ids
+        self.user_groups = defaultdict(set)
+        # user/group id -> permission mask
+        self.user_approved = defaultdict(int)
+        self.user_denied = defaultdict(int)
+        self.group_approved = defaultdict(int)
+        self.group_denied = defaultdict(int)
+        # wildcard permission id -> (prefix length, mask of the permissions
+        # it covers)
+        self.wildcards = {}
+        # tuple of permission names -> compiled mask
+        self.name_masks = {}
+        # user id -> effective mask, filled in as users are resolved
+        self.user_masks = {}
+        self.loaded_at = time.time()
+
+
+class PermissionIndex(object):
+    """
+        Loads the permission assignment and group membership tables into
+        dict/set indexes so that effective permissions can be resolved in
+        Python without a round trip to the database.
+
+        The precedence rules are the same as cm_permission_map():
+
+            user deny > user approve > group deny > group approve
+
+        Permissions named like "reports-sales-*" are wildcards.  Assigning one
+        to a user or group assigns every permission whose name starts with
+        "reports-sales-", unless the same user or group has an assignment for
+        that permission itself or a longer wildcard covering it.  The queries
+        used by the other engines follow the same rules through
+        auth_permission_wildcards (see queries.user_assignments()).
+    """
+    def __init__(self):
+        self._data = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        self._data = None
+
+    def is_stale(self, data):
+        if data.layout is not permission_registry.layout():
+            # the masks would not match the ones built with the new layout
+            return True
+        ttl = settings.components.auth.permission_engine_ttl
+        return ttl is not None and time.time() - data.loaded_at > ttl
+
+    @property
+    def data(self):
+        data = self._data
+        if data is None or self.is_stale(data):
+            with self._lock:
+                data = self._data
+                if data is None or self.is_stale(data):
+                    data = self._data = self.load()
+        return data
+
+    def load(self):
+        from compstack.auth.model.orm import User
+        from compstack.auth.model.metadata import group_permission_assignments as tbl_gpa, \
+            user_permission_assignments as tbl_upa
+        from compstack.auth.model.queries import group_membership
+
+        data = _IndexData(permission_registry.load())
+        positions = data.layout.positions
+        for uid, super_user in db.sess.execute(sasql.select([User.id, User.super_user])):
+            data.users[uid] = bool(super_user)
+        membership = group_membership()
+        for uid, gid in db.sess.execute(
+            sasql.select([membership.c.auth_user_id, membership.c.auth_group_id])
+        ):
+            data.user_groups[uid].add(gid)
+        for uid, pid, approved in db.sess.execute(
+            sasql.select([tbl_upa.c.user_id, tbl_upa.c.permission_id, tbl_upa.c.approved])
+        ):
+            if pid not in positions:
+                # added after the layout was loaded, picked up on the next load
+                continue
+            if approved == 1:
+                data.user_approved[uid] |= 1 << positions[pid]
+            else:
+                data.user_denied[uid] |= 1 << positions[pid]
+        for gid, pid, approved in db.sess.execute(
+            sasql.select([tbl_gpa.c.group_id, tbl_gpa.c.permission_id, tbl_gpa.c.approved])
+        ):
+            if pid not in positions:
+                continue
+            if approved == 1:
+                data.group_approved[gid] |= 1 << positions[pid]
+            else:
+                data.group_denied[gid] |= 1 << positions[pid]
+        self.load_wildcards(data)
+        return data
+
+    def load_wildcards(self, data):
+        """
+            Folds wildcard assignments into the assignment masks, using what
+            each wildcard covers according to the layout.
+        """
+        for pid, (length, covered) in data.layout.wildcards.items():
+            data.wildcards[pid] = (length, data.layout.mask_for_ids(covered))
+        if not data.wildcards:
+            return
+
+        wildcard_bits = data.layout.mask_for_ids(data.wildcards)
+        for approved, denied in ((data.user_approved, data.user_denied),
+                                 (data.group_approved, data.group_denied)):
+            for oid in set(approved) | set(denied):
+                if (approved.get(oid, 0) | denied.get(oid, 0)) & wildcard_bits:
+                    approved[oid], denied[oid] = self.expand_wildcards(
+                        data, approved.get(oid, 0), denied.get(oid, 0)
+                    )
+
+    def expand_wildcards(self, data, approved, denied):
+        """
+            returns the approved and denied masks of one user or group with
+            the permissions covered by its wildcard assignments added
+        """
+        wild_approved = 0
+        wild_denied = 0
+        # shorter (broader) wildcards first so longer ones override them
+        assigned = [
+            (data.wildcards[pid][0], pid) for pid in data.wildcards
+            if (approved | denied) & data.layout.bit(pid)
+        ]
+        for _, pid in sorted(assigned):
+            covered = data.wildcards[pid][1]
+            if approved & data.layout.bit(pid):
+                wild_approved |= covered
+                wild_denied &= ~covered
+            else:
+                wild_denied |= covered
+                wild_approved &= ~covered
+        # assignments of the permission itself win over wildcards
+        explicit = approved | denied
+        return approved | (wild_approved & ~explicit), denied | (wild_denied & ~explicit)
+
+    def effective_mask(self, uid, data=None):
+        """
+            returns the mask of permissions approved for the user with the
+            given user_id `uid`, ignoring the super user flag
+        """
+        data = data or self.data
+        if uid in data.user_masks:
+            return data.user_masks[uid]
+        group_approved = 0
+        group_denied = 0
+        for gid in data.user_groups.get(uid, ()):
+            group_approved |= data.group_approved.get(gid, 0)
+            group_denied |= data.group_denied.get(gid, 0)
+        user_approved = data.user_approved.get(uid, 0)
+        user_denied = data.user_denied.get(uid, 0)
+        mask = ((group_approved & ~group_denied) | user_approved) & ~user_denied
+        data.user_masks[uid] = mask
+        return mask
+
+    def mask_for_names(self, permissions, data=None):
+        """
+            returns the mask for the given permission names or None if any of
+            the names is not a permission
+        """
+        data = data or self.data
+        key = tuple(tolist(permissions))
+        if key not in data.name_masks:
+            if any(name not in data.perm_ids for name in key):
+                data.name_masks[key] = None
+            else:
+                data.name_masks[key] = data.layout.mask_for_ids(
+                    data.perm_ids[name] for name in key
+                )
+        return data.name_masks[key]
+
+    def permission_dict(self, uid, su_override=True):
+        """
+            same return value as UserMixin.cm_permission_dict()
+        """
+        data = self.data
+        if uid not in data.users:
+            return {}
+        user_is_super = su_override and data.users[uid]
+        mask = self.effective_mask(uid, data)
+        return dict(
+            (name, user_is_super or bool(mask & data.layout.bit(pid)))
+            for pid, name in data.perm_names.items()
+        )
+
+    def permission_mask(self, uid, su_override=True):
+        """
+            same return value as UserMixin.cm_permission_mask()
+        """
+        data = self.data
+        if uid not in data.users:
+            return 0
+        if su_override and data.users[uid]:
+            return data.layout.full_mask
+        return self.effective_mask(uid, data)
+
+    def has_permission(self, uid, perms, su_override=True):
+        """
+            same return value as UserMixin.cm_has_permission()
+        """
+        data = self.data
+        if uid not in data.users or not data.perm_names:
+            return False
+        required = self.mask_for_names(perms, data)
+        if required is None:
+            return False
+        if su_override and data.users[uid]:
+            return True
+        return self.effective_mask(uid, data) & required == required
+
+    def user_ids_with_permissions(self, permissions, match='any'):
+        """
+            returns the ids of users approved for any (or all, depending on
+            `match`) of the given permission names, in id order
+        """
+        data = self.data
+        if match == 'all':
+            wanted = self.mask_for_names(permissions, data)
+            if not wanted:
+                return []
+            return [
+                uid for uid in sorted(data.users)
+                if self.effective_mask(uid, data) & wanted == wanted
+            ]
+        wanted = data.layout.mask_for_ids(
+            data.perm_ids[name] for name in tolist(permissions) if name in data.perm_ids
+        )
+        if not wanted:
+            return []
+        return [uid for uid in sorted(data.users) if wanted & self.effective_mask(uid, data)]
+
+
+permission_index = PermissionIndex()
+on_epoch_change(permission_index.clear)
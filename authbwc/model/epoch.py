@@ -0,0 +1,135 @@
+"""
+    The auth epoch is a single counter that is bumped in the same transaction
+    as any change to users, groups, memberships or permission assignments.
+    Processes compare it to the last value they saw (see check_auth_epoch())
+    to find out that data they cached about permissions is stale.
+
+    The process that bumps the epoch drops its own cached data when the
+    transaction ends, so nothing loaded from uncommitted rows outlives it.
+    That happens on rollback as well, since data may have been loaded from
+    the rows that were rolled back.
+"""
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+import sqlalchemy.sql as sasql
+
+from compstack.sqlalchemy import db
+
+EPOCH_ROW_ID = 1
+
+_INFO_KEY = 'auth_epoch_bumped'
+
+_listeners = []
+
+# the epoch this process saw on its last check
+_seen = {'epoch': None}
+
+
+def on_epoch_change(callback):
+    """
+        Registers a callable (with no arguments) that should drop cached
+        permission data.  It gets called when a transaction that changed the
+        epoch in this process ends and when check_auth_epoch() finds the epoch
+        was changed elsewhere.
+    """
+    _listeners.append(callback)
+    return callback
+
+
+def _notify():
+    for callback in _listeners:
+        callback()
+
+
+def current_auth_epoch():
+    from compstack.auth.model.metadata import auth_epoch as tbl_epoch
+    epoch = db.sess.execute(
+        sasql.select([tbl_epoch.c.epoch], tbl_epoch.c.id == EPOCH_ROW_ID)
+    ).scalar()
+    return epoch or 0
+
+
+def bump_auth_epoch(session=None):
+    from compstack.auth.model.metadata import auth_epoch as tbl_epoch
+    session = session or db.sess
+    result = session.execute(
+        tbl_epoch.update(tbl_epoch.c.id == EPOCH_ROW_ID).values(epoch=tbl_epoch.c.epoch + 1)
+    )
+    if result.rowcount == 0:
+        session.execute(tbl_epoch.insert().values(id=EPOCH_ROW_ID, epoch=1))
+    session.info[_INFO_KEY] = True
+
+
+def auth_classes():
+    from compstack.auth.model.declarative import GroupMixin, UserMixin
+    from compstack.auth.model.orm import Permission
+    return UserMixin, GroupMixin, Permission
+
+
+def cached_attributes():
+    """
+        (class, attribute names) of the columns, besides the ids, that cached
+        permission data is built from: the registry's permission names and
+        the in-memory engine's super user flags
+    """
+    UserMixin, GroupMixin, Permission = auth_classes()
+    return ((UserMixin, ('super_user',)), (Permission, ('name',)))
+
+
+def _changes_cached_attribute(obj):
+    for cls, names in cached_attributes():
+        if isinstance(obj, cls):
+            attrs = sa.inspect(obj).attrs
+            return any(attrs[name].history.has_changes() for name in names)
+    return False
+
+
+@sa.event.listens_for(saorm.Session, 'after_flush')
+def _bump_after_flush(session, flush_context):
+    # users, groups and permissions added, deleted or renamed without going
+    # through the model's write methods, e.g. DefaultMixin.delete()
+    classes = auth_classes()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, classes):
+            bump_auth_epoch(session)
+            return
+    for obj in session.dirty:
+        if _changes_cached_attribute(obj):
+            bump_auth_epoch(session)
+            return
+
+
+@sa.event.listens_for(saorm.Session, 'after_bulk_delete')
+def _bump_after_bulk_delete(context):
+    if issubclass(context.mapper.class_, auth_classes()):
+        bump_auth_epoch(context.session)
+
+
+@sa.event.listens_for(saorm.Session, 'after_bulk_update')
+def _bump_after_bulk_update(context):
+    # the keys of the values can be attributes, columns or names
+    keys = set(getattr(key, 'key', key) for key in context.values)
+    for cls, names in cached_attributes():
+        if issubclass(context.mapper.class_, cls) and keys.intersection(names):
+            bump_auth_epoch(context.session)
+            return
+
+
+@sa.event.listens_for(saorm.Session, 'after_commit')
+@sa.event.listens_for(saorm.Session, 'after_rollback')
+def _notify_after_transaction(session):
+    if session.info.pop(_INFO_KEY, False):
+        _notify()
+
+
+def check_auth_epoch():
+    """
+        Drops cached permission data if the epoch changed since the last
+        check.  Returns True when it did.
+    """
+    epoch = current_auth_epoch()
+    if epoch == _seen['epoch']:
+        return False
+    _seen['epoch'] = epoch
+    _notify()
+    return True
@@ -1,9 +1,12 @@
-from sqlalchemy import Table, Column, ForeignKey, CheckConstraint, Index, Integer
+from sqlalchemy import Table, Column, ForeignKey, CheckConstraint, Index, Integer, \
+    PrimaryKeyConstraint
 
 from compstack.auth.model.orm import User, Group
 from compstack.sqlalchemy import db
 
-__all__ = ['group_permission_assignments', 'user_permission_assignments']
+__all__ = ['group_permission_assignments', 'user_permission_assignments',
+           'effective_permissions', 'auth_epoch', 'group_groups', 'group_closure',
+           'permission_wildcards']
 
 group_permission_assignments = Table(
     'auth_permission_assignments_groups', db.meta,
@@ -23,6 +26,14 @@ Index(
     unique=True
 )
 
+# finds the groups holding a permission (see queries.permission_holders_statement())
+Index(
+    'ix_auth_permission_assignments_groups_2',
+    group_permission_assignments.c.permission_id,
+    group_permission_assignments.c.approved,
+    group_permission_assignments.c.group_id,
+)
+
 
 user_permission_assignments = Table(
     'auth_permission_assignments_users', db.meta,
@@ -43,6 +54,14 @@ Index(
     unique=True
 )
 
+# finds the users holding a permission directly
+Index(
+    'ix_auth_permission_assignments_users_2',
+    user_permission_assignments.c.permission_id,
+    user_permission_assignments.c.approved,
+    user_permission_assignments.c.user_id,
+)
+
 # user <-> group table
 user_groups = Table(
     'auth_user_group_map', db.meta,
@@ -51,3 +70,84 @@ user_groups = Table(
     Column('auth_group_id', Integer, ForeignKey(Group.id, name='fk_auth_ugmap_group_id',
                                                 ondelete='cascade'))
 )
+
+Index(
+    'ix_auth_user_group_map_group',
+    user_groups.c.auth_group_id,
+    user_groups.c.auth_user_id,
+)
+
+# group <-> group table, the child group's members are members of the parent
+group_groups = Table(
+    'auth_group_group_map', db.meta,
+    Column('parent_group_id', Integer, ForeignKey(Group.id, name='fk_auth_ggmap_parent_id',
+                                                  ondelete='cascade'), nullable=False),
+    Column('child_group_id', Integer, ForeignKey(Group.id, name='fk_auth_ggmap_child_id',
+                                                 ondelete='cascade'), nullable=False),
+    PrimaryKeyConstraint('parent_group_id', 'child_group_id', name='pk_auth_group_group_map'),
+)
+
+# transitive closure of auth_group_group_map: a row for every group and each
+# group it is nested in at any depth (see nesting.py)
+group_closure = Table(
+    'auth_group_closure', db.meta,
+    Column('ancestor_id', Integer, ForeignKey(Group.id, name='fk_auth_gclosure_ancestor_id',
+                                              ondelete='cascade'), nullable=False),
+    Column('descendant_id', Integer, ForeignKey(Group.id, name='fk_auth_gclosure_descendant_id',
+                                                ondelete='cascade'), nullable=False),
+    PrimaryKeyConstraint('ancestor_id', 'descendant_id', name='pk_auth_group_closure'),
+)
+
+Index(
+    'ix_auth_group_closure_1',
+    group_closure.c.descendant_id,
+    group_closure.c.ancestor_id,
+)
+
+# the permissions each wildcard permission (e.g. "reports-sales-*") covers,
+# with the length of the wildcard's name so that longer wildcards can win over
+# shorter ones.  Kept up to date as permissions are written (see
+# engine.sync_permission_wildcards()).
+permission_wildcards = Table(
+    'auth_permission_wildcards', db.meta,
+    Column('wildcard_id', Integer, ForeignKey("auth_permissions.id",
+                                              name='fk_auth_pwild_wildcard_id',
+                                              ondelete='cascade'), nullable=False),
+    Column('permission_id', Integer, ForeignKey("auth_permissions.id",
+                                                name='fk_auth_pwild_permission_id',
+                                                ondelete='cascade'), nullable=False),
+    Column('name_length', Integer, nullable=False),
+    PrimaryKeyConstraint('wildcard_id', 'permission_id', name='pk_auth_permission_wildcards'),
+)
+
+Index(
+    'ix_auth_permission_wildcards_1',
+    permission_wildcards.c.permission_id,
+    permission_wildcards.c.wildcard_id,
+)
+
+# approved (user, permission) pairs, maintained when the permission engine is
+# 'table'.  Super user status is not reflected here.
+effective_permissions = Table(
+    'auth_effective_permissions', db.meta,
+    Column('user_id', Integer, ForeignKey(User.id, name='fk_auth_effperm_user_id',
+                                          ondelete='cascade'), nullable=False),
+    Column('permission_id', Integer, ForeignKey("auth_permissions.id",
+                                                name='fk_auth_effperm_permission_id',
+                                                ondelete='cascade'), nullable=False),
+    PrimaryKeyConstraint('user_id', 'permission_id', name='pk_auth_effective_permissions'),
+)
+
+Index(
+    'ix_auth_effective_permissions_1',
+    effective_permissions.c.permission_id,
+    effective_permissions.c.user_id,
+)
+
+# single row counter bumped whenever users, groups, memberships or assignments
+# change (see epoch.py)
+auth_epoch = Table(
+    'auth_epoch', db.meta,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('epoch', Integer, nullable=False),
+)
@@ -0,0 +1,134 @@
+"""
+    Groups can be nested in other groups.  The members of a group are also
+    members of every group it is nested in, at any depth.
+
+    auth_group_closure has an (ancestor, descendant) row for each of those
+    pairs, so membership is resolved with a single join no matter how deep
+    the nesting goes.  Groups are not paired with themselves: direct
+    memberships are read from auth_user_group_map, so groups that were never
+    written through the Group write paths need no closure rows.  The closure is
+    kept up to date by the Group write paths whether or not the nested_groups
+    setting is on.
+"""
+from collections import defaultdict
+
+from blazeweb.globals import settings
+import sqlalchemy.sql as sasql
+
+from compstack.sqlalchemy import db
+
+
+def nested_groups_enabled():
+    return bool(settings.components.auth.nested_groups)
+
+
+def group_parent_map():
+    """
+        returns a dict of group id -> set of the ids of the groups it is
+        directly nested in
+    """
+    from compstack.auth.model.metadata import group_groups as tbl_gg
+    parents = defaultdict(set)
+    for parent_id, child_id in db.sess.execute(
+        sasql.select([tbl_gg.c.parent_group_id, tbl_gg.c.child_group_id])
+    ):
+        parents[child_id].add(parent_id)
+    return parents
+
+
+def group_ancestor_ids(group_id, parents):
+    """
+        returns the ids of the groups `group_id` is nested in at any depth,
+        including itself
+    """
+    seen = set([group_id])
+    stack = [group_id]
+    while stack:
+        for parent_id in parents.get(stack.pop(), ()):
+            if parent_id not in seen:
+                seen.add(parent_id)
+                stack.append(parent_id)
+    return seen
+
+
+def group_descendant_ids(group_id):
+    """
+        returns the ids of the groups nested in `group_id` at any depth,
+        including itself
+    """
+    from compstack.auth.model.metadata import group_closure as tbl_gc
+    ids = set(r[0] for r in db.sess.execute(
+        sasql.select([tbl_gc.c.descendant_id], tbl_gc.c.ancestor_id == group_id)
+    ))
+    ids.add(group_id)
+    return ids
+
+
+def rebuild_group_closure(group_ids=None):
+    """
+        Recomputes the closure rows of the given groups (as descendants).
+        None means all groups.
+    """
+    from compstack.auth.model.metadata import group_closure as tbl_gc
+    from compstack.auth.model.orm import Group
+
+    if group_ids is None:
+        group_ids = [r[0] for r in db.sess.execute(sasql.select([Group.id]))]
+        db.sess.execute(tbl_gc.delete())
+    else:
+        group_ids = list(group_ids)
+        if not group_ids:
+            return
+        db.sess.execute(tbl_gc.delete(tbl_gc.c.descendant_id.in_(group_ids)))
+
+    parents = group_parent_map()
+    rows = [
+        {'ancestor_id': ancestor_id, 'descendant_id': group_id}
+        for group_id in group_ids
+        for ancestor_id in group_ancestor_ids(group_id, parents)
+        if ancestor_id != group_id
+    ]
+    if rows:
+        db.sess.execute(tbl_gc.insert(), rows)
+
+
+def set_group_parents(group_id, parent_ids):
+    """
+        Makes `parent_ids` the groups that `group_id` is directly nested in
+        and updates the closure.  Returns the ids of the groups whose
+        ancestors changed, i.e. `group_id` and the groups nested in it.
+    """
+    from compstack.auth.model.metadata import group_groups as tbl_gg
+
+    parent_ids = set(int(pid) for pid in parent_ids)
+    nested_ids = group_descendant_ids(group_id)
+    if parent_ids & nested_ids:
+        raise ValueError('group %s can not be nested in itself' % group_id)
+
+    db.sess.execute(tbl_gg.delete(tbl_gg.c.child_group_id == group_id))
+    if parent_ids:
+        db.sess.execute(tbl_gg.insert(), [
+            {'parent_group_id': pid, 'child_group_id': group_id} for pid in parent_ids
+        ])
+    rebuild_group_closure(nested_ids)
+    return nested_ids
+
+
+def remove_group_nesting(group_id):
+    """
+        Removes `group_id` from the nesting tables before it is deleted.
+        Returns the ids of the groups that were nested in it.
+    """
+    from compstack.auth.model.metadata import group_closure as tbl_gc, group_groups as tbl_gg
+
+    nested_ids = group_descendant_ids(group_id) - set([group_id])
+    db.sess.execute(tbl_gg.delete(sasql.or_(
+        tbl_gg.c.parent_group_id == group_id,
+        tbl_gg.c.child_group_id == group_id
+    )))
+    db.sess.execute(tbl_gc.delete(sasql.or_(
+        tbl_gc.c.ancestor_id == group_id,
+        tbl_gc.c.descendant_id == group_id
+    )))
+    rebuild_group_closure(nested_ids)
+    return nested_ids
@@ -1,66 +1,242 @@
-from sqlalchemy.sql import select, and_
-from sqlalchemy.sql.functions import sum
+from sqlalchemy.sql import select, and_, or_, exists, case, bindparam, literal, union, \
+    union_all
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.sql.functions import count, sum
 from sqlalchemy.orm import outerjoin
+from sqlalchemy.util import LRUCache
+from compstack.sqlalchemy import db
 from compstack.auth.model.orm import User, Group, Permission
+from compstack.auth.model.metadata import group_closure as tbl_gc
 from compstack.auth.model.metadata import group_permission_assignments as tbl_gpa
+from compstack.auth.model.metadata import permission_wildcards as tbl_pw
 from compstack.auth.model.metadata import user_groups
 from compstack.auth.model.metadata import user_permission_assignments as tbl_upa
+from compstack.auth.model.engine import wildcards_in_use
+from compstack.auth.model.nesting import nested_groups_enabled
+from compstack.auth.model.sqlview import permission_view_enabled, user_permissions_view
 
 
-def query_denied_group_permissions():
-    return select(
+# statements built by cached_statement(), by key and the settings that change
+# their shape
+_statements = {}
+
+# compiled forms of those statements, used by execute_cached()
+_compiled_cache = LRUCache(100)
+
+
+def cached_statement(key, build):
+    """
+        The statement `build()` returns, built once per process for `key`.
+        Statements should take their values from bind parameters so that they
+        can be reused for any user.
+    """
+    key = (key, nested_groups_enabled(), permission_view_enabled(), wildcards_in_use())
+    statement = _statements.get(key)
+    if statement is None:
+        statement = _statements[key] = build()
+    return statement
+
+
+def execute_cached(statement, params=None, stream=False):
+    """
+        Executes `statement` in the current session, compiling it only once per
+        dialect (see cached_statement()).  With `stream`, rows are fetched from
+        a server side cursor where the driver supports one.
+    """
+    connection = db.sess.connection().execution_options(compiled_cache=_compiled_cache,
+                                                        stream_results=stream)
+    return connection.execute(statement, params or {})
+
+
+def _filter_users(query, column, uid):
+    """
+        `uid` can be None (no filter), a single user id, a list of user ids or
+        a bind parameter
+    """
+    if uid is None:
+        return query
+    if isinstance(uid, (list, tuple, set, frozenset)):
+        return query.where(column.in_(list(uid)))
+    return query.where(column == uid)
+
+
+def _filter_permissions(query, permission_ids):
+    if permission_ids is None:
+        return query
+    return query.where(Permission.id.in_(list(permission_ids)))
+
+
+def user_assignments(expand=None):
+    """
+        auth_permission_assignments_users, or a select with the same columns
+        that also has a row for each permission covered by a wildcard
+        assignment, with the wildcard's approval.  Like in the in-memory
+        engine, an assignment of the permission itself or of a longer wildcard
+        covering it wins.  `expand` defaults to wildcards_in_use(), so the
+        plain table is read as long as there are no wildcard permissions.
+    """
+    return _expanded_assignments(tbl_upa, u'user_id', expand)
+
+
+def group_assignments(expand=None):
+    """
+        same as user_assignments() for auth_permission_assignments_groups
+    """
+    return _expanded_assignments(tbl_gpa, u'group_id', expand)
+
+
+def _expanded_assignments(table, owner, expand):
+    if expand is None:
+        expand = wildcards_in_use()
+    if not expand:
+        return table
+    wild = table.alias()
+    covers = tbl_pw.alias()
+    explicit = table.alias()
+    longer = table.alias()
+    longer_covers = tbl_pw.alias()
+    covered = select(
+        [wild.c[owner], covers.c.permission_id, wild.c.approved],
+        from_obj=wild.join(covers, covers.c.wildcard_id == wild.c.permission_id)
+    ).where(and_(
+        ~exists().where(and_(
+            explicit.c[owner] == wild.c[owner],
+            explicit.c.permission_id == covers.c.permission_id
+        )),
+        ~exists().where(and_(
+            longer.c[owner] == wild.c[owner],
+            longer_covers.c.wildcard_id == longer.c.permission_id,
+            longer_covers.c.permission_id == covers.c.permission_id,
+            longer_covers.c.name_length > covers.c.name_length
+        ))
+    ))
+    return union_all(
+        select([table.c[owner], table.c.permission_id, table.c.approved]),
+        covered
+    ).alias()
+
+
+def group_membership():
+    """
+        (auth_user_id, auth_group_id) for every group a user is a member of.
+        With nested groups on, that includes the groups their groups are
+        nested in, through auth_group_closure.
+    """
+    if not nested_groups_enabled():
+        return user_groups
+    return union(
+        select([user_groups.c.auth_user_id, user_groups.c.auth_group_id]),
+        select(
+            [user_groups.c.auth_user_id, tbl_gc.c.ancestor_id.label(u'auth_group_id')],
+            user_groups.c.auth_group_id == tbl_gc.c.descendant_id
+        )
+    ).alias(u'group_membership')
+
+
+def query_group_user_ids(group_ids):
+    """
+        the ids of the users that are members of any of the given groups
+    """
+    membership = group_membership()
+    return select([membership.c.auth_user_id]).where(
+        membership.c.auth_group_id.in_(list(group_ids))
+    ).distinct()
+
+
+def query_denied_group_permissions(uid=None, permission_ids=None):
+    user_groups = group_membership()
+    gpa = group_assignments()
+    query = select(
         [
             Permission.id.label(u'permission_id'),
             user_groups.c.auth_user_id.label(u'user_id'),
-            sum(tbl_gpa.c.approved).label(u'group_denied'),
+            sum(gpa.c.approved).label(u'group_denied'),
         ],
         from_obj=outerjoin(
             Permission,
-            tbl_gpa,
+            gpa,
             and_(
-                Permission.id == tbl_gpa.c.permission_id,
-                tbl_gpa.c.approved == -1
+                Permission.id == gpa.c.permission_id,
+                gpa.c.approved == -1
             )
         ).outerjoin(
-            user_groups, user_groups.c.auth_group_id == tbl_gpa.c.group_id
+            user_groups, user_groups.c.auth_group_id == gpa.c.group_id
         )
     ).group_by(
         Permission.id,
         user_groups.c.auth_user_id
     )
+    query = _filter_permissions(query, permission_ids)
+    return _filter_users(query, user_groups.c.auth_user_id, uid)
 
 
-def query_approved_group_permissions():
-    return select(
+def query_approved_group_permissions(uid=None, permission_ids=None):
+    user_groups = group_membership()
+    gpa = group_assignments()
+    query = select(
         [
             Permission.id.label(u'permission_id'),
             user_groups.c.auth_user_id.label(u'user_id'),
-            sum(tbl_gpa.c.approved).label(u'group_approved'),
+            sum(gpa.c.approved).label(u'group_approved'),
         ],
         from_obj=outerjoin(
             Permission,
-            tbl_gpa,
+            gpa,
             and_(
-                Permission.id == tbl_gpa.c.permission_id,
-                tbl_gpa.c.approved == 1
+                Permission.id == gpa.c.permission_id,
+                gpa.c.approved == 1
             )
         ).outerjoin(
-            user_groups, user_groups.c.auth_group_id == tbl_gpa.c.group_id
+            user_groups, user_groups.c.auth_group_id == gpa.c.group_id
+        )
+    ).group_by(
+        Permission.id,
+        user_groups.c.auth_user_id
+    )
+    query = _filter_permissions(query, permission_ids)
+    return _filter_users(query, user_groups.c.auth_user_id, uid)
+
+
+def query_group_permissions(uid=None, permission_ids=None, expand_wildcards=None):
+    """
+        group_approved and group_denied per permission and user, like
+        query_approved_group_permissions() and query_denied_group_permissions()
+        together, aggregated in a single pass over the group assignments
+    """
+    user_groups = group_membership()
+    gpa = group_assignments(expand_wildcards)
+    query = select(
+        [
+            Permission.id.label(u'permission_id'),
+            user_groups.c.auth_user_id.label(u'user_id'),
+            sum(case([(gpa.c.approved == 1, gpa.c.approved)])).label(u'group_approved'),
+            sum(case([(gpa.c.approved == -1, gpa.c.approved)])).label(u'group_denied'),
+        ],
+        from_obj=outerjoin(
+            Permission,
+            gpa,
+            Permission.id == gpa.c.permission_id
+        ).outerjoin(
+            user_groups, user_groups.c.auth_group_id == gpa.c.group_id
         )
     ).group_by(
         Permission.id,
         user_groups.c.auth_user_id
     )
+    query = _filter_permissions(query, permission_ids)
+    return _filter_users(query, user_groups.c.auth_user_id, uid)
 
 
 def query_user_group_permissions():
+    user_groups = group_membership()
+    gpa = group_assignments()
     return select(
         [
             User.id.label(u'user_id'),
             Group.id.label(u'group_id'),
             Group.name.label(u'group_name'),
-            tbl_gpa.c.permission_id,
-            tbl_gpa.c.approved.label(u'group_approved'),
+            gpa.c.permission_id,
+            gpa.c.approved.label(u'group_approved'),
         ],
         from_obj=outerjoin(
             User,
@@ -69,46 +245,322 @@ def query_user_group_permissions():
         ).outerjoin(
             Group, Group.id == user_groups.c.auth_group_id
         ).outerjoin(
-            tbl_gpa, tbl_gpa.c.group_id == Group.id
+            gpa, gpa.c.group_id == Group.id
         )
-    ).where(tbl_gpa.c.permission_id.isnot(None))
+    ).where(gpa.c.permission_id.isnot(None))
+
+
+def query_users_permissions(uid=None, permission_ids=None):
+    """
+        One row per user and permission with the user's own assignment and
+        the group aggregates.  Reads the auth_user_permissions view when the
+        permission_view setting is on.
+    """
+    if permission_view_enabled():
+        view = user_permissions_view
+        query = select([view]).order_by(view.c.user_id, view.c.permission_id)
+        if permission_ids is not None:
+            query = query.where(view.c.permission_id.in_(list(permission_ids)))
+        return _filter_users(query, view.c.user_id, uid)
+    return build_users_permissions(uid, permission_ids)
 
 
-def query_users_permissions():
-    ga = query_approved_group_permissions().alias('g_approve')
-    gd = query_denied_group_permissions().alias('g_deny')
+def build_users_permissions(uid=None, permission_ids=None, ordered=True, expand_wildcards=None):
+    """
+        The query behind query_users_permissions().  Without `ordered` it has
+        no ORDER BY, as needed for a view definition.  `expand_wildcards` is
+        passed to user_assignments().
+    """
+    upa = user_assignments(expand_wildcards)
+    gp = query_group_permissions(uid, permission_ids, expand_wildcards).alias('g_perms')
     user_perm = select([User.id.label(u'user_id'),
                         Permission.id.label(u'permission_id'),
                         Permission.name.label(u'permission_name'),
-                        User.login_id]).correlate(None).alias(u'user_perm')
-    return select(
+                        User.login_id]).correlate(None)
+    user_perm = _filter_permissions(user_perm, permission_ids)
+    user_perm = _filter_users(user_perm, User.id, uid).alias(u'user_perm')
+    query = select(
         [
             user_perm.c.user_id,
             user_perm.c.permission_id,
             user_perm.c.permission_name,
             user_perm.c.login_id,
-            tbl_upa.c.approved.label(u'user_approved'),
-            ga.c.group_approved,
-            gd.c.group_denied,
+            upa.c.approved.label(u'user_approved'),
+            gp.c.group_approved,
+            gp.c.group_denied,
         ],
         from_obj=outerjoin(
             user_perm,
-            tbl_upa,
+            upa,
             and_(
-                tbl_upa.c.user_id == user_perm.c.user_id,
-                tbl_upa.c.permission_id == user_perm.c.permission_id
+                upa.c.user_id == user_perm.c.user_id,
+                upa.c.permission_id == user_perm.c.permission_id
             )
         ).outerjoin(
-            ga,
+            gp,
             and_(
-                ga.c.user_id == user_perm.c.user_id,
-                ga.c.permission_id == user_perm.c.permission_id
+                gp.c.user_id == user_perm.c.user_id,
+                gp.c.permission_id == user_perm.c.permission_id
             )
+        )
+    )
+    if ordered:
+        query = query.order_by(user_perm.c.user_id, user_perm.c.permission_id)
+    return query
+
+
+def query_user_permissions(uid):
+    """
+        Same rows as query_users_permissions(uid) for a single user id (or bind
+        parameter), but the user's assignments and group memberships are
+        selected before the group assignments are aggregated, so the cost
+        scales with the assignments of that user rather than of every user.
+        The auth_user_permissions view is not used, since its aggregates can
+        only be filtered after they are computed.
+    """
+    membership = group_membership()
+    upa = user_assignments()
+    gpa = group_assignments()
+    groups = select([membership.c.auth_group_id]).where(
+        membership.c.auth_user_id == uid
+    ).alias(u'u_groups')
+    gp = select(
+        [
+            gpa.c.permission_id,
+            sum(case([(gpa.c.approved == 1, gpa.c.approved)])).label(u'group_approved'),
+            sum(case([(gpa.c.approved == -1, gpa.c.approved)])).label(u'group_denied'),
+        ],
+        from_obj=gpa.join(groups, groups.c.auth_group_id == gpa.c.group_id)
+    ).group_by(gpa.c.permission_id).alias(u'g_perms')
+    up = select([upa.c.permission_id, upa.c.approved]).where(
+        upa.c.user_id == uid
+    ).alias(u'u_perms')
+    user_perm = select([User.id.label(u'user_id'),
+                        Permission.id.label(u'permission_id'),
+                        Permission.name.label(u'permission_name'),
+                        User.login_id]).where(User.id == uid).correlate(None).alias(u'user_perm')
+    return select(
+        [
+            user_perm.c.user_id,
+            user_perm.c.permission_id,
+            user_perm.c.permission_name,
+            user_perm.c.login_id,
+            up.c.approved.label(u'user_approved'),
+            gp.c.group_approved,
+            gp.c.group_denied,
+        ],
+        from_obj=outerjoin(
+            user_perm, up, up.c.permission_id == user_perm.c.permission_id
         ).outerjoin(
-            gd,
+            gp, gp.c.permission_id == user_perm.c.permission_id
+        )
+    ).order_by(user_perm.c.user_id, user_perm.c.permission_id)
+
+
+def permission_map_statement():
+    """
+        query_user_permissions() for the user in the `uid` bind parameter
+    """
+    def build():
+        user_perm = query_user_permissions(bindparam('uid')).alias()
+        return select([user_perm])
+    return cached_statement('permission_map', build)
+
+
+def user_group_permissions_statement():
+    """
+        query_user_group_permissions() for the user in the `uid` bind parameter
+    """
+    def build():
+        user_group_perm = query_user_group_permissions().alias()
+        return select(
+            [
+                user_group_perm.c.permission_id,
+                user_group_perm.c.group_name,
+                user_group_perm.c.group_id,
+                user_group_perm.c.group_approved
+            ],
+            from_obj=user_group_perm
+        ).where(user_group_perm.c.user_id == bindparam('uid'))
+    return cached_statement('user_group_permissions', build)
+
+
+def permission_explanation_statement():
+    """
+        One row per permission and (user, group) assignment source for the user
+        in the `uid` bind parameter: the user's own assignment and, for each of
+        their groups that has the permission assigned, the group's id, name and
+        assignment.  Permissions without any group assignment get a single row
+        with a NULL group.
+    """
+    def build():
+        uid = bindparam('uid')
+        membership = group_membership()
+        upa = user_assignments()
+        gpa = group_assignments()
+        group_sources = gpa.join(
+            membership,
             and_(
-                gd.c.user_id == user_perm.c.user_id,
-                gd.c.permission_id == user_perm.c.permission_id
+                membership.c.auth_group_id == gpa.c.group_id,
+                membership.c.auth_user_id == uid
             )
+        ).join(Group, Group.id == gpa.c.group_id)
+        return select(
+            [
+                Permission.id.label(u'permission_id'),
+                Permission.name.label(u'permission_name'),
+                upa.c.approved.label(u'user_approved'),
+                Group.id.label(u'group_id'),
+                Group.name.label(u'group_name'),
+                gpa.c.approved.label(u'group_approved'),
+            ],
+            from_obj=outerjoin(
+                Permission,
+                upa,
+                and_(upa.c.permission_id == Permission.id, upa.c.user_id == uid)
+            ).outerjoin(group_sources, gpa.c.permission_id == Permission.id)
+        ).order_by(Permission.id, Group.name)
+    return cached_statement('permission_explanation', build)
+
+
+def permission_holders_statement():
+    """
+        (user_id, login_id, source) of the users approved for the permission
+        in the `permission_id` bind parameter, ordered by user id, starting
+        after `after_id` and limited to `limit` rows.  `source` is 'direct' for
+        a user level approval and 'group' when the approval comes from groups.
+
+        Only the permission's assignments are read, through the
+        permission_id indexes on the assignment tables, so the cost doesn't
+        grow with the number of permissions.  Super user status is not taken
+        into account.
+    """
+    def build():
+        permission_id = bindparam('permission_id')
+        after_id = bindparam('after_id')
+        membership = group_membership().alias(u'holder_groups')
+        upa = user_assignments()
+        gpa = group_assignments()
+        direct = select(
+            [upa.c.user_id, literal(u'direct').label(u'source')]
+        ).where(and_(
+            upa.c.permission_id == permission_id,
+            upa.c.approved == 1,
+            upa.c.user_id > after_id
+        ))
+        user_assigned = exists().where(and_(
+            upa.c.user_id == membership.c.auth_user_id,
+            upa.c.permission_id == permission_id
+        )).correlate_except(upa)
+        via_group = select(
+            [membership.c.auth_user_id.label(u'user_id'), literal(u'group').label(u'source')],
+            from_obj=membership.join(gpa, gpa.c.group_id == membership.c.auth_group_id)
+        ).where(and_(
+            gpa.c.permission_id == permission_id,
+            gpa.c.approved == 1,
+            membership.c.auth_user_id > after_id,
+            ~user_assigned,
+            ~_group_assignment_exists(membership.c.auth_user_id, permission_id, -1)
+        )).distinct()
+        holders = union_all(direct, via_group).alias(u'holders')
+        return select(
+            [holders.c.user_id, User.login_id, holders.c.source],
+            from_obj=holders.join(User, User.id == holders.c.user_id)
+        ).order_by(holders.c.user_id).limit(bindparam('limit'))
+    return cached_statement('permission_holders', build)
+
+
+def approved_clause(user_perm):
+    """
+        The resulting approval of a row from query_users_permissions() as a SQL
+        expression, using the same precedence as cm_permission_map().
+    """
+    return or_(
+        user_perm.c.user_approved == 1,
+        and_(
+            user_perm.c.user_approved.is_(None),
+            or_(
+                user_perm.c.group_denied.is_(None),
+                user_perm.c.group_denied >= 0,
+            ),
+            user_perm.c.group_approved >= 1
         )
-    ).order_by(user_perm.c.user_id, user_perm.c.permission_id)
+    )
+
+
+def query_effective_permissions(user_ids=None, permission_ids=None):
+    """
+        The (user_id, permission_id) pairs that are approved, optionally
+        limited to the given users and permissions.  Used to populate
+        auth_effective_permissions.
+    """
+    user_perm = query_users_permissions(user_ids, permission_ids).alias()
+    return select(
+        [user_perm.c.user_id, user_perm.c.permission_id],
+        from_obj=user_perm
+    ).where(approved_clause(user_perm))
+
+
+def query_approved_permission_counts(user_ids, permission_ids):
+    """
+        (user_id, approved_count) for the given users, counting how many of
+        the given permissions each one is approved for.  Users without any of
+        the permissions approved are not in the result.
+    """
+    user_perm = query_users_permissions(user_ids, permission_ids).alias()
+    return select(
+        [user_perm.c.user_id, count(user_perm.c.permission_id).label(u'approved_count')],
+        from_obj=user_perm
+    ).where(approved_clause(user_perm)).group_by(user_perm.c.user_id)
+
+
+def _user_assignment_exists(user_id, permission_id, approved):
+    upa = user_assignments()
+    return exists().where(and_(
+        upa.c.user_id == user_id,
+        upa.c.permission_id == permission_id,
+        upa.c.approved == approved
+    )).correlate_except(upa)
+
+
+def _group_assignment_exists(user_id, permission_id, approved):
+    user_groups = group_membership()
+    gpa = group_assignments()
+    return exists().where(and_(
+        user_groups.c.auth_user_id == user_id,
+        gpa.c.group_id == user_groups.c.auth_group_id,
+        gpa.c.permission_id == permission_id,
+        gpa.c.approved == approved
+    )).correlate_except(user_groups, gpa)
+
+
+def user_permission_approved(user_id, permission_id):
+    """
+        EXISTS based expression that is true when the user is approved for the
+        permission, using the same precedence as cm_permission_map().  The
+        arguments can be columns of an enclosing query or values.
+    """
+    return or_(
+        _user_assignment_exists(user_id, permission_id, 1),
+        and_(
+            ~_user_assignment_exists(user_id, permission_id, -1),
+            ~_group_assignment_exists(user_id, permission_id, -1),
+            _group_assignment_exists(user_id, permission_id, 1)
+        )
+    )
+
+
+def users_approved_clause(user_id, permission_ids, match='any'):
+    """
+        Filter for a query over users that keeps the users approved for any
+        (or all) of the given permission ids.  With match 'any',
+        `permission_ids` can be an expanding bind parameter.
+    """
+    if match == 'all':
+        return and_(*[user_permission_approved(user_id, pid) for pid in permission_ids])
+    if not isinstance(permission_ids, BindParameter):
+        permission_ids = list(permission_ids)
+    return exists().where(and_(
+        Permission.id.in_(permission_ids),
+        user_permission_approved(user_id, Permission.id)
+    )).correlate_except(Permission)
@@ -0,0 +1,111 @@
+"""
+    The model sends `auth.permissions_changed` once a transaction that changed
+    permission assignments, group memberships, groups or users is committed:
+
+        def on_change(sender, user_ids, group_ids, permission_ids):
+            ...
+
+        permissions_changed.connect(on_change)
+
+    The arguments are frozensets of the ids involved, any of which can be
+    empty.  Deleting users, groups or permissions, including bulk deletes
+    like delete_where(), sends the deleted ids along with the users and groups
+    that lose permissions by it.  Changes recorded during a transaction are
+    merged into a single
+    signal when it commits and dropped when it is rolled back.  The session
+    is between transactions when receivers are called, so they should not use
+    it to emit SQL.
+"""
+from blazeweb.events import signal
+import sqlalchemy as sa
+import sqlalchemy.orm as saorm
+
+from compstack.sqlalchemy import db
+
+permissions_changed = signal('auth.permissions_changed')
+
+_INFO_KEY = 'auth_permission_changes'
+
+
+def record_permission_change(user_ids=(), group_ids=(), permission_ids=()):
+    """
+        Adds ids to the pending change of the current transaction
+    """
+    _record(db.sess, user_ids, group_ids, permission_ids)
+
+
+def _record(session, user_ids=(), group_ids=(), permission_ids=()):
+    pending = session.info.setdefault(_INFO_KEY, (set(), set(), set()))
+    pending[0].update(user_ids)
+    pending[1].update(group_ids)
+    pending[2].update(permission_ids)
+
+
+def _record_deletes(session, cls, ids):
+    """
+        Records the deletion of the users, groups or permissions of class
+        `cls` with the given ids.  Called before the rows are deleted, while
+        the affected assignments and memberships can still be read.
+    """
+    from compstack.auth.model.declarative import GroupMixin, UserMixin
+    from compstack.auth.model.engine import permission_registry
+    from compstack.auth.model.metadata import group_permission_assignments as tbl_gpa, \
+        user_permission_assignments as tbl_upa
+    from compstack.auth.model.orm import Permission
+    from compstack.auth.model.queries import query_group_user_ids
+
+    ids = list(ids)
+    if not ids:
+        return
+    if issubclass(cls, UserMixin):
+        _record(session, user_ids=ids)
+    elif issubclass(cls, GroupMixin):
+        user_ids = [r[0] for r in session.execute(query_group_user_ids(ids))]
+        _record(session, user_ids, ids)
+    elif issubclass(cls, Permission):
+        user_ids = [r[0] for r in session.execute(
+            sa.select([tbl_upa.c.user_id], tbl_upa.c.permission_id.in_(ids)).distinct()
+        )]
+        group_ids = [r[0] for r in session.execute(
+            sa.select([tbl_gpa.c.group_id], tbl_gpa.c.permission_id.in_(ids)).distinct()
+        )]
+        if group_ids:
+            user_ids.extend(r[0] for r in session.execute(query_group_user_ids(group_ids)))
+        # deleting a wildcard changes the permissions it covered
+        _record(session, user_ids, group_ids, permission_registry.layout().covered_ids(ids))
+
+
+@sa.event.listens_for(saorm.Session, 'before_flush')
+def _record_flushed_deletes(session, flush_context, instances):
+    from compstack.auth.model.epoch import auth_classes
+    for auth_cls in auth_classes():
+        _record_deletes(session, auth_cls, [
+            obj.id for obj in session.deleted if isinstance(obj, auth_cls)
+        ])
+
+
+@sa.event.listens_for(saorm.Query, 'before_compile_delete')
+def _record_bulk_deletes(query, delete_context):
+    from compstack.auth.model.epoch import auth_classes
+    cls = delete_context.mapper.class_
+    if issubclass(cls, auth_classes()):
+        _record_deletes(query.session, cls, [r[0] for r in query.with_entities(cls.id)])
+
+
+@sa.event.listens_for(saorm.Session, 'after_commit')
+def _send_permissions_changed(session):
+    pending = session.info.pop(_INFO_KEY, None)
+    if pending is None:
+        return
+    user_ids, group_ids, permission_ids = pending
+    permissions_changed.send(
+        None,
+        user_ids=frozenset(user_ids),
+        group_ids=frozenset(group_ids),
+        permission_ids=frozenset(permission_ids),
+    )
+
+
+@sa.event.listens_for(saorm.Session, 'after_rollback')
+def _drop_permissions_changed(session):
+    session.info.pop(_INFO_KEY, None)
@@ -0,0 +1,91 @@
+"""
+    auth_user_permissions is a database view with one row per user and
+    permission (the columns of queries.query_users_permissions()).  The
+    init-db task installs it, along with indexes that support it, so that it
+    can be planned, indexed and monitored like any other database object.
+    With the permission_view setting on, the model selects from the view
+    rather than sending the whole construct on every query.
+
+    init-db only installs the view when permission_view is on.  The view is
+    built from the queries as they are when it is installed, so run the
+    install-permission-view task after turning permission_view on for an
+    existing database, or nested_groups on or off.
+"""
+from blazeweb.globals import settings
+import sqlalchemy as sa
+from sqlalchemy import Column, Integer, MetaData, Table, Unicode
+
+from compstack.sqlalchemy import db
+
+VIEW_NAME = 'auth_user_permissions'
+
+# a MetaData of its own so that create_all() doesn't make this a table
+view_meta = MetaData()
+
+user_permissions_view = Table(
+    VIEW_NAME, view_meta,
+    Column('user_id', Integer),
+    Column('permission_id', Integer),
+    Column('permission_name', Unicode(250)),
+    Column('login_id', Unicode(150)),
+    Column('user_approved', Integer),
+    Column('group_approved', Integer),
+    Column('group_denied', Integer),
+)
+
+
+def permission_view_enabled():
+    return bool(settings.components.auth.permission_view)
+
+
+# name -> (table, key columns, included columns) of the indexes that support
+# the view.  The assignment tables are already indexed by owner and
+# permission, and memberships by group; these cover membership lookups by
+# user and let the group aggregate read assignments from an index alone.
+VIEW_INDEXES = {
+    'ix_auth_user_group_map_user': ('auth_user_group_map', 'auth_user_id, auth_group_id', None),
+    'ix_auth_permission_assignments_groups_cover': (
+        'auth_permission_assignments_groups', 'group_id, permission_id', 'approved'
+    ),
+}
+
+
+def create_view_indexes():
+    inspector = sa.inspect(db.engine)
+    existing = set(
+        index['name']
+        for table in set(table for table, _, _ in VIEW_INDEXES.values())
+        for index in inspector.get_indexes(table)
+    )
+    for name, (table, columns, included) in sorted(VIEW_INDEXES.items()):
+        if name in existing:
+            continue
+        if included and db.engine.dialect.name in ('postgresql', 'mssql'):
+            sql = 'CREATE INDEX %s ON %s (%s) INCLUDE (%s)' % (name, table, columns, included)
+        elif included:
+            sql = 'CREATE INDEX %s ON %s (%s, %s)' % (name, table, columns, included)
+        else:
+            sql = 'CREATE INDEX %s ON %s (%s)' % (name, table, columns)
+        db.engine.execute(sql)
+
+
+def drop_permission_view():
+    if db.engine.dialect.name == 'mssql':
+        # no DROP VIEW IF EXISTS before SQL Server 2016
+        db.engine.execute("IF OBJECT_ID('%s', 'V') IS NOT NULL DROP VIEW %s"
+                          % (VIEW_NAME, VIEW_NAME))
+    else:
+        db.engine.execute('DROP VIEW IF EXISTS %s' % VIEW_NAME)
+
+
+def install_permission_view():
+    from compstack.auth.model.queries import build_users_permissions
+
+    drop_permission_view()
+    # views can't have an ORDER BY on SQL Server.  Wildcards are always
+    # resolved since they can be added after the view is installed.
+    definition = build_users_permissions(ordered=False, expand_wildcards=True).compile(
+        dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}
+    )
+    db.engine.execute('CREATE VIEW %s AS %s' % (VIEW_NAME, definition))
+    create_view_indexes()
@@ -0,0 +1,16 @@
+import sqlalchemy as sa
+
+from compstack.auth.model.metadata import group_permission_assignments, \
+    user_permission_assignments, user_groups
+from compstack.sqlalchemy import db
+
+
+def action_010_add_indexes():
+    inspector = sa.inspect(db.engine)
+    for table in (group_permission_assignments, user_permission_assignments, user_groups):
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            index.create(bind=db.engine)
+            print('added %s' % index.name)
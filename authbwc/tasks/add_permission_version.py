@@ -0,0 +1,14 @@
+import sqlalchemy as sa
+
+from compstack.sqlalchemy import db
+
+
+def action_010_add_column():
+    columns = [c['name'] for c in sa.inspect(db.engine).get_columns('auth_users')]
+    if 'permission_version' in columns:
+        print('column already present')
+        return
+    db.engine.execute(
+        'alter table auth_users add permission_version integer default 0 not null'
+    )
+    print('added auth_users.permission_version')
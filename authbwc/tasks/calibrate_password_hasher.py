@@ -0,0 +1,22 @@
+import multiprocessing
+
+from blazeweb.globals import settings
+
+from compstack.auth.lib.hashers import calibrate_hasher
+
+
+def action_010_calibrate():
+    config = settings.components.auth.password_hasher
+    name = config.name if config.name in ('pbkdf2', 'scrypt') else 'pbkdf2'
+    hasher, seconds = calibrate_hasher(name, config.target_ms / 1000.0)
+    cores = multiprocessing.cpu_count()
+    print('%s: %s' % (hasher.algorithm, ', '.join(str(p) for p in hasher.params())))
+    print('%.0f ms per hash, %.1f hashes/sec per core, %.1f hashes/sec on %d cores' % (
+        seconds * 1000, 1 / seconds, cores / seconds, cores))
+    if name == 'pbkdf2':
+        print('settings: password_hasher.name = \'pbkdf2\'; '
+              'password_hasher.iterations = %d' % hasher.iterations)
+    else:
+        print('settings: password_hasher.name = \'scrypt\'; '
+              'password_hasher.n = %d; password_hasher.r = %d; password_hasher.p = %d'
+              % (hasher.n, hasher.r, hasher.p))
@@ -1,12 +1,24 @@
 from blazeweb.tasks import attributes
 
 from compstack.auth.helpers import add_administrative_user
+from compstack.auth.model.epoch import current_auth_epoch, EPOCH_ROW_ID
+from compstack.auth.model.metadata import auth_epoch as tbl_epoch
 from compstack.auth.model.orm import Permission
+from compstack.auth.model.sqlview import install_permission_view, permission_view_enabled
+from compstack.sqlalchemy import db
+
+
+def action_20_permission_view():
+    if permission_view_enabled():
+        install_permission_view()
 
 
 @attributes('base-data')
 def action_30_base_data():
     Permission.add_iu(name=u'auth-manage')
+    if not current_auth_epoch():
+        db.sess.execute(tbl_epoch.insert().values(id=EPOCH_ROW_ID, epoch=1))
+        db.sess.commit()
 
 
 @attributes('+dev')
@@ -0,0 +1,5 @@
+from compstack.auth.model.sqlview import install_permission_view
+
+
+def action_010_install():
+    install_permission_view()
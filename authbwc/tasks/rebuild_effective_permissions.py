@@ -0,0 +1,7 @@
+from compstack.auth.model.engine import rebuild_effective_permissions
+from compstack.sqlalchemy import db
+
+
+def action_010_rebuild():
+    rebuild_effective_permissions()
+    db.sess.commit()
@@ -0,0 +1,7 @@
+from compstack.auth.model.nesting import rebuild_group_closure
+from compstack.sqlalchemy import db
+
+
+def action_010_rebuild():
+    rebuild_group_closure()
+    db.sess.commit()
@@ -0,0 +1,7 @@
+from compstack.auth.model.engine import sync_permission_wildcards
+from compstack.sqlalchemy import db
+
+
+def action_010_rebuild():
+    sync_permission_wildcards()
+    db.sess.commit()
@@ -5,7 +5,7 @@ from blazeweb.globals import settings, rg, user as session_user
 from blazeweb.routing import url_for, current_url
 from blazeweb.utils import redirect, abort
 from blazeweb.views import View, SecureView
-from formencode.validators import String
+from formencode.validators import Int, String
 import sqlalchemy as sa
 from sqlalchemy.exc import IntegrityError
 from compstack.auth.forms import ChangePasswordForm, NewPasswordForm, \
@@ -14,6 +14,8 @@ from compstack.auth.forms import ChangePasswordForm, NewPasswordForm, \
 from compstack.auth.grids import GroupGrid, PermissionGrid, UserGrid
 from compstack.auth.helpers import after_login_url, load_session_user, send_new_user_email, \
     send_change_password_email, send_reset_password_email
+from compstack.auth.lib.hashers import PasswordVerifyBusy
+from compstack.auth.lib.throttle import login_throttle
 from compstack.auth.model.orm import User as orm_User, Group as orm_Group, \
     Permission as orm_Permission
 from compstack.common.lib.views import CrudBase as CommonCrudBase, FormMixin
@@ -274,8 +276,34 @@ class PermissionMap(SecureView):
     def default(self, objid):
         dbuser = orm_User.get(objid)
         self.assign('dbuser', dbuser)
-        self.assign('result', dbuser.permission_map)
-        self.assign('permgroups', dbuser.permission_map_groups)
+        self.assign('result', dbuser.permission_explanation)
+        self.render_template()
+
+
+class PermissionHolders(SecureView):
+    per_page = 50
+
+    def init(self):
+        self.add_processor('after', Int)
+
+    def auth_pre(self):
+        self.require_all = 'auth-manage'
+
+    def default(self, objid, after=None):
+        permission = orm_Permission.get(objid)
+        if permission is None:
+            abort(404)
+        holders = orm_User.cm_permission_holders(
+            objid, after_id=after or 0, limit=self.per_page + 1
+        )
+        next_after = None
+        if len(holders) > self.per_page:
+            holders = holders[:self.per_page]
+            next_after = holders[-1]['user_id']
+        self.assign('permission', permission)
+        self.assign('holders', holders)
+        self.assign('next_after', next_after)
+        self.assign('is_first_page', not after)
         self.render_template()
 
 
@@ -285,10 +313,30 @@ class Login(View):
 
     def post(self):
         if self.form.is_valid():
-            user = orm_User.validate(
-                self.form.els.login_id.value,
-                self.form.els.password.value
-            )
+            login_id = self.form.els.login_id.value
+            throttle = login_throttle()
+            if throttle is not None and throttle.is_throttled(login_id, rg.request.remote_addr):
+                log.application('user login throttled; user login: %s; remote_ip: %s',
+                                login_id, rg.request.remote_addr)
+                session_user.add_message('error', 'Too many failed logins, please try again'
+                                         ' later.')
+                return self.default()
+            try:
+                user = orm_User.validate(
+                    login_id,
+                    self.form.els.password.value
+                )
+            except PasswordVerifyBusy:
+                log.application('user login turned away, verification pool full; '
+                                'user login: %s; remote_ip: %s',
+                                login_id, rg.request.remote_addr)
+                session_user.add_message('error', 'The server is busy, please try again.')
+                return self.default()
+            if throttle is not None:
+                if user:
+                    throttle.record_success(login_id)
+                else:
+                    throttle.record_failure(login_id, rg.request.remote_addr)
             if user:
                 if user.inactive:
                     session_user.add_message('error', 'That user is inactive.')
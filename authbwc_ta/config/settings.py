@@ -46,6 +46,12 @@ class Test(Default):
 
         self.db.url = 'sqlite://'
 
+        # keep hashing fast, the tests create a lot of users
+        self.components.auth.password_hasher.iterations = 1000
+
+        # the tests log in many times from the same address
+        self.components.auth.login_throttle.backend = None
+
         # uncomment this if you want to use a database you can inspect
         # from os import path
         # self.db.url = 'sqlite:///%s' % path.join(self.dirs.data, 'test_application.db')
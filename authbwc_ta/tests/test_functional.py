@@ -1,15 +1,18 @@
 from blazeutils import randchars
-from blazeweb.globals import ag
+from blazeweb.globals import ag, settings
 from blazeweb.testing import Client, TestApp
 import datetime
 import minimock
 from nose.tools import eq_
+import pickle
 import re
 import smtplib
 from werkzeug.wrappers import BaseResponse
 
 from compstack.auth.lib.testing import login_client_with_permissions, \
     login_client_as_user, create_user_with_permissions
+from compstack.auth.lib.hashers import PasswordVerifyBusy
+from compstack.auth.lib.throttle import reset_login_throttle
 from compstack.auth.model.orm import User, Group, Permission
 from compstack.sqlalchemy import db
 
@@ -649,6 +652,38 @@ class TestUserLogins(object):
         assert resp.status_code == 200, resp.status
         assert b'Login failed!' in resp.data
 
+    def test_throttled_login(self):
+        user = self.user
+        settings.components.auth.login_throttle.backend = 'memory'
+        settings.components.auth.login_throttle.per_login = 2
+        reset_login_throttle()
+        try:
+            client = Client(ag.wsgi_test_app, BaseResponse)
+            topost = {
+                'login_id': user.login_id,
+                'password': 'foobar',
+                'login-form-submit-flag': '1'
+            }
+            for _ in range(2):
+                resp = client.post('users/login', data=topost)
+                assert b'Login failed!' in resp.data
+
+            # turned away before the user is looked up, even with the right
+            # password
+            topost['password'] = user.text_password
+            minimock.mock('User.validate', raises=AssertionError('validate called'),
+                          tracker=None)
+            try:
+                resp = client.post('users/login', data=topost)
+            finally:
+                minimock.restore()
+            assert resp.status_code == 200, resp.status
+            assert b'Too many failed logins' in resp.data
+        finally:
+            settings.components.auth.login_throttle.backend = None
+            settings.components.auth.login_throttle.per_login = 10
+            reset_login_throttle()
+
     def test_inactive_login(self):
         user = self.user
         # set the user's inactive flag
@@ -687,6 +722,85 @@ class TestUserLogins(object):
         r = ta.post('/users/login', topost)
         assert len(r.user.perms) == 0
 
+    def test_mask_session_permissions(self):
+        settings.components.auth.session_permissions = 'mask'
+        try:
+            user = create_user_with_permissions(u'users-test1')
+            ta = TestApp(ag.wsgi_test_app)
+            topost = {
+                'login_id': user.login_id,
+                'password': user.text_password,
+                'login-form-submit-flag': '1'
+            }
+            r = ta.post('/users/login', topost)
+            perms = r.user.perms
+            eq_(perms.mask, user.permission_mask())
+            assert r.user.has_perm(u'users-test1')
+            assert not r.user.has_perm(u'auth-manage')
+            assert r.user.has_any_perm([u'auth-manage', u'users-test1'])
+            eq_(list(perms), [u'users-test1'])
+
+            # only the mask and its layout go into the session
+            r.user.add_perm(u'users-test2')
+            state = pickle.loads(pickle.dumps(perms)).__getstate__()
+            eq_(state, {'uid': user.id, 'mask': perms.mask, 'layout_key': perms.layout_key,
+                        'extra': set([u'users-test2'])})
+            assert u'users-test2' in perms
+        finally:
+            settings.components.auth.session_permissions = 'names'
+
+    def test_mask_rebuilt_for_new_layout(self):
+        settings.components.auth.session_permissions = 'mask'
+        try:
+            gone = Permission.add_iu(name=u'mask-test-gone')
+            Permission.add_iu(name=u'mask-test-kept')
+            user = create_user_with_permissions([u'mask-test-gone', u'mask-test-kept'])
+            ta = TestApp(ag.wsgi_test_app)
+            topost = {
+                'login_id': user.login_id,
+                'password': user.text_password,
+                'login-form-submit-flag': '1'
+            }
+            perms = ta.post('/users/login', topost).user.perms
+            eq_(set(perms), set([u'mask-test-gone', u'mask-test-kept']))
+            stored = pickle.dumps(perms)
+
+            # the bits after the deleted permission move down
+            Permission.delete(gone.id)
+            db.sess.commit()
+            perms = pickle.loads(stored)
+            eq_(set(perms), set([u'mask-test-kept']))
+            eq_(perms.mask, user.permission_mask())
+        finally:
+            settings.components.auth.session_permissions = 'names'
+
+    def test_stale_session_rebuilt(self):
+        settings.components.auth.check_session_version = True
+        try:
+            user = create_user_with_permissions()
+            ta = TestApp(ag.wsgi_test_app)
+            topost = {
+                'login_id': user.login_id,
+                'password': user.text_password,
+                'login-form-submit-flag': '1'
+            }
+            r = ta.post('/users/login', topost)
+            assert not r.user.has_perm(u'users-test1')
+            version = r.user.permission_version
+
+            user.set_permissions([Permission.get_by(name=u'users-test1').id])
+            db.sess.commit()
+            r = ta.get('/')
+            assert r.user.has_perm(u'users-test1')
+            eq_(r.user.permission_version, version + 1)
+
+            # deactivated users are logged out
+            User.edit(user.id, inactive_flag=True)
+            r = ta.get('/')
+            assert not r.user.is_authenticated
+        finally:
+            settings.components.auth.check_session_version = False
+
 
 class TestRecoverPassword(object):
 
@@ -877,6 +991,23 @@ class TestPasswordResetRequired(object):
         cls.userid = login_client_as_user(cls.c, cls.user.login_id, cls.user.text_password,
                                           validate_login_response=False)
 
+    def test_busy_verification(self):
+        topost = {
+            'change-password-form-submit-flag': u'submitted',
+            'old_password': self.user.text_password,
+            'password': '%s123' % self.user.text_password,
+            'password-confirm': '%s123' % self.user.text_password,
+            'submit': u'Submit'
+        }
+        minimock.mock('User.validate_password', raises=PasswordVerifyBusy(), tracker=None)
+        try:
+            req, resp = self.c.post('/users/profile', data=topost, follow_redirects=True)
+        finally:
+            minimock.restore()
+        eq_(resp.status_code, 200)
+        assert b'the server is busy' in resp.data, resp.data
+        assert b'<h1>Change Password</h1>' in resp.data
+
     def test_reset_required(self):
         req, resp = self.c.get('/users/profile', follow_redirects=True)
         assert '/users/profile' in req.url
@@ -894,6 +1025,55 @@ class TestPasswordResetRequired(object):
         assert b'<h1>Change Password</h1>' not in resp.data, resp.data
 
 
+class TestPermissionHolders(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.permission = Permission.testing_create()
+        cls.group = Group.testing_create()
+        cls.group.assign_permissions([cls.permission.id], [])
+        cls.direct = User.testing_create()
+        cls.direct.assign_permissions([cls.permission.id], [])
+        cls.via_group = User.testing_create(groups=cls.group)
+        cls.permission_id = cls.permission.id
+        cls.direct_id = cls.direct.id
+        cls.via_group_id = cls.via_group.id
+        db.sess.commit()
+        cls.tam = TestApp(ag.wsgi_test_app)
+        login_client_with_permissions(cls.tam, [u'auth-manage'])
+
+    def test_unauthorized(self):
+        ta = TestApp(ag.wsgi_test_app)
+        login_client_with_permissions(ta)
+        ta.get('/permissions/holders/{0}'.format(self.permission_id), status=403)
+
+    def test_page_load(self):
+        resp = self.tam.get('/permissions/holders/{0}'.format(self.permission_id))
+        d = resp.pyq
+        rows = d('table.datagrid tr td:last-child')
+        eq_([rows.eq(i).text() for i in range(len(rows))], ['direct', 'via group'])
+        assert str(d('a[href="/users/permissions/{0}"]'.format(self.via_group_id)))
+        assert 'next page' not in resp
+
+    def test_paging(self):
+        from compstack.auth.views import PermissionHolders
+        PermissionHolders.per_page = 1
+        try:
+            resp = self.tam.get('/permissions/holders/{0}'.format(self.permission_id))
+            assert str(resp.pyq('a[href="/users/permissions/{0}"]'.format(self.direct_id)))
+            assert 'after={0}'.format(self.direct_id) in resp
+            resp = self.tam.get('/permissions/holders/{0}?after={1}'.format(
+                self.permission_id, self.direct_id))
+            assert str(resp.pyq('a[href="/users/permissions/{0}"]'.format(self.via_group_id)))
+            assert not str(resp.pyq('a[href="/users/permissions/{0}"]'.format(self.direct_id)))
+            assert 'next page' not in resp
+        finally:
+            PermissionHolders.per_page = 50
+
+    def test_missing_permission(self):
+        self.tam.get('/permissions/holders/0', status=404)
+
+
 class TestPermissionMap(object):
 
     @classmethod
@@ -1,10 +1,18 @@
 import datetime as dt
+from blazeweb.globals import settings
+from blazeweb.testing import inrequest
+import minimock
 from nose.tools import eq_
 import sqlalchemy as sa
 
+from authbwc.lib.cache import permission_cache, request_memo, reset_permission_cache
+from authbwc.model.engine import permission_bit, permission_index, permission_registry, \
+    rebuild_effective_permissions
 from authbwc.model.orm import User, Permission, Group
+from authbwc.model.epoch import check_auth_epoch, current_auth_epoch
+from authbwc.model.signals import permissions_changed
 from authbwc.model.metadata import user_permission_assignments as upa, \
-    user_groups as tbl_ugm
+    user_groups as tbl_ugm, effective_permissions as tbl_ep, auth_epoch as tbl_epoch
 from compstack.sqlalchemy import db
 
 
@@ -69,6 +77,19 @@ class TestUser(object):
             u'users-test2': False, u'prof-test-1': False}
         eq_(u.permission_dict(su_override=False), expect)
 
+    def test_super_user_skips_permission_map(self):
+        u = User.testing_create()
+        u.super_user = True
+        db.sess.commit()
+        try:
+            minimock.mock('User.cm_permission_map', returns=[], tracker=None)
+            perms = u.permission_dict()
+            eq_(len(perms), Permission.count())
+            assert all(perms.values())
+            eq_(u.permission_mask(), (1 << Permission.count()) - 1)
+        finally:
+            minimock.restore()
+
     def test_has_perm(self):
         u = User.testing_create()
         p = Permission.get_by(name=u'auth-manage')
@@ -97,6 +118,26 @@ class TestUser(object):
         # discount super user
         eq_(u.has_permission(u'ugp_denied', su_override=False), False)
 
+    def test_set_permissions_changes(self):
+        u = User.testing_create()
+        p1, p2, p3 = [Permission.get_by(name=name).id
+                      for name in (u'users-test1', u'users-test2', u'auth-manage')]
+
+        eq_(u.set_permissions([p1, p2]), (sorted([p1, p2]), [], []))
+
+        # nothing to write, so the epoch stays put
+        epoch = current_auth_epoch()
+        eq_(u.set_permissions([p1, p2]).permission_ids, set())
+        eq_(current_auth_epoch(), epoch)
+
+        # the approved flag is flipped in place
+        eq_(u.set_permissions([p2], approved=False), ([], [p2], []))
+        eq_(u.assigned_permission_ids, ([p1], [p2]))
+
+        changes = u.assign_permissions([p1, p3], [])
+        eq_(changes, ([p3], [], [p2]))
+        eq_(changes.permission_ids, set([p2, p3]))
+
     def test_testing_create_args(self):
         u = User.testing_create(loginid=u'foobar')
         eq_(u.login_id, u'foobar')
@@ -233,6 +274,15 @@ class TestGroups(object):
         eq_(u.groups[0].id, g2.id)
         eq_(Group.count(), 1)
 
+    def test_assign_permissions_changes(self):
+        g = Group.testing_create()
+        p1, p2, p3 = [Permission.get_by(name=name).id
+                      for name in (u'users-test1', u'users-test2', u'auth-manage')]
+        eq_(g.assign_permissions([p1], [p2]), (sorted([p1, p2]), [], []))
+        eq_(g.assign_permissions([p1, p2], [p3]), ([p3], [p2], []))
+        eq_(g.assign_permissions([p1], []), ([], [], sorted([p2, p3])))
+        eq_(g.assigned_permission_ids, ([p1], []))
+
     def test_group_delete_doesnt_affect_user(self):
         # create group
         g1 = Group.testing_create()
@@ -264,3 +314,814 @@ class TestGroups(object):
 
         # shouldn't be any mappings left
         eq_(db.sess.query(tbl_ugm).count(), 0)
+
+
+class TestPermissionEngine(object):
+
+    @classmethod
+    def setup_class(cls):
+        settings.components.auth.permission_engine = 'memory'
+
+    @classmethod
+    def teardown_class(cls):
+        settings.components.auth.permission_engine = 'sql'
+        permission_index.clear()
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+        permission_index.clear()
+
+    def sql_permission_dict(self, user, su_override=True):
+        settings.components.auth.permission_engine = 'sql'
+        try:
+            return user.permission_dict(su_override=su_override)
+        finally:
+            settings.components.auth.permission_engine = 'memory'
+
+    def test_precedence_matches_sql(self):
+        g1 = Group.testing_create()
+        g2 = Group.testing_create()
+        Group.assign_permissions_by_name(g1.name, (u'ugp_approved', u'users-test1',
+                                                   u'users-test2'))
+        Group.assign_permissions_by_name(g2.name, None, u'users-test2')
+        u = User.testing_create(approved_perms=u'prof-test-1', denied_perms=u'users-test1',
+                                groups=[g1, g2])
+
+        pdict = u.permission_dict()
+        eq_(pdict, self.sql_permission_dict(u))
+        eq_(pdict[u'ugp_approved'], True)
+        eq_(pdict[u'users-test1'], False)
+        eq_(pdict[u'users-test2'], False)
+        eq_(pdict[u'prof-test-1'], True)
+        eq_(pdict[u'prof-test-2'], False)
+
+        eq_(u.has_permission(u'ugp_approved', u'prof-test-1'), True)
+        eq_(u.has_permission(u'users-test2'), False)
+
+    def test_wildcards(self):
+        for name in (u'wc-reports-*', u'wc-reports-sales-*', u'wc-reports-sales-view',
+                     u'wc-reports-sales-export', u'wc-reports-hr-view'):
+            Permission.add_iu(name=name)
+        g = Group.testing_create()
+        Group.assign_permissions_by_name(g.name, u'wc-reports-*')
+        u = User.testing_create(denied_perms=u'wc-reports-sales-*', groups=[g])
+        u2 = User.testing_create(approved_perms=u'wc-reports-sales-view',
+                                 denied_perms=u'wc-reports-sales-*')
+        permission_index.clear()
+
+        eq_(u.has_permission(u'wc-reports-hr-view'), True)
+        # the user's denial beats the group's approval
+        eq_(u.has_permission(u'wc-reports-sales-view'), False)
+        eq_(u.has_permission(u'wc-reports-sales-export'), False)
+        # an assignment of the permission itself beats the wildcard
+        eq_(u2.has_permission(u'wc-reports-sales-view'), True)
+        eq_(u2.has_permission(u'wc-reports-sales-export'), False)
+
+        # the longer wildcard wins for the same user
+        u3 = User.testing_create(approved_perms=u'wc-reports-sales-*',
+                                 denied_perms=u'wc-reports-*')
+        permission_index.clear()
+        eq_(u3.has_permission(u'wc-reports-sales-export'), True)
+        eq_(u3.has_permission(u'wc-reports-hr-view'), False)
+
+    def test_wildcards_in_every_engine(self):
+        for name in (u'zz-rep-*', u'zz-rep-view', u'zz-rep-export', u'zz-rep-sales-*',
+                     u'zz-rep-sales-view'):
+            Permission.add_iu(name=name)
+        g = Group.testing_create()
+        Group.assign_permissions_by_name(g.name, u'zz-rep-*')
+        u1 = User.testing_create(denied_perms=u'zz-rep-sales-*', groups=[g])
+        u2 = User.testing_create(approved_perms=u'zz-rep-*', denied_perms=u'zz-rep-export')
+        db.sess.commit()
+        expected = {
+            u1.id: {u'zz-rep-view': True, u'zz-rep-export': True, u'zz-rep-sales-view': False},
+            u2.id: {u'zz-rep-view': True, u'zz-rep-export': False, u'zz-rep-sales-view': True},
+        }
+        view_id = Permission.get_by(name=u'zz-rep-view').id
+
+        for engine in ('memory', 'sql', 'table'):
+            settings.components.auth.permission_engine = engine
+            try:
+                rebuild_effective_permissions()
+                permission_index.clear()
+                for uid, approvals in expected.items():
+                    perm_map = dict((row['permission_name'], row['resulting_approval'])
+                                    for row in User.cm_permission_map(uid))
+                    explanation = dict((row['permission_name'], row['resulting_approval'])
+                                       for row in User.cm_permission_explanation(uid))
+                    for name, approved in approvals.items():
+                        eq_(User.cm_has_permission(uid, name), approved, (engine, uid, name))
+                        eq_(bool(perm_map[name]), approved, (engine, uid, name))
+                        eq_(bool(explanation[name]), approved, (engine, uid, name))
+                eq_([h['user_id'] for h in User.cm_permission_holders(view_id)],
+                    [u1.id, u2.id], engine)
+                eq_(User.get_by_permissions(u'zz-rep-sales-view', ids_only=True), [u2.id],
+                    engine)
+                eq_(User.cm_has_permission_many([u1.id, u2.id], u'zz-rep-export'),
+                    {u1.id: True, u2.id: False}, engine)
+            finally:
+                settings.components.auth.permission_engine = 'memory'
+
+    def test_wildcards_in_effective_permissions(self):
+        wildcard = Permission.add_iu(name=u'zz-eff-*')
+        u = User.testing_create()
+        settings.components.auth.permission_engine = 'table'
+        try:
+            rebuild_effective_permissions()
+            User.bulk_grant([u.id], [wildcard.id])
+            Permission.add_iu(name=u'zz-eff-view')
+            eq_(u.has_permission(u'zz-eff-view'), True)
+            User.bulk_revoke([u.id], [wildcard.id])
+            eq_(u.has_permission(u'zz-eff-view'), False)
+        finally:
+            settings.components.auth.permission_engine = 'memory'
+
+    def test_super_user(self):
+        u = User.testing_create()
+        User.edit(u.id, super_user=True)
+        assert all(u.permission_dict().values())
+        eq_(u.permission_dict(su_override=False), self.sql_permission_dict(u, False))
+
+    def test_unknown_user(self):
+        eq_(User.cm_permission_dict(0), {})
+        eq_(User.cm_has_permission(0, u'auth-manage'), False)
+
+    def test_write_clears_index(self):
+        u = User.testing_create()
+        eq_(u.has_permission(u'auth-manage'), False)
+        u.set_permissions([Permission.get_by(name=u'auth-manage').id])
+        db.sess.commit()
+        eq_(u.has_permission(u'auth-manage'), True)
+
+    def test_delete_clears_index(self):
+        u = User.testing_create(approved_perms=u'auth-manage')
+        uid = u.id
+        eq_(User.cm_has_permission(uid, u'auth-manage'), True)
+        User.delete(uid)
+        db.sess.commit()
+        eq_(User.cm_has_permission(uid, u'auth-manage'), False)
+
+    def test_rollback_clears_index(self):
+        u = User.testing_create()
+        eq_(u.has_permission(u'auth-manage'), False)
+        u.set_permissions([Permission.get_by(name=u'auth-manage').id])
+        # the index is loaded from the uncommitted assignment
+        permission_index.clear()
+        eq_(u.has_permission(u'auth-manage'), True)
+        db.sess.rollback()
+        eq_(u.has_permission(u'auth-manage'), False)
+
+    def test_get_by_permissions(self):
+        g = Group.testing_create()
+        Group.assign_permissions_by_name(g.name, u'ugp_approved')
+        u1 = User.testing_create(approved_perms=u'ugp_approved')
+        u2 = User.testing_create(groups=g)
+        User.testing_create(denied_perms=u'ugp_approved', groups=g)
+        eq_(User.get_by_permissions(u'ugp_approved'), [u1, u2])
+        eq_(User.get_by_permissions(u'foobar'), [])
+
+    def test_permission_mask(self):
+        p1 = Permission.get_by(name=u'auth-manage')
+        p2 = Permission.get_by(name=u'prof-test-1')
+        u = User.testing_create(approved_perms=[u'auth-manage', u'prof-test-1'],
+                                denied_perms=u'prof-test-2')
+        expect = permission_bit(p1.id) | permission_bit(p2.id)
+        eq_(u.permission_mask(), expect)
+        settings.components.auth.permission_engine = 'sql'
+        try:
+            eq_(u.permission_mask(), expect)
+        finally:
+            settings.components.auth.permission_engine = 'memory'
+
+        eq_(u.has_permission(u'auth-manage', u'prof-test-1'), True)
+        eq_(u.has_permission(u'auth-manage', u'prof-test-2'), False)
+        eq_(u.has_permission(u'auth-manage', u'foobar'), False)
+
+
+class TestEffectivePermissionsTable(object):
+
+    @classmethod
+    def setup_class(cls):
+        settings.components.auth.permission_engine = 'table'
+
+    @classmethod
+    def teardown_class(cls):
+        settings.components.auth.permission_engine = 'sql'
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+
+    def effective_ids(self, user):
+        return set(
+            r[0] for r in
+            db.sess.query(tbl_ep.c.permission_id).filter(tbl_ep.c.user_id == user.id)
+        )
+
+    def expected_ids(self, user):
+        settings.components.auth.permission_engine = 'sql'
+        try:
+            return set(
+                pmap['permission_id'] for pmap in user.permission_map
+                if pmap['resulting_approval']
+            )
+        finally:
+            settings.components.auth.permission_engine = 'table'
+
+    def test_user_assignments(self):
+        p1 = Permission.get_by(name=u'auth-manage')
+        u = User.testing_create(approved_perms=[u'auth-manage', u'prof-test-1'],
+                                denied_perms=u'prof-test-2')
+        eq_(self.effective_ids(u), self.expected_ids(u))
+        eq_(u.has_permission(u'auth-manage', u'prof-test-1'), True)
+        eq_(u.has_permission(u'prof-test-2'), False)
+
+        u.set_permissions([p1.id], False)
+        eq_(self.effective_ids(u), self.expected_ids(u))
+        eq_(u.has_permission(u'auth-manage'), False)
+
+    def test_group_changes(self):
+        g1 = Group.testing_create()
+        g2 = Group.testing_create()
+        u1 = User.testing_create(groups=g1)
+        u2 = User.testing_create(denied_perms=u'users-test1')
+        approved = [
+            Permission.get_by(name=name).id for name in (u'users-test1', u'users-test2')
+        ]
+        denied = [Permission.get_by(name=u'users-test2').id]
+
+        Group.edit(g1.id, assigned_users=[u1.id, u2.id], approved_permissions=approved)
+        eq_(self.effective_ids(u1), self.expected_ids(u1))
+        eq_(self.effective_ids(u2), self.expected_ids(u2))
+        eq_(u1.has_permission(u'users-test1', u'users-test2'), True)
+        eq_(u2.has_permission(u'users-test2'), True)
+        eq_(u2.has_permission(u'users-test1'), False)
+
+        User.edit(u1.id, assigned_groups=[g1.id, g2.id])
+        Group.edit(g2.id, assigned_users=[u1.id], denied_permissions=denied)
+        eq_(self.effective_ids(u1), self.expected_ids(u1))
+        eq_(u1.has_permission(u'users-test2'), False)
+
+        # removing a member
+        Group.edit(g1.id, assigned_users=[u1.id], approved_permissions=approved)
+        eq_(self.effective_ids(u2), set())
+
+        # deleting a group
+        Group.delete(g1.id)
+        eq_(self.effective_ids(u1), set())
+
+    def test_get_by_permissions(self):
+        g = Group.testing_create()
+        Group.assign_permissions_by_name(g.name, u'ugp_approved')
+        u1 = User.testing_create(approved_perms=u'ugp_approved')
+        u2 = User.testing_create(groups=g)
+        User.testing_create(denied_perms=u'ugp_approved', groups=g)
+        eq_(User.get_by_permissions(u'ugp_approved'), [u1, u2])
+
+    def test_permission_delete(self):
+        p = Permission.testing_create()
+        u = User.testing_create(approved_perms=p.name)
+        eq_(self.effective_ids(u), set([p.id]))
+        Permission.delete(p.id)
+        eq_(self.effective_ids(u), set())
+
+    def test_super_user_and_unknown_user(self):
+        u = User.testing_create()
+        User.edit(u.id, super_user=True)
+        assert all(u.permission_dict().values())
+        assert not any(u.permission_dict(su_override=False).values())
+        eq_(User.cm_permission_dict(0), {})
+
+    def test_rebuild(self):
+        u = User.testing_create(approved_perms=u'auth-manage')
+        db.sess.execute(tbl_ep.delete())
+        eq_(self.effective_ids(u), set())
+        rebuild_effective_permissions()
+        eq_(self.effective_ids(u), self.expected_ids(u))
+
+
+class TestAuthEpoch(object):
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+
+    def test_write_paths_bump(self):
+        epoch = current_auth_epoch()
+        u = User.testing_create()
+        assert current_auth_epoch() > epoch
+
+        epoch = current_auth_epoch()
+        g = Group.testing_create()
+        assert current_auth_epoch() > epoch
+
+        epoch = current_auth_epoch()
+        User.edit(u.id, assigned_groups=[g.id])
+        assert current_auth_epoch() > epoch
+
+        epoch = current_auth_epoch()
+        Group.delete(g.id)
+        assert current_auth_epoch() > epoch
+
+    def test_cached_attributes_bump(self):
+        p = Permission.add_iu(name=u'zz-epoch-old')
+        u = User.testing_create()
+        db.sess.commit()
+
+        epoch = current_auth_epoch()
+        p.name = u'zz-epoch-new'
+        db.sess.commit()
+        assert current_auth_epoch() > epoch
+
+        epoch = current_auth_epoch()
+        u.super_user = True
+        db.sess.commit()
+        assert current_auth_epoch() > epoch
+
+        epoch = current_auth_epoch()
+        db.sess.query(Permission).filter_by(id=p.id).update(
+            {Permission.name: u'zz-epoch-bulk'}, synchronize_session='fetch'
+        )
+        db.sess.commit()
+        assert current_auth_epoch() > epoch
+        eq_(permission_registry.ids_for_names(u'zz-epoch-bulk'), [p.id])
+
+        # columns that no cached data is built from leave it alone
+        epoch = current_auth_epoch()
+        u.email_address = u'%s@example.org' % u.login_id
+        db.sess.commit()
+        eq_(current_auth_epoch(), epoch)
+
+    def test_check_drops_index(self):
+        settings.components.auth.permission_engine = 'memory'
+        try:
+            check_auth_epoch()
+            eq_(check_auth_epoch(), False)
+            u = User.testing_create()
+            eq_(check_auth_epoch(), True)
+            eq_(u.has_permission(u'auth-manage'), False)
+            assert permission_index._data is not None
+
+            # simulate a change from another process
+            db.sess.execute(tbl_epoch.update().values(epoch=tbl_epoch.c.epoch + 1))
+            db.sess.commit()
+            eq_(check_auth_epoch(), True)
+            assert permission_index._data is None
+        finally:
+            settings.components.auth.permission_engine = 'sql'
+
+
+class TestHasPermissionMany(object):
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+
+    def test_matches_single_checks(self):
+        g = Group.testing_create()
+        Group.assign_permissions_by_name(g.name, (u'users-test1', u'users-test2'))
+        u1 = User.testing_create(approved_perms=[u'users-test1', u'users-test2'])
+        u2 = User.testing_create(groups=g)
+        u3 = User.testing_create(groups=g, denied_perms=u'users-test2')
+        u4 = User.testing_create()
+        User.edit(u4.id, super_user=True)
+        uids = [u1.id, u2.id, u3.id, u4.id, 0]
+
+        for engine in ('sql', 'memory', 'table'):
+            settings.components.auth.permission_engine = engine
+            try:
+                rebuild_effective_permissions()
+                permission_index.clear()
+                for perms in ((u'users-test1',), (u'users-test1', u'users-test2'),
+                              (u'users-test1', u'foobar')):
+                    for su_override in (True, False):
+                        expect = dict(
+                            (uid, User.cm_has_permission(uid, *perms, su_override=su_override))
+                            for uid in uids
+                        )
+                        result = User.cm_has_permission_many(
+                            uids, *perms, su_override=su_override, chunk_size=2
+                        )
+                        eq_(result, expect, (engine, perms, su_override))
+            finally:
+                settings.components.auth.permission_engine = 'sql'
+
+        eq_(User.cm_has_permission_many(uids, u'users-test2'),
+            {u1.id: True, u2.id: True, u3.id: False, u4.id: True, 0: False})
+
+
+class TestGetByPermissions(object):
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+
+    def test_options(self):
+        g = Group.testing_create()
+        Group.assign_permissions_by_name(g.name, (u'users-test1', u'users-test2'))
+        u1 = User.testing_create(approved_perms=[u'users-test1', u'users-test2'], groups=g)
+        u2 = User.testing_create(approved_perms=u'users-test1')
+        u3 = User.testing_create(groups=g, denied_perms=u'users-test2')
+        User.testing_create(denied_perms=[u'users-test1', u'users-test2'], groups=g)
+        perms = [u'users-test1', u'users-test2']
+
+        for engine in ('sql', 'memory', 'table'):
+            settings.components.auth.permission_engine = engine
+            try:
+                rebuild_effective_permissions()
+                permission_index.clear()
+                # users matching several permissions are only returned once
+                eq_(User.get_by_permissions(perms), [u1, u2, u3], engine)
+                eq_(User.get_by_permissions(perms, match='all'), [u1], engine)
+                eq_(User.get_by_permissions(perms + [u'foobar'], match='all'), [], engine)
+                eq_(User.get_by_permissions(perms, ids_only=True), [u1.id, u2.id, u3.id],
+                    engine)
+
+                result = User.get_by_permissions(perms, stream=True, chunk_size=1)
+                assert not isinstance(result, list)
+                eq_(list(result), [u1, u2, u3], engine)
+                result = User.get_by_permissions(perms, ids_only=True, stream=True)
+                eq_(list(result), [u1.id, u2.id, u3.id], engine)
+            finally:
+                settings.components.auth.permission_engine = 'sql'
+
+    def test_single_user_query(self):
+        users = [User.testing_create(approved_perms=u'users-test1') for _ in range(3)]
+        db.sess.commit()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if 'FROM auth_users' in statement:
+                statements.append(statement)
+        sa.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            # no chunked reloads while the rows are being read
+            eq_(list(User.get_by_permissions(u'users-test1', stream=True, chunk_size=1)),
+                users)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', record)
+        eq_(len(statements), 1)
+
+    def test_bad_match(self):
+        try:
+            User.get_by_permissions(u'users-test1', match='some')
+            assert False
+        except ValueError as e:
+            assert 'match must be' in str(e)
+
+
+class TestPermissionCache(object):
+
+    @classmethod
+    def setup_class(cls):
+        settings.components.auth.permission_cache.backend = 'memory'
+        reset_permission_cache()
+
+    @classmethod
+    def teardown_class(cls):
+        settings.components.auth.permission_cache.backend = None
+        reset_permission_cache()
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+
+    def test_cached_and_invalidated(self):
+        cache = permission_cache()
+        u = User.testing_create()
+        hits, misses = cache.hits, cache.misses
+
+        eq_(u.has_permission(u'auth-manage'), False)
+        eq_(cache.misses, misses + 1)
+        eq_(u.has_permission(u'auth-manage'), False)
+        eq_(cache.hits, hits + 1)
+        # su_override is part of the key
+        u.permission_dict(su_override=False)
+        eq_(cache.misses, misses + 2)
+
+        # committed writes clear the cache
+        u.set_permissions([Permission.get_by(name=u'auth-manage').id])
+        db.sess.commit()
+        eq_(len(cache), 0)
+        eq_(u.has_permission(u'auth-manage'), True)
+
+        # callers can't change what is cached
+        u.permission_dict()[u'auth-manage'] = False
+        eq_(u.has_permission(u'auth-manage'), True)
+
+        # so does deleting the permission
+        p = Permission.testing_create()
+        u.set_permissions([p.id])
+        db.sess.commit()
+        eq_(u.has_permission(p.name), True)
+        Permission.delete(p.id)
+        db.sess.commit()
+        eq_(len(cache), 0)
+        eq_(u.has_permission(p.name), False)
+
+
+class TestBulkAssignments(object):
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+        self.p1, self.p2 = [Permission.get_by(name=name).id
+                            for name in (u'users-test1', u'users-test2')]
+
+    def test_users(self):
+        u1 = User.testing_create()
+        u2 = User.testing_create()
+        ids = [u1.id, u2.id]
+
+        eq_(User.bulk_grant(ids, [self.p1, self.p2], chunk_size=1), 4)
+        assert u1.has_permission(u'users-test1', u'users-test2')
+        assert u2.has_permission(u'users-test1', u'users-test2')
+        # already granted
+        eq_(User.bulk_grant(ids, [self.p1]), 0)
+
+        # the existing row is flipped and the other assignment is kept
+        eq_(User.bulk_deny([u1.id], [self.p1]), 1)
+        eq_(u1.assigned_permission_ids, ([self.p2], [self.p1]))
+
+        eq_(User.bulk_revoke(ids, [self.p1]), 2)
+        eq_(u1.assigned_permission_ids, ([self.p2], []))
+        eq_(u2.assigned_permission_ids, ([self.p2], []))
+
+        # unknown users are skipped
+        eq_(User.bulk_grant([u1.id + u2.id + 100], [self.p1]), 0)
+
+    def test_groups(self):
+        g1 = Group.testing_create()
+        g2 = Group.testing_create()
+        u = User.testing_create(groups=[g1])
+        version = u.permission_version
+
+        eq_(Group.bulk_grant([g1.id, g2.id], [self.p1]), 2)
+        assert u.has_permission(u'users-test1')
+        eq_(User.cm_permission_version(u.id), version + 1)
+
+        eq_(Group.bulk_deny([g2.id], [self.p1]), 1)
+        eq_(g2.assigned_permission_ids, ([], [self.p1]))
+        eq_(Group.bulk_revoke([g1.id], [self.p1]), 1)
+        assert not u.has_permission(u'users-test1')
+
+
+class TestPermissionsChangedSignal(object):
+
+    def setUp(self):
+        self.sent = []
+        permissions_changed.connect(self.receive)
+        self.p1, self.p2 = [Permission.get_by(name=name).id
+                            for name in (u'users-test1', u'users-test2')]
+
+    def tearDown(self):
+        permissions_changed.disconnect(self.receive)
+        db.sess.rollback()
+
+    def receive(self, sender, user_ids, group_ids, permission_ids):
+        self.sent.append((set(user_ids), set(group_ids), set(permission_ids)))
+
+    def test_coalesced_per_commit(self):
+        u = User.testing_create()
+        del self.sent[:]
+
+        u.set_permissions([self.p1], True)
+        u.set_permissions([self.p2], False)
+        eq_(self.sent, [])
+        db.sess.commit()
+        eq_(self.sent, [(set([u.id]), set(), set([self.p1, self.p2]))])
+
+        # nothing written, nothing sent
+        u.set_permissions([self.p1], True)
+        db.sess.commit()
+        eq_(len(self.sent), 1)
+
+    def test_rollback(self):
+        u = User.testing_create()
+        del self.sent[:]
+        u.set_permissions([self.p1], True)
+        db.sess.rollback()
+        db.sess.commit()
+        eq_(self.sent, [])
+
+    def test_groups(self):
+        u = User.testing_create()
+        del self.sent[:]
+        g = Group.add(name=u'signal-group', assigned_users=[u.id],
+                      approved_permissions=[self.p1])
+        eq_(self.sent, [(set([u.id]), set([g.id]), set([self.p1]))])
+
+        Group.delete(g.id)
+        eq_(self.sent[-1], (set([u.id]), set([g.id]), set()))
+
+    def test_user_groups_changed(self):
+        g1 = Group.testing_create()
+        g2 = Group.testing_create()
+        u = User.testing_create(groups=[g1])
+        db.sess.commit()
+        del self.sent[:]
+        # the group left is reported along with the group joined
+        User.edit(u.id, assigned_groups=[g2.id])
+        db.sess.commit()
+        eq_(self.sent, [(set([u.id]), set([g1.id, g2.id]), set())])
+
+    def test_user_delete(self):
+        u = User.testing_create()
+        del self.sent[:]
+        User.delete(u.id)
+        eq_(self.sent, [(set([u.id]), set(), set())])
+
+    def test_bulk_deletes(self):
+        u1 = User.testing_create()
+        u2 = User.testing_create()
+        g = Group.add(name=u'signal-bulk', assigned_users=[u2.id])
+        del self.sent[:]
+        User.delete_where(User.id == u1.id)
+        eq_(self.sent, [(set([u1.id]), set(), set())])
+        Group.delete_where(Group.id == g.id)
+        eq_(self.sent[-1], (set([u2.id]), set([g.id]), set()))
+
+    def test_permission_delete(self):
+        p = Permission.add(name=u'signal-perm')
+        g = Group.testing_create()
+        u1 = User.testing_create(approved_perms=u'signal-perm')
+        u2 = User.testing_create(groups=[g])
+        Group.assign_permissions_by_name(g.name, u'signal-perm')
+        db.sess.commit()
+        del self.sent[:]
+        Permission.delete(p.id)
+        db.sess.commit()
+        eq_(self.sent, [(set([u1.id, u2.id]), set([g.id]), set([p.id]))])
+
+
+class TestNestedGroups(object):
+
+    @classmethod
+    def setup_class(cls):
+        settings.components.auth.nested_groups = True
+
+    @classmethod
+    def teardown_class(cls):
+        settings.components.auth.nested_groups = False
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+        self.perm_id = Permission.get_by(name=u'users-test1').id
+
+    def check_engines(self, user, expected):
+        eq_(user.has_permission(u'users-test1'), expected)
+        try:
+            settings.components.auth.permission_engine = 'memory'
+            permission_index.clear()
+            eq_(user.has_permission(u'users-test1'), expected)
+            settings.components.auth.permission_engine = 'table'
+            rebuild_effective_permissions()
+            eq_(user.has_permission(u'users-test1'), expected)
+        finally:
+            settings.components.auth.permission_engine = 'sql'
+
+    def test_inherited_through_levels(self):
+        top = Group.add(name=u'nested-top', approved_permissions=[self.perm_id])
+        middle = Group.add(name=u'nested-middle', assigned_groups=[top.id])
+        bottom = Group.add(name=u'nested-bottom', assigned_groups=[middle.id])
+        u = User.testing_create(groups=[bottom])
+        self.check_engines(u, True)
+        eq_(sorted(Group.cm_user_ids(top.id)), [u.id])
+        eq_(bottom.parent_group_ids, [middle.id])
+
+        # a denial in between wins like any other group denial
+        Group.edit(middle.id, assigned_groups=[top.id], denied_permissions=[self.perm_id])
+        self.check_engines(u, False)
+
+        # taking the middle group out of the top one
+        Group.edit(middle.id, assigned_groups=[])
+        eq_(Group.cm_user_ids(top.id), [])
+        self.check_engines(u, False)
+
+    def test_delete_nested_group(self):
+        top = Group.add(name=u'nested-top', approved_permissions=[self.perm_id])
+        middle = Group.add(name=u'nested-middle', assigned_groups=[top.id])
+        bottom = Group.add(name=u'nested-bottom', assigned_groups=[middle.id])
+        u = User.testing_create(groups=[bottom])
+        assert u.has_permission(u'users-test1')
+        Group.delete(middle.id)
+        assert not u.has_permission(u'users-test1')
+
+    def test_groups_created_outside_update(self):
+        g = Group(name=u'nested-orm')
+        db.sess.add(g)
+        db.sess.flush()
+        g.assign_permissions([self.perm_id], [])
+        u = User.testing_create(groups=[g])
+        self.check_engines(u, True)
+        eq_(Group.cm_user_ids(g.id), [u.id])
+
+    def test_cycle(self):
+        top = Group.add(name=u'nested-top')
+        bottom = Group.add(name=u'nested-bottom', assigned_groups=[top.id])
+        try:
+            Group.edit(top.id, assigned_groups=[bottom.id])
+            assert False, 'expected ValueError'
+        except ValueError as e:
+            eq_(str(e), 'group %s can not be nested in itself' % top.id)
+
+    def test_off(self):
+        top = Group.add(name=u'nested-top', approved_permissions=[self.perm_id])
+        bottom = Group.add(name=u'nested-bottom', assigned_groups=[top.id])
+        u = User.testing_create(groups=[bottom])
+        settings.components.auth.nested_groups = False
+        try:
+            assert not u.has_permission(u'users-test1')
+        finally:
+            settings.components.auth.nested_groups = True
+
+
+class TestRequestMemo(object):
+
+    @classmethod
+    def teardown_class(cls):
+        # inrequest() doesn't clean up the request level session like a
+        # real response cycle does
+        db.Session.remove()
+
+    def setUp(self):
+        User.delete_all()
+        Group.delete_all()
+
+    def test_no_request(self):
+        eq_(request_memo(), None)
+
+    @inrequest('/')
+    def test_memoized_and_cleared(self):
+        u = User.testing_create()
+        eq_(u.has_permission(u'auth-manage'), False)
+        memo = request_memo()
+        assert ('permission_dict', u.id, True) in memo
+
+        assert ('permission_mask', u.id, True) in memo
+
+        # served from the memo, so the database isn't consulted again; the
+        # mask is built from the memoized dict
+        memo[('permission_dict', u.id, True)] = {u'auth-manage': True}
+        del memo[('permission_mask', u.id, True)]
+        eq_(u.has_permission(u'auth-manage'), True)
+
+        # writes committed during the request clear it
+        u.set_permissions([Permission.get_by(name=u'auth-manage').id])
+        db.sess.commit()
+        eq_(memo, {})
+        eq_(u.has_permission(u'auth-manage'), True)
+
+    @inrequest('/')
+    def test_mask_in_every_engine(self):
+        Permission.add_iu(name=u'zz-mask-a')
+        Permission.add_iu(name=u'zz-mask-b')
+        u = User.testing_create(approved_perms=u'zz-mask-a')
+        su = User.testing_create()
+        su.super_user = True
+        db.sess.commit()
+        default_engine = settings.components.auth.permission_engine
+        for engine in ('sql', 'table'):
+            settings.components.auth.permission_engine = engine
+            try:
+                rebuild_effective_permissions()
+                request_memo().clear()
+                eq_(u.has_permission(u'zz-mask-a'), True, engine)
+                eq_(u.has_permission(u'zz-mask-a', u'zz-mask-b'), False, engine)
+                eq_(u.has_permission(u'zz-mask-nope'), False, engine)
+                eq_(su.has_permission(u'zz-mask-a', u'zz-mask-b'), True, engine)
+                eq_(su.has_permission(u'zz-mask-b', su_override=False), False, engine)
+
+                # the checks are answered by the memoized mask
+                layout, mask = request_memo()[('permission_mask', u.id, True)]
+                eq_(mask, layout.mask_for_names(u'zz-mask-a'))
+                request_memo()[('permission_mask', u.id, True)] = \
+                    (layout, layout.mask_for_names([u'zz-mask-a', u'zz-mask-b']))
+                eq_(u.has_permission(u'zz-mask-b'), True, engine)
+            finally:
+                settings.components.auth.permission_engine = default_engine
+
+    @inrequest('/')
+    def test_permission_dict_copies(self):
+        u = User.testing_create()
+        pdict = u.permission_dict()
+        memoized = request_memo()[('permission_dict', u.id, True)]
+        assert pdict is not memoized
+        eq_(pdict, memoized)
+
+        # callers can change their copy without touching the memo
+        pdict[u'auth-manage'] = True
+        eq_(u.has_permission(u'auth-manage'), False)
+
+    @inrequest('/')
+    def test_super_user(self):
+        u = User.testing_create()
+        eq_(User.cm_is_super_user(u.id), False)
+        eq_(request_memo()[('super_user', u.id)], False)
+
+        # resolving permissions records the flag too
+        u2 = User.testing_create()
+        u2.permission_dict()
+        eq_(request_memo()[('super_user', u2.id)], False)
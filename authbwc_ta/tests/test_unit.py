@@ -1,17 +1,43 @@
 import datetime
+import hashlib
+import os
+import shutil
+import tempfile
 
 from blazeweb.globals import settings
 from blazeweb.testing import inrequest
 from blazeutils import randchars
+from nose import SkipTest
 from nose.tools import eq_
 import six
+import sqlalchemy as sa
 
-from compstack.auth.helpers import after_login_url
+from compstack.auth.helpers import after_login_url, chunked
+from compstack.auth.lib import hashers
+from compstack.auth.lib.cache import DbmCache, LRUCache
+from compstack.auth.lib.throttle import DbmWindowStore, LoginThrottle, MemoryWindowStore
 from compstack.auth.lib.testing import create_user_with_permissions
+from compstack.auth.model.engine import PermissionLayout, PrefixTrie, permission_registry
 from compstack.auth.model.orm import User, Group, Permission
 from compstack.sqlalchemy import db
 
 
+def test_chunked():
+    eq_(list(chunked([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+    eq_(list(chunked([], 2)), [])
+
+    # iterators are consumed one chunk at a time
+    consumed = []
+
+    def items():
+        for i in range(5):
+            consumed.append(i)
+            yield i
+    chunks = chunked(items(), 2)
+    eq_(next(chunks), [0, 1])
+    eq_(consumed, [0, 1])
+
+
 def test_group_unique():
     g1 = Group.add_iu(name=u'test unique group name')
     g2 = Group.add_iu(name=u'test unique group name')
@@ -97,6 +123,76 @@ def test_password_validate():
     assert not u.validate_password('foobar')
 
 
+class TestPasswordHashers(object):
+
+    def test_hash_format(self):
+        u = create_user_with_permissions()
+        algorithm, iterations, digest = u.pass_hash.split('$')
+        eq_((algorithm, iterations), ('pbkdf2_sha256', '1000'))
+        eq_(len(digest), 64)
+
+    def test_legacy_hash_upgraded_on_login(self):
+        u = create_user_with_permissions()
+        password = u.text_password
+        full_salt, _ = User.calc_salt(u.pass_salt)
+        u.pass_hash = hashlib.sha512(password.encode() + full_salt).hexdigest()
+        db.sess.commit()
+
+        assert u.validate_password(password)
+        assert not u.validate_password('foobar')
+        assert User.validate(u.login_id, 'foobar') is None
+        assert '$' not in u.pass_hash
+
+        assert User.validate(u.login_id, password) is u
+        assert u.pass_hash.startswith('pbkdf2_sha256$1000$')
+        assert u.validate_password(password)
+
+    def test_work_factor_change(self):
+        u = create_user_with_permissions()
+        password = u.text_password
+        settings.components.auth.password_hasher.iterations = 1200
+        try:
+            # hashes made with the old iteration count still verify
+            assert u.validate_password(password)
+            User.validate(u.login_id, password)
+            assert u.pass_hash.startswith('pbkdf2_sha256$1200$')
+        finally:
+            settings.components.auth.password_hasher.iterations = 1000
+
+    def test_scrypt(self):
+        if not hasattr(hashlib, 'scrypt'):
+            raise SkipTest('hashlib.scrypt is not available')
+        hasher = hashers.ScryptHasher(n=2 ** 8, r=8, p=1)
+        encoded = hasher.encode(u'password', b'salt')
+        assert encoded.startswith('scrypt$256$8$1$')
+        assert hashers.identify_hasher(encoded).verify(u'password', b'salt', encoded)
+        assert not hashers.identify_hasher(encoded).verify(u'other', b'salt', encoded)
+
+    def test_verify_pool(self):
+        u = create_user_with_permissions()
+        password = u.text_password
+        config = settings.components.auth.password_verify
+        config.workers, config.max_pending = 1, 0
+        try:
+            assert u.validate_password(password)
+            _, slots = hashers._pool.get(1, 0)
+            slots.acquire()
+            try:
+                u.validate_password(password)
+                assert False, 'expected PasswordVerifyBusy'
+            except hashers.PasswordVerifyBusy:
+                pass
+            finally:
+                slots.release()
+        finally:
+            config.workers, config.max_pending = None, 20
+
+    def test_calibrate(self):
+        hasher, seconds = hashers.calibrate_hasher('pbkdf2', 0.001)
+        assert hasher.iterations >= 10000
+        assert seconds >= 0.001
+
+
 def test_user_get_by_login():
     u = create_user_with_permissions()
     obj = User.get_by(login_id=u.login_id)
@@ -234,6 +330,169 @@ class TestPermissions(object):
         for rec in perm_map:
             assert rec['resulting_approval'] == (rec['permission_name'] in permissions_approved)
 
+    def test_user_permission_explanation(self):
+        user = User.get(self.user.id)
+        perm_map = user.permission_map
+        perm_map_groups = user.permission_map_groups
+        explanation = user.permission_explanation
+        eq_([row['permission_id'] for row in explanation],
+            [row['permission_id'] for row in perm_map])
+        for row, expected in zip(explanation, perm_map):
+            for key in ('permission_name', 'user_approved', 'group_approved', 'group_denied',
+                        'resulting_approval'):
+                eq_(row[key], expected[key])
+            groups = perm_map_groups.get(row['permission_id'], {'approved': [], 'denied': []})
+            eq_(row['approved_groups'], groups['approved'])
+            eq_(row['denied_groups'], groups['denied'])
+
+    def test_permission_holders(self):
+        approved = Permission.get_by(name=u'ugp_approved')
+        holders = User.cm_permission_holders(approved.id)
+        eq_([(h['user_id'], h['source']) for h in holders],
+            [(self.user.id, 'direct'), (self.user2.id, 'direct')])
+        eq_(holders[0]['login_id'], self.user.login_id)
+
+        eq_([(h['user_id'], h['source']) for h in
+             User.cm_permission_holders(self.perm_approved_grp.id)],
+            [(self.user.id, 'group')])
+        # denied by the user or by another group
+        eq_(User.cm_permission_holders(self.perm_denied.id), [])
+        eq_(User.cm_permission_holders(self.perm_denied_grp.id), [])
+
+        # keyset paging
+        eq_([h['user_id'] for h in User.cm_permission_holders(approved.id, limit=1)],
+            [self.user.id])
+        eq_([h['user_id'] for h in
+             User.cm_permission_holders(approved.id, after_id=self.user.id, limit=1)],
+            [self.user2.id])
+
+    def test_user_permissions_query_matches_full_view(self):
+        from compstack.auth.model.queries import query_users_permissions, \
+            query_user_permissions
+
+        full = query_users_permissions().alias()
+        for uid in (self.user.id, self.user2.id):
+            expected = [
+                tuple(row) for row in
+                db.sess.execute(sa.select([full]).where(full.c.user_id == uid))
+            ]
+            scoped = [tuple(row) for row in db.sess.execute(query_user_permissions(uid))]
+            assert expected
+            eq_(scoped, expected)
+        # the user is filtered before aggregating, not through the view
+        settings.components.auth.permission_view = True
+        try:
+            assert 'auth_user_permissions' not in str(query_user_permissions(self.user.id))
+        finally:
+            settings.components.auth.permission_view = False
+
+    def test_permission_view(self):
+        from compstack.auth.model.queries import query_users_permissions, \
+            build_users_permissions
+        from compstack.auth.model.sqlview import install_permission_view, \
+            drop_permission_view
+
+        expected = [tuple(row) for row in db.sess.execute(build_users_permissions(self.user.id))]
+        # the view definition can't be ordered on SQL Server
+        assert 'ORDER BY' not in str(build_users_permissions(ordered=False))
+        permission_map = User.get(self.user.id).permission_map
+        db.sess.commit()
+        install_permission_view()
+        settings.components.auth.permission_view = True
+        try:
+            eq_([tuple(row) for row in db.sess.execute(query_users_permissions(self.user.id))],
+                expected)
+            eq_(User.get(self.user.id).permission_map, permission_map)
+        finally:
+            settings.components.auth.permission_view = False
+            db.sess.commit()
+            drop_permission_view()
+
+    def test_cached_statements(self):
+        from compstack.auth.model import queries
+
+        eq_(User.cm_permission_map(self.user.id), User.get(self.user.id).permission_map)
+        statement = queries.permission_map_statement()
+        assert queries.permission_map_statement() is statement
+        User.cm_permission_map(self.user2.id)
+        User.get(self.user2.id).permission_map_groups
+        User.get_by_permissions(u'ugp_approved')
+        User.get_by_permissions([u'ugp_approved', u'ugp_denied'], match='all')
+        compiled = len(queries._compiled_cache)
+        assert compiled
+        User.cm_permission_map(self.user.id)
+        User.get(self.user.id).permission_map_groups
+        eq_(User.get_by_permissions([u'ugp_approved', u'ugp_approved_grp'], ids_only=True),
+            [self.user.id, self.user2.id])
+        eq_(User.get_by_permissions([u'ugp_approved', u'ugp_not_approved'], match='all'), [])
+        eq_(len(queries._compiled_cache), compiled)
+
+    def test_group_permissions_single_pass(self):
+        from compstack.auth.model.queries import query_group_permissions, \
+            query_approved_group_permissions, query_denied_group_permissions
+
+        def by_key(query, *columns):
+            return dict(
+                ((row['permission_id'], row['user_id']), tuple(row[c] for c in columns))
+                for row in db.sess.execute(query) if row['user_id'] is not None
+            )
+        combined = by_key(query_group_permissions(self.user.id),
+                          'group_approved', 'group_denied')
+        approved = by_key(query_approved_group_permissions(self.user.id), 'group_approved')
+        denied = by_key(query_denied_group_permissions(self.user.id), 'group_denied')
+        assert combined
+        for key in set(combined) | set(approved) | set(denied):
+            eq_(combined[key], approved.get(key, (None,)) + denied.get(key, (None,)))
+
+
+class TestPermissionRegistry(object):
+
+    def test_ids_for_names(self):
+        p1 = Permission.add_iu(name=u'registry-test-1')
+        p2 = Permission.add_iu(name=u'registry-test-2')
+        eq_(permission_registry.ids_for_names([u'registry-test-2', u'registry-test-1']),
+            [p2.id, p1.id])
+        eq_(permission_registry.ids_for_names(u'registry-test-1'), [p1.id])
+        eq_(permission_registry.ids_for_names(None), [])
+
+    def test_unknown_name(self):
+        try:
+            permission_registry.ids_for_names([u'registry-test-1', u'registry-not-there'])
+            assert False, 'expected ValueError'
+        except ValueError as e:
+            eq_(str(e), 'permission registry-not-there does not exist')
+
+    def test_cleared_by_permission_writes(self):
+        p = Permission.add_iu(name=u'registry-test-3')
+        eq_(permission_registry.ids_for_names(u'registry-test-3'), [p.id])
+        Permission.add_iu(name=u'registry-test-4')
+        Permission.delete_where(Permission.id == p.id)
+        new_p = Permission.add(name=u'registry-test-3')
+        assert new_p.id != p.id
+        eq_(permission_registry.ids_for_names(u'registry-test-3'), [new_p.id])
+
+    def test_dense_bits(self):
+        Permission.add_iu(name=u'registry-test-5')
+        layout = permission_registry.layout()
+        ids = sorted(layout.names)
+        eq_([layout.bit(pid) for pid in ids], [1 << i for i in range(len(ids))])
+        eq_(layout.full_mask, (1 << len(ids)) - 1)
+        eq_(sorted(layout.names_for_mask(layout.full_mask)), sorted(layout.ids))
+        eq_(permission_registry.names_for_mask(layout.bit(ids[-1])), [layout.names[ids[-1]]])
+        # processes loading the same permissions agree on the layout
+        eq_(PermissionLayout(layout.names.items()).key, layout.key)
+
+
+def test_prefix_trie():
+    trie = PrefixTrie()
+    trie.add('', 'all')
+    trie.add('reports-', 'reports')
+    trie.add('reports-sales-', 'sales')
+    trie.add('reports-sales-', 'sales2')
+    eq_(trie.matching('reports-sales-view'), ['all', 'reports', 'sales', 'sales2'])
+    eq_(trie.matching('reports-hr'), ['all', 'reports'])
+    eq_(trie.matching('users'), ['all'])
+
 
 class TestAfterLoginUrl(object):
     def test_no_settings(self):
@@ -252,3 +511,101 @@ class TestAfterLoginUrl(object):
     def test_with_script_name(self):
         settings.components.auth.after_login_url = 'foobar'
         eq_('/script/foobar', after_login_url())
+
+
+class TestCacheBackends(object):
+
+    def test_lru_eviction(self):
+        cache = LRUCache(max_size=2, ttl=None)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        eq_(cache.get(1), 'a')
+        cache.set(3, 'c')
+        # 2 was the least recently used
+        eq_(cache.get(2), None)
+        eq_(cache.get(1), 'a')
+        eq_(cache.get(3), 'c')
+        eq_(cache.stats, {'hits': 3, 'misses': 1, 'evictions': 1})
+
+    def test_lru_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache.set(1, 'a')
+        eq_(cache.get(1), None)
+        eq_(cache.stats, {'hits': 0, 'misses': 1, 'evictions': 1})
+
+    def test_dbm(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'cache')
+            cache = DbmCache(path)
+            cache.set((1, True), {u'auth-manage': True})
+            # another instance (i.e. process) sees the same entries
+            eq_(DbmCache(path).get((1, True)), {u'auth-manage': True})
+            eq_(cache.get((2, True)), None)
+            cache.delete((1, True))
+            eq_(cache.get((1, True)), None)
+            cache.set((1, True), {})
+            cache.clear()
+            eq_(cache.get((1, True)), None)
+
+            cache = DbmCache(path, ttl=-1)
+            cache.set(1, 'a')
+            eq_(cache.get(1), None)
+            eq_(cache.evictions, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestLoginThrottle(object):
+
+    def test_memory_window(self):
+        store = MemoryWindowStore(max_keys=2)
+        throttle = LoginThrottle(store, window=60, per_login=2, per_ip=3)
+        throttle.record_failure(u'Bob', '10.0.0.1')
+        assert not throttle.is_throttled(u'bob', '10.0.0.2')
+        throttle.record_failure(u'bob', '10.0.0.1')
+        # login ids are not case sensitive
+        assert throttle.is_throttled(u'BOB', '10.0.0.2')
+        assert not throttle.is_throttled(u'alice', '10.0.0.1')
+        throttle.record_failure(u'alice', '10.0.0.1')
+        assert throttle.is_throttled(u'carol', '10.0.0.1')
+        # only max_keys keys are kept, the least recently used is dropped
+        eq_(len(store._entries), 2)
+        assert not throttle.is_throttled(u'bob', None)
+
+        throttle.record_success(u'alice')
+        assert not throttle.is_throttled(u'alice', None)
+
+    def test_per_ip_is_opt_in(self):
+        throttle = LoginThrottle(MemoryWindowStore(), window=60, per_login=2)
+        for _ in range(5):
+            throttle.record_failure(randchars(), '10.0.0.1')
+        # many login ids failing from one address (e.g. a proxy) are not throttled
+        assert not throttle.is_throttled(u'bob', '10.0.0.1')
+        eq_(settings.components.auth.login_throttle.per_ip, None)
+
+    def test_window_slides(self):
+        store = MemoryWindowStore()
+        store.add('key', 10, 5, 100)
+        store.add('key', 10, 5, 105)
+        eq_(store.count('key', 10, 109), 2)
+        eq_(store.count('key', 10, 112), 1)
+        eq_(store.count('key', 10, 120), 0)
+        # at most `limit` times are kept per key
+        for now in range(200, 210):
+            store.add('key', 60, 3, now)
+        eq_(store.count('key', 60, 210), 3)
+
+    def test_dbm(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'throttle')
+            throttle = LoginThrottle(DbmWindowStore(path), window=60, per_login=2, per_ip=None)
+            throttle.record_failure(u'bob', '10.0.0.1')
+            throttle.record_failure(u'bob', '10.0.0.1')
+            # another process sees the same failures
+            assert LoginThrottle(DbmWindowStore(path), 60, 2, None).is_throttled(u'bob', None)
+            throttle.record_success(u'bob')
+            assert not throttle.is_throttled(u'bob', None)
+        finally:
+            shutil.rmtree(tmpdir)